@@ -1,16 +1,23 @@
 import coloredlogs, logging
-from time import sleep, gmtime
-import schedule
 import datetime
 
-from icalendar import Calendar
-
 from telegram import ParseMode, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
-from telegram.ext import Updater, MessageHandler, Filters, CommandHandler, CallbackContext, ConversationHandler
+from telegram.ext import Updater, MessageHandler, Filters, CommandHandler, CallbackContext, ConversationHandler, TypeHandler
 
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import threading
+import secrets
+import os
 
 from .notify_dispatcher import *
+from .notify_scheduler import *
+from .send_pipeline import SendPipeline, TELEGRAM_GLOBAL_RATE
+from .shards import CommandQueue, ShardCommand
+from .webhook_server import WebhookServer
+from .ical_extractor import iter_events, read_events, UnsupportedFeedError
+from .parse_pool import is_uom_timetable
+from .metrics import MetricsServer, REGISTRY, SEND_QUEUE_DEPTH, DISPATCH_SECONDS, STARTUP_POLLING_SECONDS, STARTUP_FIRST_UPDATE_SECONDS, profiled, process_uptime
 
 coloredlogs.install()
 logging.basicConfig(
@@ -29,60 +36,252 @@ token_file.close()
 
 HINT_IMAGE_PATH = "./ical_demo_screenshot.png"
 
-END = False
+ICAL_FETCH_WORKERS = 16
+ICAL_FETCH_TIMEOUT = (5.0, 30.0)
+# worker processes parsing the feeds of a refresh, 1 parses them in the bot's own process.
+ICAL_PARSE_WORKERS = os.cpu_count() or 1
+ICAL_PARSE_CHUNKSIZE = 8
+# feeds a refresh downloads and parses at a time, only one batch of feed contents is in memory at once.
+ICAL_REFRESH_BATCH = 256
+
+DAILY_DISPATCH_TIME = (6, 0)
+# The local hours [start, end) the nightly feed refreshes are spread over, every feed has its own slot in it.
+FEED_REFRESH_WINDOW = (1, 5)
+# How often the feeds which are due (their nightly slot, a retry or the shorter interval of a often changing feed) are refreshed.
+FEED_REFRESH_CHECK_MINUTES = 10
+
+SEND_WORKERS = 8
+SEND_MAX_RETRIES = 5
+
+# The port of the Prometheus text endpoint at /metrics, None to disable it.
+METRICS_PORT = 9464
+# How often a one line summary of the metrics is written to the log, None to disable it.
+METRICS_DUMP_SECONDS = 3600
+# When true, every daily dispatch runs under cProfile and the stats are dumped to logs/.
+PROFILE_DAILY_DISPATCH = False
+
+# threads running the handlers marked run_async, i.e. the /setup steps which wait on the network.
+HANDLER_WORKERS = 16
+# how many events of a new subscription are looked at to tell whether it's a UoM timetable.
+VERIFY_SAMPLE_EVENTS = 3
+
+# The Bot API server, None for Telegram's. A local telegram-bot-api server saves the round trips to Telegram.
+TELEGRAM_API_URL = None
+
+# In webhook mode Telegram posts the updates to WEBHOOK_URL, which has to reach the server listening on WEBHOOK_HOST:WEBHOOK_PORT at WEBHOOK_PATH,
+# e.g. through a reverse proxy terminating the TLS. The secret token Telegram sends along is read from WEBHOOK_SECRET_FILE,
+# a new one is made on every start when there's no such file.
+WEBHOOK_URL = None
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_SECRET_FILE = '.WEBHOOK_SECRET'
+# threads handling the updates received on the webhook, and the updates every one of them queues at most.
+WEBHOOK_WORKERS = 8
+WEBHOOK_QUEUE_SIZE = 64
+
+INTAKE_POLLING = 'polling'
+INTAKE_WEBHOOK = 'webhook'
+
+# How often a shard worker looks for commands passed on by the front process, and how many it runs at once.
+SHARD_COMMAND_POLL_SECONDS = 0.5
+SHARD_COMMAND_WORKERS = 4
 
 STATE_SETUP_SUBSCRIPTION = 0
 
+# ROLE_SINGLE runs the whole bot in one process. In the sharded deployment the ROLE_FRONT process only handles the Telegram updates
+# and passes the commands which change a user on to the ROLE_WORKER process owning that user, which also sends the reply, see shards.
+ROLE_SINGLE = 'single'
+ROLE_FRONT = 'front'
+ROLE_WORKER = 'worker'
+
+COMMAND_SETUP = 'setup'
+COMMAND_STOP = 'stop'
+COMMAND_RESUME = 'resume'
+COMMAND_LEAD = 'lead'
+
+SETUP_DB_FAILED_MSG = "There might be a server side problem. Please commit an issue on [GitHub](https://github.com/GrayNekoBean/uom_checkin_alarm_bot) or contact @GrayNekoBean for reporting the bug."
+
 class UoMCheckinBot:
-    def __init__(self) -> None:
-        self.tg_updater = Updater(TOKEN)
+    # role: ROLE_SINGLE, ROLE_FRONT or ROLE_WORKER.
+    # shard, shards: a worker owns the users of shard `shard` out of `shards`, the front passes the commands on to `shards` workers.
+    # intake: INTAKE_POLLING or INTAKE_WEBHOOK, how the updates are received, the webhook_* arguments are only used by the latter.
+    def __init__(self, role: str = ROLE_SINGLE, shard: int = 0, shards: int = 1, intake: str = INTAKE_POLLING, webhook_url: str = WEBHOOK_URL,
+                 webhook_host: str = WEBHOOK_HOST, webhook_port: int = WEBHOOK_PORT, webhook_path: str = WEBHOOK_PATH, api_url: str = TELEGRAM_API_URL) -> None:
+        self.role = role
+        self.shard = shard
+        self.shards = max(1, shards)
+        self.intake = intake
+        self.webhook_url = webhook_url
+        self.webhook_listen = (webhook_host, webhook_port)
+        self.webhook_path = webhook_path
+        self.webhook_server = None
+        self.tg_updater = Updater(TOKEN, workers=HANDLER_WORKERS, base_url=api_url)
         self.tg_dispatcher = self.tg_updater.dispatcher
-        self.notify_dispatcher = NotifyDispatcher('./db/bot-database.db')
+        self.notify_dispatcher = NotifyDispatcher('./db/bot-database.db', ICalFetcher(ICAL_FETCH_WORKERS, ICAL_FETCH_TIMEOUT),
+                                                  parse_pool=ParsePool(ICAL_PARSE_WORKERS, ICAL_PARSE_CHUNKSIZE), batch_size=ICAL_REFRESH_BATCH,
+                                                  shard=(shard, self.shards) if role == ROLE_WORKER else None)
+        self.notify_dispatcher.refresh_scheduler.window = FEED_REFRESH_WINDOW
+        self.timer_engine = TimerEngine()
+        # the workers share the bot's global flood limit between them.
+        global_rate = TELEGRAM_GLOBAL_RATE / self.shards if role == ROLE_WORKER else TELEGRAM_GLOBAL_RATE
+        self.send_pipeline = SendPipeline(self.tg_dispatcher.bot, workers=SEND_WORKERS, global_rate=global_rate, max_retries=SEND_MAX_RETRIES)
+        self.command_queue = CommandQueue(self.notify_dispatcher.db, self.shards) if role != ROLE_SINGLE else None
+        self.__command_pool = ThreadPoolExecutor(SHARD_COMMAND_WORKERS, thread_name_prefix='shard-command') if role == ROLE_WORKER else None
+        # the feed refreshes run one after the other on one long-lived thread, which keeps its database connection between them.
+        self.__refresh_pool = ThreadPoolExecutor(1, thread_name_prefix='feed-refresh') if role != ROLE_FRONT else None
+        self.__refresh_future = None
+        self.notify_dispatcher.add_dispatch_listener(self.__schedule_notifies)
+        SEND_QUEUE_DEPTH.set_function(lambda: self.send_pipeline.pending())
+        # the daily dispatch and the one at startup never run at the same time.
+        self.__dispatch_lock = threading.Lock()
+        self.__first_update_seen = False
         self.hint_image = None
-        self.__setup_command_handlers()
+        if role != ROLE_WORKER:
+            self.__setup_command_handlers()
         pass
 
+    # Polling starts as soon as the users and the dispatch persisted today (if any) are loaded,
+    # a missing or stale dispatch is brought up to date in the background.
+    # The front process only polls, a worker doesn't poll at all and takes the commands of its shard instead.
     def run(self):
-        schedule.every().minutes.do(self.update)
-        schedule.every().day.at("06:00").do(self.dispatchTodaySessions)
-        t1 = threading.Thread(target=self.sched_loop)
+        if self.role != ROLE_FRONT:
+            self.timer_engine.schedule_daily('daily-dispatch', DAILY_DISPATCH_TIME[0], DAILY_DISPATCH_TIME[1], self.dispatchTodaySessions)
+            self.timer_engine.schedule_every('feed-refresh', FEED_REFRESH_CHECK_MINUTES * 60, self.__refresh_due_feeds)
+        if self.role == ROLE_WORKER:
+            released = self.command_queue.release(self.shard)
+            if released:
+                logger.info(f'Taking {released} unfinished command(s) of shard {self.shard} again.')
+            self.timer_engine.schedule_every('shard-commands', SHARD_COMMAND_POLL_SECONDS, self.__take_shard_commands)
+        if METRICS_PORT:
+            # every worker of the host serves its own metrics on the ports after the front's.
+            MetricsServer(METRICS_PORT + 1 + self.shard if self.role == ROLE_WORKER else METRICS_PORT).start()
+        if METRICS_DUMP_SECONDS:
+            self.timer_engine.schedule_every('metrics-dump', METRICS_DUMP_SECONDS, lambda: logger.info(f'Metrics: {REGISTRY.summary()}'))
+        t1 = threading.Thread(target=self.timer_engine.run_forever)
         t1.start()
-        # t2 = threading.Thread(target=self.tg_updater.start_polling())
-        # t2.start()
-        self.tg_updater.start_polling()
+        if self.role == ROLE_FRONT:
+            self.__start_polling()
+            return
+        self.send_pipeline.start()
+        self.notify_dispatcher.load_users()
+        resumed = self.notify_dispatcher.resume_dispatch()
+        if self.role == ROLE_SINGLE:
+            self.__start_polling()
+        else:
+            logger.info(f'Shard worker {self.shard} of {self.shards} started with {len(self.notify_dispatcher.users)} user(s).')
+        if not resumed:
+            threading.Thread(target=self.__startup_dispatch, name='startup-dispatch', daemon=True).start()
 
-    def sched_loop(self):
-        while not END:
-            schedule.run_pending()
-            sleep(1.0)
+    def __start_polling(self):
+        if self.intake == INTAKE_WEBHOOK:
+            self.__start_webhook()
+        else:
+            self.tg_updater.start_polling()
+        uptime = process_uptime()
+        STARTUP_POLLING_SECONDS.set(uptime)
+        logger.info(f'Started receiving updates by {self.intake} {uptime:.2f} seconds after the process started.')
 
-    def dispatchTodaySessions(self, fetch_local_icals=False):
-        if self.notify_dispatcher.load_all_users_calendars(fetch_local=fetch_local_icals):
+    # The server is listening before Telegram is told about the webhook, so no update is posted to nowhere.
+    def __start_webhook(self):
+        if not self.webhook_url:
+            raise ValueError('The webhook mode needs the url Telegram posts the updates to.')
+        secret = None
+        if os.path.exists(WEBHOOK_SECRET_FILE):
+            secret_file = open(WEBHOOK_SECRET_FILE, 'r')
+            secret = secret_file.read().strip()
+            secret_file.close()
+        if not secret:
+            secret = secrets.token_urlsafe(32)
+        # the dispatcher's own loop only starts the threads running the run_async handlers here, the updates are handled by the webhook's workers.
+        ready = threading.Event()
+        threading.Thread(target=self.tg_dispatcher.start, args=(ready,), name='dispatcher', daemon=True).start()
+        ready.wait()
+        self.webhook_server = WebhookServer(self.tg_dispatcher, self.webhook_listen[0], self.webhook_listen[1], self.webhook_path, secret,
+                                            WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+        self.webhook_server.start()
+        self.tg_dispatcher.bot.set_webhook(url=self.webhook_url, secret_token=secret)
+
+    # Today's sessions are dispatched from the EventIndex kept by the last run straight away, then the cached feeds are loaded as usual.
+    def __startup_dispatch(self):
+        with self.__dispatch_lock:
             self.notify_dispatcher.dispatchAll()
+        self.dispatchTodaySessions(True)
+
+    def dispatchTodaySessions(self, fetch_local_icals=False):
+        if PROFILE_DAILY_DISPATCH:
+            with profiled('logs/dispatch-' + datetime.now().strftime('%d-%m-%Y-%H:%M:%S') + '.prof'):
+                self.__dispatch_today_sessions(fetch_local_icals)
         else:
-            logger.error("A database issue occured when trying to download ical files.")
+            self.__dispatch_today_sessions(fetch_local_icals)
+
+    # At startup every feed is loaded (from its cached file when there is one), the daily dispatch only downloads the feeds which are due,
+    # the others have been refreshed in their slot of the night already.
+    def __dispatch_today_sessions(self, fetch_local_icals: bool):
+        with self.__dispatch_lock, DISPATCH_SECONDS.time():
+            if fetch_local_icals:
+                loaded = self.notify_dispatcher.load_all_users_calendars(fetch_local=True)
+            else:
+                loaded = self.notify_dispatcher.load_users() and self.notify_dispatcher.load_due_calendars()
+            if loaded:
+                self.notify_dispatcher.dispatchAll()
+                self.notify_dispatcher.collect_feed_garbage()
+            else:
+                logger.error("A database issue occured when trying to download ical files.")
 
-    def update(self):
-        if datetime.now().minute == 50:
-            self.__check_and_send_notifies()
-            
-    def __send_notify(self, chat_id: int, course: Course):
+    # Runs on the timer engine, the downloads happen on the refresh thread so they don't hold up the reminders.
+    # A refresh still running when the next one is due isn't queued up behind it, that round is skipped.
+    def __refresh_due_feeds(self):
+        if self.__refresh_future is not None and not self.__refresh_future.done():
+            return
+        self.__refresh_future = self.__refresh_pool.submit(self.__refresh_due_feeds_now)
+
+    def __refresh_due_feeds_now(self):
+        # a dispatch in progress refreshes the feeds itself, this round is skipped.
+        if not self.__dispatch_lock.acquire(blocking=False):
+            return
+        try:
+            self.notify_dispatcher.load_due_calendars()
+            # the sessions of users whose feed changed are dispatched again, before the daily dispatch they wait for it.
+            if self.notify_dispatcher.changed_users and self.notify_dispatcher.dispatch_date == self.notify_dispatcher.clock.now().astimezone().date():
+                self.notify_dispatcher.dispatchAll()
+        except Exception:
+            logger.exception('Failed to refresh the due ical feeds.')
+        finally:
+            self.__dispatch_lock.release()
+
+    # Sets a timer for every due time of the dispatched users' reminders (every user when user_ids is None).
+    # Timers are keyed by the due time, so users sharing a due time share one timer.
+    def __schedule_notifies(self, user_ids):
+        for when in self.notify_dispatcher.due_index.due_times(user_ids):
+            self.timer_engine.schedule_at(('due', when), when, lambda when=when: self.__check_and_send_notifies(when))
+
+    def __render_notify(self, course: Course) -> str:
         code = course.code
         unit = course.name
         type = course.type
-        msg = f"Hey, you have a *{type}* session of *{unit}* (*{code}*) in 10 minutes, don't forget to check-in here: \nhttps://my.manchester.ac.uk/MyCheckIn"
-        self.tg_dispatcher.bot.send_message(chat_id, msg, parse_mode=ParseMode.MARKDOWN)
-
-    def __check_and_send_notifies(self):
-        current_hour = datetime.utcnow().hour
-        courses = self.notify_dispatcher.query_course_by_time(current_hour)
-        if courses:
-            for course in courses:
-                if not self.notify_dispatcher.is_user_stop_notify(course.user_id):
-                    self.__send_notify(course.user_id, course)
-        # else:
-        #     if (current_hour >= 8 and current_hour <= 16):
-        #         logging.info("This is a bit wierd since it's working hour but no courses at this hour was found, there might be a problem, or not.")
+        minutes = max(1, round((course.start - self.timer_engine.clock.now()).total_seconds() / 60))
+        return f"Hey, you have a *{type}* session of *{unit}* (*{code}*) in {minutes} minutes, don't forget to check-in here: \nhttps://my.manchester.ac.uk/MyCheckIn"
+
+    def __send_notify(self, chat_id: int, course: Course, msg: str):
+        # queued, the pipeline sends it within Telegram's rate limits and records it as notified once it's delivered.
+        self.send_pipeline.send(chat_id, msg, parse_mode=ParseMode.MARKDOWN, session_start=course.start,
+                                on_sent=lambda job: self.notify_dispatcher.mark_notified(course))
+
+    # Stopped users are never in the due index, courses which have started in the meantime (after a stall) are dropped.
+    # The message is rendered once per session, everyone attending it whose reminder is due now gets the same text.
+    def __check_and_send_notifies(self, when: datetime):
+        now = self.timer_engine.clock.now()
+        messages = {}
+        for course in self.notify_dispatcher.pop_due_courses(when):
+            if course.start <= now:
+                logger.warning(f'The reminder of a session at {course.start} for user {course.user_id} was due at {when} and is dropped.')
+                continue
+            key = (course.code, course.name, course.type, course.start)
+            msg = messages.get(key)
+            if msg is None:
+                msg = messages[key] = self.__render_notify(course)
+            self.__send_notify(course.user_id, course, msg)
 
     def __start(self, update: Update, context: CallbackContext):
         welcome_msg = "Hi, Welcome to use this bot. If you're a student of UoM, this bot can notify you to check-in for every session! \nLet's not keep missing the check-in, for not get droped-out someday! \nUse /setup to activate this bot for you, and we'll need you to give some of your information."
@@ -97,7 +296,7 @@ class UoMCheckinBot:
         if (update.effective_chat.id < 0):
             update.message.reply_text(setup_deny_msg)
             return ConversationHandler.END
-        if self.notify_dispatcher.is_user_exists(update.effective_chat.id):
+        if self.__is_registered(update.effective_chat.id):
             msg = update.message.reply_text(update_msg, reply_markup=keyboard_markup)
             context.chat_data['updating'] = True
         else:
@@ -114,56 +313,70 @@ class UoMCheckinBot:
         context.chat_data['id'] = update.effective_chat.id
         return STATE_SETUP_SUBSCRIPTION
     
-    def __verify_subscription(self, href: str):
-        response = requests.get(href)
-        if response:
-            if response.ok:
-                try:
-                    ical = Calendar.from_ical(response.text)
-                except ValueError:
-                    return False
-                if ical:
-                    if len(ical.subcomponents) > 2:
-                        sample_event = ical.subcomponents[1]
-                        if sample_event['DESCRIPTION']:
-                            desc = str(sample_event['DESCRIPTION'])
-                            lines = desc.splitlines()
-                            if (len(lines) >= 5):
-                                infos = {}
-                                for ln in lines:
-                                    parts = ln.split(': ')
-                                    if len(parts) == 2:
-                                        infos[parts[0]] = parts[1]
-                                if ('Event type' in infos) and ('Unit Code' in infos) and ('Unit Description' in infos):
-                                    return (ical, response.text)
-        return False
+    # Reads the feed while it's downloading and stops after the first few events, they are enough to tell a UoM timetable.
+    # The whole feed is only downloaded and parsed afterwards, by load_and_dispatch_user.
+    def __verify_subscription(self, href: str) -> bool:
+        with self.notify_dispatcher.fetcher.stream(href) as response:
+            if not response.ok:
+                logger.info(f'Subscription verification failed to download {href}: {response.error}')
+                return False
+            try:
+                events = list(itertools.islice(iter_events(response.lines), VERIFY_SAMPLE_EVENTS))
+            except UnsupportedFeedError:
+                events = None
+            if response.error:
+                logger.info(f'Subscription verification failed to download {href}: {response.error}')
+                return False
+        if events is None:
+            # not something the streaming extractor handles, check the whole feed the slow way.
+            response = self.notify_dispatcher.fetcher.fetch(href)
+            if not response.ok:
+                return False
+            try:
+                events = read_events(response.text)[:VERIFY_SAMPLE_EVENTS]
+            except ValueError:
+                return False
+        return is_uom_timetable(events)
 
+    # Runs on the dispatcher's worker pool (run_async), so a slow link only holds up its own conversation.
     def __setup_2(self, update: Update, context: CallbackContext) -> int:
         VALIDATING_MSG = "Verifying your ical subscription URL, please wait for a few seconds..."
-        SUCCESS_MSG = "Exellent, everythings' done! You will be notified to go check-in by this bot when every session is about to start."
+        LOADING_MSG = "Your subscription looks good, I'm loading your timetable now..."
         VERIFY_FAILED_MSG = "Sorry, This link does not seem like a UoM timetable link. there might be internet issues, or you provided a wrong link. If you're sure everything's done right, it could be my problem. You can commit an issue on [GitHub](https://github.com/GrayNekoBean/uom_checkin_alarm_bot) or contact @GrayNekoBean for reporting the bug."
-        DB_FAILED_MSG = "There might be a server side problem. Please commit an issue on [GitHub](https://github.com/GrayNekoBean/uom_checkin_alarm_bot) or contact @GrayNekoBean for reporting the bug."
         link = update.message.text
         update.message.reply_text(VALIDATING_MSG)
-        verified_ical = self.__verify_subscription(link)
-        if verified_ical:
-            success = False
-            if (context.chat_data['updating']):
-                success = self.notify_dispatcher.update_user_subscription(update.effective_chat.id, link)
-            else:
-                user = User(context.chat_data['id'], link, UserConfig())
-                user.calendar = verified_ical[0]
-                user.ical_content = verified_ical[1]
-                success = self.notify_dispatcher.add_user(user)
-            if success:
-                update.message.reply_text(SUCCESS_MSG, reply_markup=ReplyKeyboardRemove())
-            else:
-                update.message.reply_markdown(DB_FAILED_MSG, reply_markup=ReplyKeyboardRemove())
-        else:
+        if not self.__verify_subscription(link):
             update.message.reply_markdown(VERIFY_FAILED_MSG)
             return STATE_SETUP_SUBSCRIPTION
+        if self.role == ROLE_FRONT:
+            # the owning worker registers the user and replies once the timetable is loaded.
+            self.command_queue.submit(COMMAND_SETUP, update.effective_chat.id, link=link)
+            update.message.reply_text(LOADING_MSG, reply_markup=ReplyKeyboardRemove())
+            return ConversationHandler.END
+        if not self.__register(update.effective_chat.id, link, context.chat_data['updating']):
+            update.message.reply_markdown(SETUP_DB_FAILED_MSG, reply_markup=ReplyKeyboardRemove())
+            return ConversationHandler.END
+        update.message.reply_text(LOADING_MSG, reply_markup=ReplyKeyboardRemove())
+        # the conversation ends here, the timetable is loaded in the background.
+        context.dispatcher.run_async(self.__load_timetable_and_reply, update.effective_chat.id, update.message)
         return ConversationHandler.END
 
+    def __load_timetable_and_reply(self, chat_id: int, message):
+        message.reply_text(self.__load_timetable(chat_id))
+
+    def __register(self, chat_id: int, link: str, updating: bool) -> bool:
+        if updating:
+            return self.notify_dispatcher.update_user_subscription(chat_id, link, load=False)
+        return self.notify_dispatcher.add_user(User(chat_id, link, UserConfig()))
+
+    # Returns the message for the user.
+    def __load_timetable(self, chat_id: int) -> str:
+        SUCCESS_MSG = "Exellent, everythings' done! You will be notified to go check-in by this bot when every session is about to start."
+        LOAD_FAILED_MSG = "Your subscription has been saved, but I couldn't download your timetable just now. I will try it again in the next refresh."
+        if self.notify_dispatcher.load_and_dispatch_user(chat_id):
+            return SUCCESS_MSG
+        return LOAD_FAILED_MSG
+
     def __input_valid_url(self, update: Update, context: CallbackContext) -> int:
         MSG = "Sorry, the url can't be accepted, please input an valid url"
         update.message.reply_text(MSG)
@@ -175,35 +388,112 @@ class UoMCheckinBot:
         return ConversationHandler.END
 
     def __stop_notify(self, update: Update, context: CallbackContext):
+        if self.role == ROLE_FRONT:
+            self.command_queue.submit(COMMAND_STOP, update.effective_chat.id)
+            return
+        update.message.reply_text(self.__stop_user(update.effective_chat.id))
+
+    # Returns the message for the user.
+    def __stop_user(self, chat_id: int) -> str:
         STOP_SUCCESS_MSG = "I will stop pushing notify to you from now on, if you want keep recieving check-in notify please use /resume"
         STOP_FAILED_MSG = "I have failed to manipulate your config. Maybe you haven't setup yet, or it could be my problem."
         ALREADY_DONE_MSG = "You have already stopped notification, you don't need to do it again."
 
-        if self.notify_dispatcher.is_user_stop_notify(update.effective_chat.id):
-            update.message.reply_text(ALREADY_DONE_MSG)
-            return
+        if self.notify_dispatcher.is_user_stop_notify(chat_id):
+            return ALREADY_DONE_MSG
 
-        if (self.notify_dispatcher.set_user_stop(update.effective_chat.id)):
-            update.message.reply_text(STOP_SUCCESS_MSG)
+        if (self.notify_dispatcher.set_user_stop(chat_id)):
+            return STOP_SUCCESS_MSG
         else:
-            update.message.reply_text(STOP_FAILED_MSG)
+            return STOP_FAILED_MSG
     
     def __resume_notify(self, update: Update, context: CallbackContext):
+        if self.role == ROLE_FRONT:
+            self.command_queue.submit(COMMAND_RESUME, update.effective_chat.id)
+            return
+        update.message.reply_text(self.__resume_user(update.effective_chat.id))
+
+    # Returns the message for the user.
+    def __resume_user(self, chat_id: int) -> str:
         RESUME_SUCCESS_MSG = "I will resume pushing notify to from from now on, if you want to stop recieving again, please user /stop"
         RESUME_FAILED_MSG = "I have failed to manipulate your config. Maybe you haven't setup yet, or it could be my problem."
         ALREADY_DONE_MSG = "The notification haven't been stopped, you don't need to resume it."
 
-        if not self.notify_dispatcher.is_user_stop_notify(update.effective_chat.id):
-            update.message.reply_text(ALREADY_DONE_MSG)
+        if not self.notify_dispatcher.is_user_stop_notify(chat_id):
+            return ALREADY_DONE_MSG
+
+        if (self.notify_dispatcher.set_user_resume(chat_id)):
+            return RESUME_SUCCESS_MSG
+        else:
+            return RESUME_FAILED_MSG
+
+    def __set_lead_time(self, update: Update, context: CallbackContext):
+        USAGE_MSG = "Please tell me how many minutes before a session you would like to be notified, e.g. /lead 15"
+
+        if len(context.args) != 1 or not context.args[0].isdigit() or not (1 <= int(context.args[0]) <= 120):
+            update.message.reply_text(USAGE_MSG)
             return
 
-        if (self.notify_dispatcher.set_user_resume(update.effective_chat.id)):
-            update.message.reply_text(RESUME_SUCCESS_MSG)
+        minutes = int(context.args[0])
+        if self.role == ROLE_FRONT:
+            self.command_queue.submit(COMMAND_LEAD, update.effective_chat.id, minutes=minutes)
+            return
+        update.message.reply_text(self.__set_user_lead_time(update.effective_chat.id, minutes))
+
+    # Returns the message for the user.
+    def __set_user_lead_time(self, chat_id: int, minutes: int) -> str:
+        SUCCESS_MSG = "Got it, I will notify you {} minutes before every session."
+        FAILED_MSG = "I have failed to manipulate your config. Maybe you haven't setup yet, or it could be my problem."
+
+        if (self.notify_dispatcher.set_user_lead_time(chat_id, minutes)):
+            return SUCCESS_MSG.format(minutes)
         else:
-            update.message.reply_text(RESUME_FAILED_MSG)
+            return FAILED_MSG
+
+    # The front process doesn't load the users, it looks them up in the database.
+    def __is_registered(self, chat_id: int) -> bool:
+        if self.role == ROLE_FRONT:
+            return self.notify_dispatcher.is_user_stored(chat_id)
+        return self.notify_dispatcher.is_user_exists(chat_id)
+
+    # Runs on the timer engine of a worker, the commands are run on the command pool.
+    def __take_shard_commands(self):
+        for command in self.command_queue.take(self.shard):
+            self.__command_pool.submit(self.__run_shard_command, command)
+
+    # The replies go through the send pipeline, after the reminders which are due.
+    def __run_shard_command(self, command: ShardCommand):
+        chat_id = command.chat_id
+        try:
+            if command.command == COMMAND_SETUP:
+                if not self.__register(chat_id, command.payload['link'], self.notify_dispatcher.is_user_exists(chat_id)):
+                    self.send_pipeline.send(chat_id, SETUP_DB_FAILED_MSG, parse_mode=ParseMode.MARKDOWN)
+                else:
+                    self.send_pipeline.send(chat_id, self.__load_timetable(chat_id))
+            elif command.command == COMMAND_STOP:
+                self.send_pipeline.send(chat_id, self.__stop_user(chat_id))
+            elif command.command == COMMAND_RESUME:
+                self.send_pipeline.send(chat_id, self.__resume_user(chat_id))
+            elif command.command == COMMAND_LEAD:
+                self.send_pipeline.send(chat_id, self.__set_user_lead_time(chat_id, command.payload['minutes']))
+            else:
+                logger.error(f'Unknown command {command.command} for chat {chat_id}.')
+        except Exception:
+            logger.exception(f'Failed to run the {command.command} command of chat {chat_id}.')
+        finally:
+            self.command_queue.done(command.id)
+
+    # In a handler group after the commands, so it runs once the first update has been handled.
+    def __record_first_update(self, update: Update, context: CallbackContext):
+        if self.__first_update_seen:
+            return
+        self.__first_update_seen = True
+        uptime = process_uptime()
+        STARTUP_FIRST_UPDATE_SECONDS.set(uptime)
+        logger.info(f'Handled the first update {uptime:.2f} seconds after the process started.')
 
     def __show_help(self, update: Update, context: CallbackContext):
-        HELP_MSG = "Welcome to use UoM check-in notify bot! if you find this bot helpful, please give a star to this bot on [GitHub](https://github.com/GrayNekoBean/uom_checkin_alarm_bot)!\nThe help info for commands are shown below: \n/start : Initialize the bot.\n/setup : Setup your timetable subscription and activate the bot function for you.\n/stop : stop sending notifications, this will not erase your user data but just stop pushing notify.\n/resume : resume sending notifies from stop status.\n/cancel : cancel any in-progress action.\n/help : show this help message."
+        HELP_MSG = "Welcome to use UoM check-in notify bot! if you find this bot helpful, please give a star to this bot on [GitHub](https://github.com/GrayNekoBean/uom_checkin_alarm_bot)!\nThe help info for commands are shown below: \n/start : Initialize the bot.\n/setup : Setup your timetable subscription and activate the bot function for you.\n/stop : stop sending notifications, this will not erase your user data but just stop pushing notify.\n/resume : resume sending notifies from stop status.\n/lead : set how many minutes before a session you will be notified, e.g. /lead 15\n/cancel : cancel any in-progress action.\n/help : show this help message."
 
         update.message.reply_markdown(HELP_MSG)
         
@@ -212,17 +502,25 @@ class UoMCheckinBot:
     def __setup_command_handlers(self):
         self.start_handler = CommandHandler('start', self.__start)
         self.setup_handler = ConversationHandler(
-            entry_points= [CommandHandler('setup', self.__setup)],
+            entry_points= [CommandHandler('setup', self.__setup, run_async=True)],
             states={
-                STATE_SETUP_SUBSCRIPTION: [MessageHandler(Filters.regex('^(http:\/\/www\.|https:\/\/www\.|http:\/\/|https:\/\/)?[a-z0-9]+([\-\.]{1}[a-z0-9]+)*\.[a-z]{2,5}(:[0-9]{1,5})?(\/.*)?$'), self.__setup_2),  MessageHandler(~Filters.command, self.__input_valid_url)]
+                STATE_SETUP_SUBSCRIPTION: [MessageHandler(Filters.regex('^(http:\/\/www\.|https:\/\/www\.|http:\/\/|https:\/\/)?[a-z0-9]+([\-\.]{1}[a-z0-9]+)*\.[a-z]{2,5}(:[0-9]{1,5})?(\/.*)?$'), self.__setup_2, run_async=True),  MessageHandler(~Filters.command, self.__input_valid_url)]
             },
             fallbacks=[CommandHandler('cancel', self.__cancel_setup)]
         )
         self.stop_handler = CommandHandler('stop', self.__stop_notify)
         self.resume_handler = CommandHandler('resume', self.__resume_notify)
+        self.lead_handler = CommandHandler('lead', self.__set_lead_time)
         self.help_handler = CommandHandler('help', self.__show_help)
         self.tg_dispatcher.add_handler(self.start_handler)
         self.tg_dispatcher.add_handler(self.setup_handler)
         self.tg_dispatcher.add_handler(self.stop_handler)
         self.tg_dispatcher.add_handler(self.resume_handler)
-        self.tg_dispatcher.add_handler(self.help_handler)
\ No newline at end of file
+        self.tg_dispatcher.add_handler(self.lead_handler)
+        self.tg_dispatcher.add_handler(self.help_handler)
+        self.first_update_handler = TypeHandler(Update, self.__record_first_update)
+        self.tg_dispatcher.add_handler(self.first_update_handler, group=1)
+
+# The target of the worker processes started by app.py.
+def run_worker(shard: int, shards: int):
+    UoMCheckinBot(ROLE_WORKER, shard, shards).run()
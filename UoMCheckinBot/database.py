@@ -0,0 +1,181 @@
+from contextlib import contextmanager
+import threading
+import weakref
+import sqlite3
+import logging
+import time
+
+from .metrics import DB_SECONDS
+
+logger = logging.getLogger('checkin-bot')
+
+DEFAULT_LEAD_MINUTES = 10
+
+# Every schema change is one step in this list, a database is migrated by running the steps after its PRAGMA user_version.
+# The first step only creates what is missing, so databases created before the versioning are migrated as well.
+def _migrate_base(cur: sqlite3.Cursor):
+    cur.execute('CREATE TABLE IF NOT EXISTS User (tg_id INTEGER PRIMARY KEY, ical_address TEXT)')
+    cur.execute(f'CREATE TABLE IF NOT EXISTS UserConfig (tg_id INTEGER PRIMARY KEY, stop INTEGER, lead_minutes INTEGER NOT NULL DEFAULT {DEFAULT_LEAD_MINUTES})')
+    cur.execute('CREATE TABLE IF NOT EXISTS Course (course_code TEXT, course_name TEXT, course_type TEXT, start_time TEXT, end_time TEXT, user_id INTEGER)')
+    # the http validators and content hash of every cached ical file, used for incremental refreshing.
+    cur.execute('CREATE TABLE IF NOT EXISTS ICalCache (tg_id INTEGER PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT)')
+    # every parsed session of every user keyed by date, and the content hash each user's index was built from.
+    cur.execute('CREATE TABLE IF NOT EXISTS EventIndex (user_id INTEGER, date TEXT, course_code TEXT, course_name TEXT, course_type TEXT, start_time TEXT, end_time TEXT)')
+    cur.execute('CREATE INDEX IF NOT EXISTS EventIndex_user_date ON EventIndex (user_id, date)')
+    cur.execute('CREATE TABLE IF NOT EXISTS EventIndexState (user_id INTEGER PRIMARY KEY, content_hash TEXT)')
+    # the reminders which have been sent, so they are not sent again after a restart.
+    cur.execute('CREATE TABLE IF NOT EXISTS NotifyLog (user_id INTEGER, start_time TEXT, sent_at TEXT, PRIMARY KEY (user_id, start_time))')
+    columns = [row[1] for row in cur.execute('PRAGMA table_info(UserConfig)')]
+    if 'lead_minutes' not in columns:
+        cur.execute(f'ALTER TABLE UserConfig ADD COLUMN lead_minutes INTEGER NOT NULL DEFAULT {DEFAULT_LEAD_MINUTES}')
+
+def _migrate_course_indexes(cur: sqlite3.Cursor):
+    cur.execute('CREATE INDEX IF NOT EXISTS Course_start_time ON Course (start_time)')
+    cur.execute('CREATE INDEX IF NOT EXISTS Course_user_id ON Course (user_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS NotifyLog_start_time ON NotifyLog (start_time)')
+
+# small key/value state of the bot which has to survive a restart, e.g. the date the Course table was dispatched for.
+def _migrate_dispatch_state(cur: sqlite3.Cursor):
+    cur.execute('CREATE TABLE IF NOT EXISTS DispatchState (key TEXT PRIMARY KEY, value TEXT)')
+
+# when every subscription is to be downloaded again, see refresh_scheduler.
+def _migrate_feed_schedule(cur: sqlite3.Cursor):
+    cur.execute('CREATE TABLE IF NOT EXISTS FeedSchedule (tg_id INTEGER PRIMARY KEY, next_refresh TEXT, failures INTEGER NOT NULL DEFAULT 0, change_rate REAL NOT NULL DEFAULT 0, last_checked TEXT)')
+    cur.execute('CREATE INDEX IF NOT EXISTS FeedSchedule_next_refresh ON FeedSchedule (next_refresh)')
+
+# a session is in the Course table at most once, so it can't be reminded of twice. Duplicates left by the old append-only dispatch are dropped first.
+# The unique index starts with user_id, so it replaces the plain index on it.
+def _migrate_course_unique(cur: sqlite3.Cursor):
+    cur.execute('DELETE FROM Course WHERE rowid NOT IN (SELECT MIN(rowid) FROM Course GROUP BY user_id, start_time, course_code, course_type)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS Course_session ON Course (user_id, start_time, course_code, course_type)')
+    cur.execute('DROP INDEX IF EXISTS Course_user_id')
+
+# the commands the front process passes on to the shard workers, see shards.
+def _migrate_shard_commands(cur: sqlite3.Cursor):
+    cur.execute('CREATE TABLE IF NOT EXISTS ShardCommand (id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL, command TEXT NOT NULL, chat_id INTEGER NOT NULL, payload TEXT, created_at TEXT, claimed_at TEXT)')
+    cur.execute('CREATE INDEX IF NOT EXISTS ShardCommand_shard ON ShardCommand (shard, claimed_at)')
+
+# the dispatched sessions are normalized: a Unit row for every (code, name), a Session row for every (unit, type, start, end) and an Enrolment
+# row for every user attending it, so a lecture of hundreds of students is stored once and fanned out to them by its Enrolment rows.
+# The existing Course rows are moved over, Course is kept as a view of the joined tables for reading. The rows of the hour-based format
+# (see _migrate_iso_session_times) aren't, and the day is dispatched again from the feeds when there were any.
+def _migrate_course_catalogue(cur: sqlite3.Cursor):
+    cur.execute('CREATE TABLE IF NOT EXISTS Unit (id INTEGER PRIMARY KEY, code TEXT NOT NULL, name TEXT NOT NULL, UNIQUE (code, name))')
+    cur.execute('CREATE TABLE IF NOT EXISTS Session (id INTEGER PRIMARY KEY, unit_id INTEGER NOT NULL REFERENCES Unit (id), type TEXT NOT NULL, start_time TEXT NOT NULL, end_time TEXT NOT NULL, '
+                'UNIQUE (unit_id, type, start_time, end_time))')
+    cur.execute('CREATE INDEX IF NOT EXISTS Session_start_time ON Session (start_time)')
+    cur.execute('CREATE TABLE IF NOT EXISTS Enrolment (user_id INTEGER NOT NULL, session_id INTEGER NOT NULL REFERENCES Session (id), PRIMARY KEY (user_id, session_id)) WITHOUT ROWID')
+    cur.execute('CREATE INDEX IF NOT EXISTS Enrolment_session_id ON Enrolment (session_id)')
+    if cur.execute("SELECT type FROM sqlite_master WHERE name='Course'").fetchone() == ('table',):
+        iso_times = "start_time LIKE '____-__-__T%' AND end_time LIKE '____-__-__T%'"
+        cur.execute(f"INSERT OR IGNORE INTO Unit (code, name) SELECT DISTINCT IFNULL(course_code, ''), IFNULL(course_name, '') FROM Course WHERE {iso_times}")
+        cur.execute("INSERT OR IGNORE INTO Session (unit_id, type, start_time, end_time) SELECT DISTINCT Unit.id, IFNULL(course_type, ''), start_time, end_time FROM Course "
+                    f"JOIN Unit ON Unit.code = IFNULL(course_code, '') AND Unit.name = IFNULL(course_name, '') WHERE {iso_times}")
+        cur.execute("INSERT OR IGNORE INTO Enrolment (user_id, session_id) SELECT Course.user_id, Session.id FROM Course "
+                    "JOIN Unit ON Unit.code = IFNULL(course_code, '') AND Unit.name = IFNULL(course_name, '') "
+                    "JOIN Session ON Session.unit_id = Unit.id AND Session.type = IFNULL(course_type, '') AND Session.start_time = Course.start_time AND Session.end_time = Course.end_time "
+                    "WHERE Course.user_id IS NOT NULL")
+        if cur.execute(f'SELECT 1 FROM Course WHERE NOT ({iso_times}) LIMIT 1').fetchone() is not None:
+            cur.execute("DELETE FROM DispatchState WHERE key LIKE 'dispatch_date%'")
+        cur.execute('DROP TABLE Course')
+    cur.execute('CREATE VIEW IF NOT EXISTS Course AS SELECT Unit.code AS course_code, Unit.name AS course_name, Session.type AS course_type, Session.start_time AS start_time, '
+                'Session.end_time AS end_time, Enrolment.user_id AS user_id FROM Enrolment JOIN Session ON Session.id = Enrolment.session_id JOIN Unit ON Unit.id = Session.unit_id')
+
+# start_time and end_time used to be the hour of the day as an integer, they are ISO timestamps since the reminders are scheduled to the minute.
+# Hour-based sessions can't be placed on a day, so they are dropped with their enrolments, and the day is dispatched again from the feeds.
+def _migrate_iso_session_times(cur: sqlite3.Cursor):
+    cur.execute("DELETE FROM Enrolment WHERE session_id IN (SELECT id FROM Session WHERE start_time NOT LIKE '____-__-__T%' OR end_time NOT LIKE '____-__-__T%')")
+    cur.execute("DELETE FROM Session WHERE start_time NOT LIKE '____-__-__T%' OR end_time NOT LIKE '____-__-__T%'")
+    if cur.rowcount:
+        cur.execute("DELETE FROM DispatchState WHERE key LIKE 'dispatch_date%'")
+
+MIGRATIONS = [_migrate_base, _migrate_course_indexes, _migrate_dispatch_state, _migrate_feed_schedule, _migrate_course_unique, _migrate_shard_commands, _migrate_course_catalogue,
+              _migrate_iso_session_times]
+
+# the holder of a thread's connection in the thread-local storage, it is dropped when the thread ends.
+class _ConnectionHolder:
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+def _close_connection(conn: sqlite3.Connection, connections: set, lock: threading.Lock):
+    with lock:
+        connections.discard(conn)
+    conn.close()
+
+# The data-access layer shared by every thread of the bot.
+# Each thread keeps one long-lived connection (so its prepared statements stay cached), the database runs in WAL mode
+# so reads never wait for a writer, and write transactions are serialized in-process instead of fighting over the file lock.
+class Database:
+    def __init__(self, path: str, timeout: float = 30.0, cached_statements: int = 256):
+        self.path = path
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.__local = threading.local()
+        self.__write_lock = threading.RLock()
+        self.__connections = set()
+        self.__connections_lock = threading.Lock()
+        self.migrate()
+
+    # the connection of a short-lived thread is closed when the thread ends, when its thread-local holder is collected.
+    def connection(self) -> sqlite3.Connection:
+        holder = getattr(self.__local, 'holder', None)
+        if holder is None:
+            # isolation_level=None: statements outside a transaction() are autocommitted.
+            # check_same_thread=False only lets close() close the connections of other threads, each connection is still used by one thread.
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, cached_statements=self.cached_statements, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            holder = self.__local.holder = _ConnectionHolder(conn)
+            weakref.finalize(holder, _close_connection, conn, self.__connections, self.__connections_lock)
+            with self.__connections_lock:
+                self.__connections.add(conn)
+        return holder.conn
+
+    # only the statement is timed, rows fetched from the returned cursor afterwards are not.
+    def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        start = time.perf_counter()
+        try:
+            return self.connection().execute(sql, params)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, kind='execute')
+
+    # with db.transaction() as cur: ... commits when the block ends, rolls back if it raises.
+    # The time spent waiting for the write lock and the time a committed transaction holds it are measured separately.
+    @contextmanager
+    def transaction(self):
+        start = time.perf_counter()
+        with self.__write_lock:
+            conn = self.connection()
+            if conn.in_transaction:
+                # nested, the outer transaction commits.
+                yield conn.cursor()
+                return
+            locked = time.perf_counter()
+            DB_SECONDS.observe(locked - start, kind='lock_wait')
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn.cursor()
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            DB_SECONDS.observe(time.perf_counter() - locked, kind='transaction')
+
+    def migrate(self):
+        with self.transaction() as cur:
+            version = cur.execute('PRAGMA user_version').fetchone()[0]
+            for i in range(version, len(MIGRATIONS)):
+                logger.info(f'Migrating database {self.path} to schema version {i + 1}.')
+                MIGRATIONS[i](cur)
+            if version < len(MIGRATIONS):
+                cur.execute(f'PRAGMA user_version={len(MIGRATIONS)}')
+
+    def close(self):
+        with self.__connections_lock:
+            for conn in self.__connections:
+                conn.close()
+            self.__connections.clear()
+        self.__local = threading.local()
@@ -0,0 +1,101 @@
+import tempfile
+import logging
+import time
+import gzip
+import os
+
+from .parse_pool import ical_hash
+
+logger = logging.getLogger('checkin-bot')
+
+# A feed kept in the store, what the parse path is given instead of the content when the feed doesn't have to be downloaded.
+# Plain values only, it's sent to the parse workers.
+class StoredFeed:
+    __slots__ = ('content_hash', 'path')
+
+    def __init__(self, content_hash: str, path: str):
+        self.content_hash = content_hash
+        self.path = path
+
+    # The lines of the feed, decompressed while they are read.
+    def open(self):
+        return gzip.open(self.path, 'rt', encoding='utf-8', newline='')
+
+    def read(self) -> str:
+        with self.open() as f:
+            return f.read()
+
+# Keeps the raw feeds gzipped under the hash of their content, root/<first 2 hex digits>/<hash>.ics.gz.
+# Users are mapped to the content they were last served by ICalCache.content_hash, users with the same feed share one blob
+# and a refresh which gets the same content again writes nothing.
+# Blobs are written to a temporary file next to them and renamed into place, so a blob is either complete or not there at all.
+class FeedStore:
+    def __init__(self, root: str = './ical', level: int = 6):
+        self.root = root
+        self.level = level
+
+    def path(self, content_hash: str) -> str:
+        return os.path.join(self.root, content_hash[:2], content_hash + '.ics.gz')
+
+    def has(self, content_hash: str) -> bool:
+        return bool(content_hash) and os.path.exists(self.path(content_hash))
+
+    def ref(self, content_hash: str) -> StoredFeed:
+        return StoredFeed(content_hash, self.path(content_hash))
+
+    # Returns the hash the content is stored under.
+    def put(self, content: str, content_hash: str = None) -> str:
+        content_hash = content_hash if content_hash else ical_hash(content)
+        path = self.path(content_hash)
+        if os.path.exists(path):
+            # touched, so the garbage collection leaves it alone until its new user is mapped to it.
+            os.utime(path)
+            return content_hash
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=self.level, mtime=0) as f:
+                    f.write(content.encode('utf-8'))
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return content_hash
+
+    def read(self, content_hash: str) -> str:
+        return self.ref(content_hash).read()
+
+    # Removes the blobs whose hash is not in referenced, and the temporary files left by an interrupted write.
+    # min_age: seconds a file has to be unchanged for, so a blob written just before its user's ICalCache row isn't removed in between.
+    # Returns the number of files and bytes removed.
+    def collect_garbage(self, referenced: set, min_age: float = 3600) -> tuple:
+        removed = 0
+        freed = 0
+        cutoff = time.time() - min_age
+        if not os.path.isdir(self.root):
+            return removed, freed
+        for bucket in os.scandir(self.root):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                name = entry.name
+                if name.endswith('.ics.gz') and name[:-len('.ics.gz')] in referenced:
+                    continue
+                if not (name.endswith('.ics.gz') or name.endswith('.tmp')):
+                    continue
+                stat = entry.stat()
+                if stat.st_mtime > cutoff:
+                    continue
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                freed += stat.st_size
+        if removed:
+            logger.info(f'Removed {removed} unreferenced ical blob(s), {freed / 2 ** 20:.1f} MB.')
+        return removed, freed
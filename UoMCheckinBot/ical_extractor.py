@@ -0,0 +1,187 @@
+from collections import namedtuple
+from datetime import datetime, date, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import logging
+
+logger = logging.getLogger('checkin-bot')
+
+# A compact record of one VEVENT, description is the unescaped DESCRIPTION text.
+EventRecord = namedtuple('EventRecord', ['start', 'end', 'description'])
+
+class UnsupportedFeedError(ValueError):
+    pass
+
+_ZONES = {'UTC': timezone.utc}
+
+def _zone(tzid: str):
+    tz = _ZONES.get(tzid)
+    if tz is None:
+        try:
+            tz = ZoneInfo(tzid)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise UnsupportedFeedError(f'Unknown TZID "{tzid}".')
+        _ZONES[tzid] = tz
+    return tz
+
+# lines: the whole ical text, or any iterable of its lines (e.g. an opened file).
+def unfold_lines(lines):
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    current = None
+    for ln in lines:
+        ln = ln.rstrip('\r\n')
+        if ln[:1] in (' ', '\t'):
+            if current is None:
+                raise UnsupportedFeedError('Feed starts with a folded line.')
+            current += ln[1:]
+            continue
+        if current is not None:
+            yield current
+        current = ln
+    if current is not None:
+        yield current
+
+def _split_property(line: str):
+    idx = line.find(':')
+    if idx < 0:
+        raise UnsupportedFeedError(f'Malformed content line: {line[:40]}')
+    head = line[:idx]
+    if '"' in head:
+        # a quoted parameter value may contain ':', look for the first colon outside the quotes.
+        quoted = False
+        for idx, ch in enumerate(line):
+            if ch == '"':
+                quoted = not quoted
+            elif ch == ':' and not quoted:
+                break
+        else:
+            raise UnsupportedFeedError(f'Malformed content line: {line[:40]}')
+        head = line[:idx]
+    parts = head.split(';')
+    params = {}
+    for p in parts[1:]:
+        key, _, val = p.partition('=')
+        params[key.upper()] = val.strip('"')
+    return parts[0].upper(), params, line[idx + 1:]
+
+def _parse_datetime(value: str, params: dict):
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        try:
+            return date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+        except ValueError:
+            raise UnsupportedFeedError(f'Malformed date "{value}".')
+    if len(value) not in (15, 16) or value[8] != 'T':
+        raise UnsupportedFeedError(f'Malformed date-time "{value}".')
+    try:
+        dt = datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[9:11]), int(value[11:13]), int(value[13:15]))
+    except ValueError:
+        raise UnsupportedFeedError(f'Malformed date-time "{value}".')
+    if value.endswith('Z'):
+        return dt.replace(tzinfo=timezone.utc)
+    if 'TZID' in params:
+        return dt.replace(tzinfo=_zone(params['TZID']))
+    return dt
+
+def _unescape(text: str) -> str:
+    if '\\' not in text:
+        return text
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch == '\\' and i + 1 < n:
+            nxt = text[i + 1]
+            out.append('\n' if nxt in 'nN' else nxt)
+            i += 2
+        else:
+            out.append(ch)
+            i += 1
+    return ''.join(out)
+
+# Scans the raw ical text line by line and yields the VEVENTs starting within [date_from, date_to] (both inclusive, either can be None)
+# as soon as each one ends, without building the icalendar object tree. All-day events are skipped as they are never a session.
+# Raises UnsupportedFeedError for anything it can't handle, use read_events to fall back to icalendar in that case.
+def iter_events(lines, date_from: date = None, date_to: date = None):
+    in_event = False
+    depth = 0
+    start = end = desc = None
+    for ln in unfold_lines(lines):
+        if ln[:6] == 'BEGIN:':
+            if in_event:
+                # sub components such as VALARM.
+                depth += 1
+            elif ln[6:] == 'VEVENT':
+                in_event = True
+                start = end = desc = None
+            continue
+        if not in_event:
+            continue
+        if ln[:4] == 'END:':
+            if depth > 0:
+                depth -= 1
+                continue
+            if ln[4:] != 'VEVENT':
+                raise UnsupportedFeedError(f'Unexpected "{ln}" inside a VEVENT.')
+            in_event = False
+            if start is None:
+                raise UnsupportedFeedError('VEVENT without DTSTART.')
+            if not isinstance(start, datetime):
+                continue
+            day = start.date()
+            if (date_from and day < date_from) or (date_to and day > date_to):
+                continue
+            yield EventRecord(start, end if end is not None else start, _unescape(desc) if desc else '')
+            continue
+        if depth > 0:
+            continue
+        head = ln[:7]
+        if head == 'DTSTART' or head[:5] == 'DTEND' or ln[:11] == 'DESCRIPTION':
+            name, params, value = _split_property(ln)
+            if name == 'DTSTART':
+                start = _parse_datetime(value, params)
+            elif name == 'DTEND':
+                end = _parse_datetime(value, params)
+            elif name == 'DESCRIPTION':
+                desc = value
+    if in_event:
+        raise UnsupportedFeedError('Unterminated VEVENT.')
+
+def extract_events(lines, date_from: date = None, date_to: date = None) -> list:
+    return list(iter_events(lines, date_from, date_to))
+
+# The slow path, builds the full icalendar tree and walks it, produces the same records as extract_events.
+def extract_events_icalendar(content: str, date_from: date = None, date_to: date = None) -> list:
+    from icalendar import Calendar
+    events = []
+    cal = Calendar.from_ical(content)
+    for event in cal.walk('VEVENT'):
+        if 'DTSTART' not in event:
+            continue
+        start = event['DTSTART'].dt
+        if not isinstance(start, datetime):
+            continue
+        day = start.date()
+        if (date_from and day < date_from) or (date_to and day > date_to):
+            continue
+        end = event['DTEND'].dt if 'DTEND' in event else start
+        events.append(EventRecord(start, end, str(event.get('DESCRIPTION', ''))))
+    return events
+
+def read_events(content: str, date_from: date = None, date_to: date = None) -> list:
+    try:
+        return extract_events(content, date_from, date_to)
+    except UnsupportedFeedError as e:
+        logger.info(f'Falling back to icalendar for a feed the streaming extractor can\'t handle: {e}')
+        return extract_events_icalendar(content, date_from, date_to)
+
+# Splits a UoM event description ("Unit Code: COMP10120" per line) into a dict.
+def parse_description(desc: str) -> dict:
+    infos = {}
+    for ln in desc.splitlines():
+        if ln == '':
+            continue
+        parts = ln.split(':')
+        if len(parts) == 2:
+            infos[parts[0]] = parts[1].strip()
+    return infos
@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import FETCH_SECONDS
+
+logger = logging.getLogger('checkin-bot')
+
+DEFAULT_MAX_WORKERS = 16
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+
+class FetchResult:
+    def __init__(self, url: str, status: int = 0, text: str = '', error: str = '', etag: str = None, last_modified: str = None):
+        self.url = url
+        self.status = status
+        self.text = text
+        self.error = error
+        self.etag = etag
+        self.last_modified = last_modified
+        # only set by ICalFetcher.stream, the lines of the feed as they arrive.
+        self.lines = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200 and not self.error
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status == 304
+
+class ICalFetcher:
+    # max_workers: how many feeds are downloaded at the same time.
+    # timeout: (connect, read) timeout in seconds for every single request, so one slow timetable server response cannot stall the others.
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, timeout: tuple = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)):
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.__local = threading.local()
+        self.__pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ical-fetch')
+
+    # requests.Session is not guaranteed to be thread safe, so every worker thread keeps its own session,
+    # which still reuses keep-alive connections to timetables.manchester.ac.uk across the feeds it downloads.
+    def __session(self) -> requests.Session:
+        session = getattr(self.__local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.__local.session = session
+        return session
+
+    # etag, last_modified: validators from the previous download of this url, when given the request is a conditional GET
+    # and an unchanged feed comes back as a 304 result without any content.
+    def fetch(self, url: str, etag: str = None, last_modified: str = None) -> FetchResult:
+        start = time.perf_counter()
+        result = self.__get(url, etag, last_modified)
+        FETCH_SECONDS.observe(time.perf_counter() - start, status=result.status if result.status else 'error')
+        return result
+
+    def __get(self, url: str, etag: str, last_modified: str) -> FetchResult:
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        try:
+            response = self.__session().get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            return FetchResult(url, error=str(e))
+        if response.status_code == 304:
+            return FetchResult(url, status=304, etag=response.headers.get('ETag', etag), last_modified=response.headers.get('Last-Modified', last_modified))
+        if not response.ok:
+            return FetchResult(url, status=response.status_code, error=f'HTTP {response.status_code}')
+        return FetchResult(url, status=response.status_code, text=response.text, etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+
+    # with fetcher.stream(url) as result: ... result.lines iterates over the lines of the feed while it's being downloaded,
+    # so a caller which only needs the start of the feed can stop early. The connection is closed when the block ends.
+    # A network error in the middle of the feed ends result.lines and is put into result.error.
+    @contextmanager
+    def stream(self, url: str, chunk_size: int = 8192):
+        try:
+            response = self.__session().get(url, timeout=self.timeout, stream=True)
+        except requests.RequestException as e:
+            yield FetchResult(url, error=str(e))
+            return
+        try:
+            if not response.ok:
+                yield FetchResult(url, status=response.status_code, error=f'HTTP {response.status_code}')
+                return
+            result = FetchResult(url, status=response.status_code, etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+            response.encoding = response.encoding or 'utf-8'
+            result.lines = self.__iter_lines(result, response.iter_content(chunk_size, decode_unicode=True))
+            yield result
+        finally:
+            response.close()
+
+    # response.iter_lines can split a CRLF across two chunks into an extra empty line, which would break line unfolding.
+    def __iter_lines(self, result: FetchResult, chunks):
+        pending = ''
+        try:
+            for chunk in chunks:
+                pending += chunk
+                lines = pending.split('\n')
+                pending = lines.pop()
+                for ln in lines:
+                    yield ln.rstrip('\r')
+        except requests.RequestException as e:
+            result.error = str(e)
+            return
+        if pending:
+            yield pending.rstrip('\r')
+
+    # urls: a dict maps any key (usually the user's chat id) to the ical address.
+    # validators: optional, a dict maps the same keys to their (etag, last_modified) pair.
+    # returns a dict maps the same keys to their FetchResult.
+    def fetch_all(self, urls: dict, validators: dict = None) -> dict:
+        return self.collect(self.submit_all(urls, validators))
+
+    # The same as fetch_all but returns at once, while the feeds are being downloaded. collect() waits for them and returns the results.
+    def submit_all(self, urls: dict, validators: dict = None) -> dict:
+        validators = validators if validators else {}
+        return {key: self.__pool.submit(self.fetch, urls[key], *validators.get(key, (None, None))) for key in urls}
+
+    def collect(self, pending: dict) -> dict:
+        return {key: pending[key].result() for key in pending}
+
+    def close(self):
+        self.__pool.shutdown(wait=True)
@@ -0,0 +1,267 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from contextlib import contextmanager
+import threading
+import cProfile
+import logging
+import bisect
+import pstats
+import time
+import io
+import os
+
+logger = logging.getLogger('checkin-bot')
+
+# In-process counters, gauges and histograms of the hot paths, rendered in the Prometheus text format.
+# Labels are passed as keyword arguments, e.g. FETCH_SECONDS.observe(0.2, status='304').
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in pairs) + '}'
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self.__lock:
+            return self.__values.get(_label_key(labels), 0)
+
+    def samples(self) -> list:
+        with self.__lock:
+            return [(self.name + _format_labels(key), value) for key, value in self.__values.items()]
+
+    def summary(self) -> str:
+        with self.__lock:
+            return ' '.join(f'{self.name}{_format_labels(key)}={value:g}' for key, value in self.__values.items())
+
+class Gauge:
+    type = 'gauge'
+
+    # fn: when given, the value is read from it every time the gauge is collected.
+    def __init__(self, name: str, help: str, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.__value = 0
+
+    def set(self, value: float):
+        self.__value = value
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def value(self) -> float:
+        if self.fn:
+            try:
+                return self.fn()
+            except Exception:
+                logger.exception(f'Failed to collect gauge {self.name}.')
+                return float('nan')
+        return self.__value
+
+    def samples(self) -> list:
+        return [(self.name, self.value())]
+
+    def summary(self) -> str:
+        return f'{self.name}={self.value():g}'
+
+class Histogram:
+    type = 'histogram'
+
+    # buckets: the upper bounds of the buckets in increasing order, +Inf is added.
+    def __init__(self, name: str, help: str, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.__series = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            series = self.__series.get(key)
+            if series is None:
+                # [count per bucket, sum, count, max]
+                series = [[0] * len(self.buckets), 0.0, 0, value]
+                self.__series[key] = series
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+            if value > series[3]:
+                series[3] = value
+
+    # with HISTOGRAM.time(): ... observes the seconds the block takes.
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self.__lock:
+            series = self.__series.get(_label_key(labels))
+            return series[2] if series else 0
+
+    def samples(self) -> list:
+        out = []
+        with self.__lock:
+            for key, (counts, total, count, _) in self.__series.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    out.append((self.name + '_bucket' + _format_labels(key, (('le', _format_value(bound)),)), cumulative))
+                out.append((self.name + '_sum' + _format_labels(key), total))
+                out.append((self.name + '_count' + _format_labels(key), count))
+        return out
+
+    def summary(self) -> str:
+        with self.__lock:
+            return ' '.join(f'{self.name}{_format_labels(key)}=(n={count} avg={total / count:.4g} max={peak:.4g})'
+                            for key, (_, total, count, peak) in self.__series.items() if count)
+
+class Registry:
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def __add(self, metric):
+        with self.__lock:
+            if metric.name in self.__metrics:
+                raise ValueError(f'Metric {metric.name} is already registered.')
+            self.__metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.__add(Counter(name, help))
+
+    def gauge(self, name: str, help: str, fn=None) -> Gauge:
+        return self.__add(Gauge(name, help, fn))
+
+    def histogram(self, name: str, help: str, buckets: tuple) -> Histogram:
+        return self.__add(Histogram(name, help, buckets))
+
+    def metrics(self) -> list:
+        with self.__lock:
+            return list(self.__metrics.values())
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, value in metric.samples():
+                lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    # One line of every metric which has been touched, for the periodic dump into the log.
+    def summary(self) -> str:
+        return ' '.join(s for s in (metric.summary() for metric in self.metrics()) if s)
+
+REGISTRY = Registry()
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+FETCH_SECONDS = REGISTRY.histogram('checkin_ical_fetch_seconds', 'Time to fetch one ical feed, by result.', LATENCY_BUCKETS)
+PARSE_SECONDS = REGISTRY.histogram('checkin_ical_parse_seconds', 'Time to parse and index one ical feed.', LATENCY_BUCKETS)
+EVENTS_PER_FEED = REGISTRY.histogram('checkin_ical_events_per_feed', 'Events parsed from one ical feed.', (0, 50, 100, 200, 400, 800, 1600))
+EVENTS_DISPATCHED = REGISTRY.histogram('checkin_events_dispatched_per_user', 'Sessions dispatched for one user on one day.', (0, 1, 2, 3, 4, 6, 8, 12))
+DB_SECONDS = REGISTRY.histogram('checkin_db_seconds', 'Time of the database statements and write transactions, by kind.', DB_BUCKETS)
+SEND_QUEUE_DEPTH = REGISTRY.gauge('checkin_send_queue_depth', 'Messages queued or being sent.')
+SEND_MESSAGES = REGISTRY.counter('checkin_send_messages_total', 'Outbound messages, by result.')
+REMINDER_LEAD = REGISTRY.histogram('checkin_reminder_seconds_before_start', 'Seconds between a reminder being delivered and its session start, 0 or less is late.',
+                                   (0, 60, 120, 300, 480, 600, 900, 1800, 3600))
+TIMER_DRIFT = REGISTRY.histogram('checkin_timer_drift_seconds', 'Seconds a timer of the scheduler fired after its due time.', (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 30.0, 60.0, 300.0))
+STARTUP_POLLING_SECONDS = REGISTRY.gauge('checkin_startup_polling_seconds', 'Seconds from the process start until the bot started polling for updates.')
+STARTUP_FIRST_UPDATE_SECONDS = REGISTRY.gauge('checkin_startup_first_update_seconds', 'Seconds from the process start until the first update was handled.')
+WEBHOOK_UPDATES = REGISTRY.counter('checkin_webhook_updates_total', 'Requests posted to the webhook, by result.')
+UPDATE_SECONDS = REGISTRY.histogram('checkin_update_seconds', 'Time the handlers took for one update received on the webhook.', LATENCY_BUCKETS)
+DISPATCH_SECONDS = REGISTRY.histogram('checkin_daily_dispatch_seconds', 'Time of the daily refresh and dispatch.', (1, 5, 10, 30, 60, 120, 300, 600, 1800))
+
+_IMPORTED_AT = time.monotonic()
+
+# Seconds since this process was started, read from /proc on Linux, elsewhere the time since this module was imported.
+def process_uptime() -> float:
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        # the command name may contain spaces, the fields are counted from its closing parenthesis, starttime is the 22nd field.
+        start_ticks = int(stat[stat.rindex(')') + 2:].split()[19])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _IMPORTED_AT
+
+class MetricsServer:
+    def __init__(self, port: int, host: str = '0.0.0.0', registry: Registry = REGISTRY):
+        self.registry = registry
+        self.__server = ThreadingHTTPServer((host, port), self.__make_handler())
+        self.__server.daemon_threads = True
+        self.port = self.__server.server_address[1]
+
+    def __make_handler(self):
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
+
+    def start(self):
+        threading.Thread(target=self.__server.serve_forever, name='metrics-server', daemon=True).start()
+        logger.info(f'Serving metrics on port {self.port}.')
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+# with profiled('logs/dispatch.prof'): ... dumps the cProfile stats of the block to path and logs the top entries.
+@contextmanager
+def profiled(path: str, top: int = 20):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+        logger.info(f'Profile written to {path}:\n{out.getvalue()}')
@@ -1,38 +1,60 @@
-from datetime import datetime
-from distutils.log import info
+from datetime import datetime, timedelta, timezone
 import sqlite3
-from icalendar import Calendar
-import requests
 import logging
 import os
 import logging
+import threading
+import sys
+
+from .database import Database, DEFAULT_LEAD_MINUTES
+from .ical_fetcher import ICalFetcher
+from .parse_pool import ParsePool, ical_hash
+from .notify_scheduler import SystemClock
+from .refresh_scheduler import RefreshScheduler, CHANGED, UNCHANGED, FAILED
+from .shards import shard_of
+from .feed_store import FeedStore
+from .metrics import PARSE_SECONDS, EVENTS_PER_FEED, EVENTS_DISPATCHED
 
 logger = logging.getLogger('checkin-bot')
 
+REFRESH_BATCH_SIZE = 256
+
+# The format of every time stored in the Session and NotifyLog tables, so they can be compared as strings. Floating times are taken as local time.
+def utc_iso(time: datetime) -> str:
+    return time.astimezone(timezone.utc).isoformat()
+
+# The local midnights starting and ending the day of the time, the next one is looked up again so a day with a DST change isn't off by an hour.
+def local_day_bounds(time: datetime) -> tuple:
+    day_start = time.astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+    return day_start, datetime.combine(day_start.date() + timedelta(days=1), datetime.min.time()).astimezone()
+
+# The per-user objects are slotted, the bot keeps one of each for every subscriber and a Course for every session of the day.
 class UserConfig:
+    __slots__ = ('stop', 'lead_minutes')
+
     def __init__(self, **kwargs) -> None:
         self.stop = False
+        self.lead_minutes = DEFAULT_LEAD_MINUTES
         for key in kwargs:
             try:
                 setattr(self, key, kwargs[key])
             except AttributeError:
                 continue
         
+# The feed itself is never kept here, it's read from the feed store when it has to be parsed.
 class User:
+    __slots__ = ('tg_id', 'subscription', 'config')
+
     def __init__(self, tg_id: int, ical_address: str, config: UserConfig):
         self.tg_id = tg_id
         self.subscription = ical_address
         self.config = config
-        self.calendar = None
-        self.ical_content = ''
-        pass
-
-    def release_calendar(self):
-        self.calendar = None
-        self.ical_content = ''
 
+# The strings of a session are interned and its times parsed once, the Courses of everyone attending it share them.
 class Course:
-    def __init__(self, course_code: str, course_name: str, course_type: str, start_time: int, end_time: int, user_id: int):
+    __slots__ = ('code', 'name', 'type', 'start', 'end', 'user_id')
+
+    def __init__(self, course_code: str, course_name: str, course_type: str, start_time: datetime, end_time: datetime, user_id: int):
         self.code = course_code
         self.name = course_name
         self.type = course_type
@@ -41,240 +63,587 @@ class Course:
         self.user_id = user_id
         pass
 
+# Today's courses which haven't been notified yet, bucketed by the time their reminders are due (session start minus the user's lead time).
+# Stopped users are kept out of the buckets, so whatever is popped from a bucket is to be sent.
+class DueIndex:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__buckets = {}
+        self.__courses = {}
+        self.__leads = {}
+
+    def __unbucket(self, user_id: int):
+        lead = self.__leads.pop(user_id, None)
+        if lead is None:
+            return
+        for course in self.__courses.get(user_id, []):
+            when = course.start - timedelta(minutes=lead)
+            bucket = self.__buckets.get(when)
+            if bucket:
+                bucket.pop(user_id, None)
+                if not bucket:
+                    del self.__buckets[when]
+
+    def __bucket(self, user_id: int, lead: int):
+        self.__leads[user_id] = lead
+        for course in self.__courses.get(user_id, []):
+            self.__buckets.setdefault(course.start - timedelta(minutes=lead), {}).setdefault(user_id, []).append(course)
+
+    def set_user_courses(self, user_id: int, courses: list, lead: int, stopped: bool):
+        with self.__lock:
+            self.__unbucket(user_id)
+            self.__courses[user_id] = list(courses)
+            if not stopped:
+                self.__bucket(user_id, lead)
+
+    def stop_user(self, user_id: int):
+        with self.__lock:
+            self.__unbucket(user_id)
+
+    # also used when the user's lead time changes.
+    def resume_user(self, user_id: int, lead: int):
+        with self.__lock:
+            self.__unbucket(user_id)
+            self.__bucket(user_id, lead)
+
+    def has_user(self, user_id: int) -> bool:
+        with self.__lock:
+            return user_id in self.__courses
+
+    def clear(self):
+        with self.__lock:
+            self.__buckets.clear()
+            self.__courses.clear()
+            self.__leads.clear()
+
+    # The due times of the given users' buckets, or of every bucket when user_ids is None.
+    def due_times(self, user_ids=None) -> list:
+        with self.__lock:
+            if user_ids is None:
+                return sorted(self.__buckets)
+            times = set()
+            for user_id in user_ids:
+                lead = self.__leads.get(user_id)
+                if lead is not None:
+                    times.update(course.start - timedelta(minutes=lead) for course in self.__courses.get(user_id, []))
+            return sorted(times)
+
+    def pop_due(self, when: datetime) -> list:
+        with self.__lock:
+            bucket = self.__buckets.pop(when, None)
+            if not bucket:
+                return []
+            due = []
+            for user_id in bucket:
+                remaining = self.__courses.get(user_id, [])
+                for course in bucket[user_id]:
+                    remaining.remove(course)
+                    due.append(course)
+            return due
+
 class NotifyDispatcher:
-    def __init__(self, database):
-        self.db = database
+    # database: a Database or the path of the sqlite database file.
+    # clock: where "now" and "today" come from, see notify_scheduler.
+    # parse_pool: parses the feeds of a refresh, in-process when not given.
+    # batch_size: how many feeds a refresh downloads and parses before moving on, which bounds the feed contents held in memory.
+    # refresh_scheduler: decides which feeds load_due_calendars downloads, one on this database and clock when not given.
+    # shard: (index, count), only the users of that shard are loaded and dispatched, see shards. Every user when not given.
+    # feed_store: where the raw feeds are kept, ./ical when not given.
+    def __init__(self, database, fetcher: ICalFetcher = None, clock=None, parse_pool: ParsePool = None, batch_size: int = REFRESH_BATCH_SIZE,
+                 refresh_scheduler: RefreshScheduler = None, shard: tuple = None, feed_store: FeedStore = None):
+        self.db = database if isinstance(database, Database) else Database(database)
         self.users = {}
+        self.fetcher = fetcher if fetcher else ICalFetcher()
+        self.clock = clock if clock else SystemClock()
+        self.parse_pool = parse_pool if parse_pool else ParsePool()
+        self.batch_size = max(1, batch_size)
+        self.refresh_scheduler = refresh_scheduler if refresh_scheduler else RefreshScheduler(self.db, self.clock)
+        self.store = feed_store if feed_store else FeedStore()
+        self.shard = shard
+        # every shard keeps the date it has dispatched for itself.
+        self.dispatch_state_key = f'dispatch_date:{shard[0]}/{shard[1]}' if shard else 'dispatch_date'
+        self.dispatch_date = None
+        self.refresh_report = {'unchanged': 0, 'changed': 0, 'failed': 0}
+        self.changed_users = set()
+        self.dispatch_listeners = []
+        # the in-memory copy of today's sessions which are still to be notified, the database is only written through.
+        self.due_index = DueIndex()
+        # the ids of the Unit rows by (code, name) and of today's Session rows by (code, name, type, start, end).
+        self.__unit_ids = {}
+        self.__session_ids = {}
+        self.__catalogue_lock = threading.Lock()
+        self.__import_legacy_icals()
         pass
 
+    # The feeds cached by earlier versions as ./ical/<user id>.ics are moved into the feed store once, found by their file names since
+    # the oldest versions didn't keep an ICalCache row. The files of users who are gone are removed. Every process of a sharded
+    # deployment runs this when it starts, a file another process has already moved is skipped.
+    def __import_legacy_icals(self):
+        if not os.path.isdir(self.store.root):
+            return
+        users = set(row[0] for row in self.db.execute('SELECT tg_id FROM User').fetchall())
+        rows = []
+        paths = []
+        for name in os.listdir(self.store.root):
+            if not name.endswith('.ics'):
+                continue
+            try:
+                tg_id = int(name[:-len('.ics')])
+            except ValueError:
+                continue
+            path = os.path.join(self.store.root, name)
+            if tg_id in users:
+                try:
+                    with open(path, 'r', newline='') as ical_file:
+                        content = ical_file.read()
+                except FileNotFoundError:
+                    continue
+                rows.append((self.store.put(content), tg_id))
+            paths.append(path)
+        if rows:
+            with self.db.transaction() as cur:
+                cur.executemany('UPDATE ICalCache SET content_hash=? WHERE tg_id=?', rows)
+                # no validators, the feed is downloaded unconditionally the next time.
+                cur.executemany('INSERT OR IGNORE INTO ICalCache (tg_id, content_hash) VALUES (?, ?)', [(row[1], row[0]) for row in rows])
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+        if paths:
+            logger.info(f'Moved {len(rows)} cached ical file(s) into the feed store, removed {len(paths) - len(rows)} of unknown users.')
+
+    def __save_ical_cache(self, rows: list):
+        # rows: list of (tg_id, etag, last_modified, content_hash)
+        if not rows:
+            return
+        with self.db.transaction() as cur:
+            cur.executemany('INSERT OR REPLACE INTO ICalCache VALUES (?, ?, ?, ?)', rows)
+
+    # contents: a dict maps user ids to their raw ical content.
+    # Parses every event of the feeds and replaces the users' rows in EventIndex, those users are dispatched again by the next dispatchAll.
+    # The feeds are parsed by the parse pool, each user's rows are written as soon as they come back. A feed which can't be parsed keeps its old index.
+    def __index_calendars(self, contents: dict):
+        if not contents:
+            return
+        for feed in self.parse_pool.parse(contents):
+            tg_id = feed.tg_id
+            if feed.error:
+                logger.error(f'Cannot parse the calendar of user {tg_id}: {feed.error}')
+                continue
+            PARSE_SECONDS.observe(feed.seconds)
+            EVENTS_PER_FEED.observe(len(feed.rows))
+            for key in feed.missing:
+                logger.error(f'Cannot find "{key}" in calendar info of user {tg_id}. Please check if there is any change on calendar format.')
+            # one short transaction per user, so the index rebuild never holds the write lock for long.
+            with self.db.transaction() as cur:
+                cur.execute('DELETE FROM EventIndex WHERE user_id=?', [tg_id])
+                cur.executemany('INSERT INTO EventIndex VALUES (?, ?, ?, ?, ?, ?, ?)', [(tg_id,) + row for row in feed.rows])
+                cur.execute('INSERT OR REPLACE INTO EventIndexState VALUES (?, ?)', [tg_id, feed.content_hash])
+            self.changed_users.add(tg_id)
+
+    def is_user_indexed(self, tg_id: int) -> bool:
+        res = self.db.execute('SELECT 1 FROM EventIndexState WHERE user_id=?', [tg_id]).fetchone()
+        return res is not None
+
+    # Only registers the user, the feed is loaded by load_and_dispatch_user.
     def add_user(self, user: User):
         if (user.tg_id in self.users):
             return False
 
         self.users[user.tg_id] = user
-        if user.calendar:
-            ical_file = open(f'./ical/{user.tg_id}.ics', 'w')
-            ical_file.write(user.ical_content)
-            ical_file.close()
-            self.dispatchForUser(user.tg_id)
-        conn = sqlite3.connect(self.db)
-        if conn:
-            cur = conn.cursor()
-            cur.execute('INSERT INTO User VALUES (?, ?)', (user.tg_id, user.subscription))
-            cur.execute('INSERT INTO UserConfig VALUES (?, ?)', (user.tg_id, user.config.stop))
-            conn.commit()
-            conn.close()
+        try:
+            with self.db.transaction() as cur:
+                cur.execute('INSERT INTO User VALUES (?, ?)', (user.tg_id, user.subscription))
+                cur.execute('INSERT INTO UserConfig (tg_id, stop, lead_minutes) VALUES (?, ?, ?)', (user.tg_id, user.config.stop, user.config.lead_minutes))
             return True
-        else:
+        except sqlite3.Error as e:
+            logger.error(f'Database error when adding user {user.tg_id}: {e}')
             return False
 
     def is_user_exists(self, tg_id: int) -> bool:
         return (tg_id in self.users)
 
+    # Looks the user up in the database, for the front process of the sharded deployment which doesn't load any user.
+    def is_user_stored(self, tg_id: int) -> bool:
+        res = self.db.execute('SELECT 1 FROM User WHERE tg_id=?', [tg_id]).fetchone()
+        return res is not None
+
     def is_user_stop_notify(self, tg_id: int) -> bool:
         return self.users[tg_id].config.stop
 
     def set_user_stop(self, tg_id: int):
         if self.is_user_exists(tg_id):
-            conn = sqlite3.connect(self.db)
-            if conn:
+            try:
+                with self.db.transaction() as cur:
+                    cur.execute("UPDATE UserConfig SET stop = 1 WHERE tg_id = ?", [tg_id])
                 self.users[tg_id].config.stop = True
-                cur = conn.cursor()
-                cur.execute("UPDATE UserConfig SET stop = 1 WHERE tg_id = ?", [tg_id])
-                conn.commit()
-                conn.close()
+                self.due_index.stop_user(tg_id)
                 return True
-            else:
-                logger.error('Database connection failed when setting user config "stop" to true.')
+            except sqlite3.Error as e:
+                logger.error(f'Database error when setting user config "stop" to true: {e}')
         return False
 
     def set_user_resume(self, tg_id: int):
         if self.is_user_exists(tg_id):
-            conn = sqlite3.connect(self.db)
-            if conn:
+            try:
+                with self.db.transaction() as cur:
+                    cur.execute("UPDATE UserConfig SET stop=0 WHERE tg_id=?", [tg_id])
                 self.users[tg_id].config.stop = False
-                cur = conn.cursor()
-                cur.execute("UPDATE UserConfig SET stop=0 WHERE tg_id=?", [tg_id])
-                conn.commit()
-                res = cur.execute("SELECT * FROM Course WHERE user_id=?", [tg_id])
-                if len(res.fetchall()) == 0:
-                    conn.close()
-                    self.load_user_calendar(self.users[tg_id])
+                if self.due_index.has_user(tg_id):
+                    self.due_index.resume_user(tg_id, self.users[tg_id].config.lead_minutes)
+                    self.__notify_dispatched([tg_id])
+                else:
+                    # the index of a stopped user is not refreshed, but it's good enough until the next refresh.
+                    if not self.is_user_indexed(tg_id):
+                        self.load_user_calendar(self.users[tg_id])
                     self.dispatchForUser(tg_id)
                 return True
-            else:
-                logger.error('Database connection failed when setting user config "stop" to false.')
+            except sqlite3.Error as e:
+                logger.error(f'Database error when setting user config "stop" to false: {e}')
         return False
 
-    def update_user_subscription(self, tg_id: int, new_sub: str):
+    def set_user_lead_time(self, tg_id: int, minutes: int):
         if self.is_user_exists(tg_id):
-            conn = sqlite3.connect(self.db)
-            if conn:
-                self.users[tg_id].config.stop = False
-                cur = conn.cursor()
-                cur.execute("UPDATE User SET subscription=? WHERE tg_id=?", [new_sub, tg_id])
-                cur.execute("DELETE FROM Course WHERE user_id=?", [tg_id])
-                conn.commit()
-                conn.close()
-                self.load_user_calendar(self.users[tg_id])
-                self.dispatchForUser(tg_id)
+            try:
+                with self.db.transaction() as cur:
+                    cur.execute("UPDATE UserConfig SET lead_minutes=? WHERE tg_id=?", [minutes, tg_id])
+                self.users[tg_id].config.lead_minutes = minutes
+                if not self.users[tg_id].config.stop:
+                    self.due_index.resume_user(tg_id, minutes)
+                self.__notify_dispatched([tg_id])
                 return True
-            else:
-                logger.error('Database connection failed when updating user ical subscription.')
+            except sqlite3.Error as e:
+                logger.error(f'Database error when setting user config "lead_minutes": {e}')
+        return False
+
+    # load: when false the new feed is left to load_and_dispatch_user, so the caller can do the slow part elsewhere.
+    # The cached validators belong to the old address, they are dropped so the new one is downloaded unconditionally.
+    # The old feed's index and reminders go too, nothing of the old timetable is dispatched again even when the new feed fails to load.
+    def update_user_subscription(self, tg_id: int, new_sub: str, load: bool = True):
+        if self.is_user_exists(tg_id):
+            try:
+                with self.db.transaction() as cur:
+                    cur.execute("UPDATE User SET ical_address=? WHERE tg_id=?", [new_sub, tg_id])
+                    cur.execute("UPDATE UserConfig SET stop=0 WHERE tg_id=?", [tg_id])
+                    cur.execute("DELETE FROM Enrolment WHERE user_id=?", [tg_id])
+                    cur.execute("DELETE FROM ICalCache WHERE tg_id=?", [tg_id])
+                    cur.execute("DELETE FROM EventIndex WHERE user_id=?", [tg_id])
+                    cur.execute("DELETE FROM EventIndexState WHERE user_id=?", [tg_id])
+            except sqlite3.Error as e:
+                logger.error(f'Database error when updating user ical subscription: {e}')
+                return False
+            self.users[tg_id].config.stop = False
+            self.users[tg_id].subscription = new_sub
+            self.due_index.set_user_courses(tg_id, [], self.users[tg_id].config.lead_minutes, False)
+            # a new feed, nothing learned about the old one applies.
+            self.refresh_scheduler.forget(tg_id)
+            if load:
+                self.load_and_dispatch_user(tg_id)
+            return True
         return False
 
+    # Downloads, indexes and dispatches the user's feed, returns whether the download succeeded.
+    def load_and_dispatch_user(self, tg_id: int) -> bool:
+        loaded = self.load_user_calendar(self.users[tg_id])
+        self.dispatchForUser(tg_id)
+        return loaded
+
     def load_user_calendar(self, user: User):
-        ical_path = f'./ical/{user.tg_id}.ics'
-        response = requests.get(user.subscription)
+        response = self.fetcher.fetch(user.subscription)
         if response.ok:
-            ical_file = open(ical_path, 'w')
-            ical_file.write(response.text)
-            ical_file.close()
-            cal = Calendar.from_ical(response.text)
-            user.calendar = cal
+            content_hash = self.store.put(response.text)
+            self.__save_ical_cache([(user.tg_id, response.etag, response.last_modified, content_hash)])
+            self.__index_calendars({user.tg_id: response.text})
+            self.refresh_scheduler.record({user.tg_id: CHANGED})
             return True
         else:
-            logger.warning('ical file download failed for: ' + user.subscription + ' , user chat id: '+ user.tg_id)
+            logger.warning(f'ical file download failed for: {user.subscription} , user chat id: {user.tg_id} ({response.error})')
+            self.refresh_scheduler.record({user.tg_id: FAILED})
             return False
 
+    def load_users(self) -> bool:
+        try:
+            cur = self.db.execute('SELECT tg_id, ical_address, stop, lead_minutes from `User` NATURAL JOIN `UserConfig`')
+        except sqlite3.Error as e:
+            logger.error(f'Database error when loading users: {e}')
+            return False
+        for row in cur.fetchall():
+            if self.shard and shard_of(row[0], self.shard[1]) != self.shard[0]:
+                continue
+            self.users[row[0]] = User(row[0], row[1], UserConfig(stop=bool(row[2]), lead_minutes=row[3]))
+        return True
+
     # @params
     # fetch_local: when true, this function will tries to fetch from cached local ical files first, if there's any missing ical files, it will still downlaod it from subscription. Otherwise it will download every ical file from subscription and update the whole cached ical file data.
-    # force_user_local: only works when fetch_local is true, if it toggles, function will only use local ical files and not going to download any missing ical files. This is only used as a fallback option.
-
+    # force_user_local: only works when fetch_local is true, if it toggles, function will only use local ical files and not going to download any missing ical files, users without one are skipped.
+    # Downloads are conditional GETs, feeds which are not modified or have the same content hash as the cached file are neither rewritten nor re-parsed.
+    # Only the feeds whose content differs from what their EventIndex was built from are parsed and indexed. The counts are kept in self.refresh_report.
+    # A feed which fails to download falls back to its own cached file, the other feeds keep what they have downloaded.
     def load_all_users_calendars(self, fetch_local: bool, force_use_local: bool=False) -> bool:
-        conn = sqlite3.connect(self.db)
-        if not conn:
+        if not self.load_users():
             return False
-        icals = {}
-        cur = conn.cursor()
-        cur = cur.execute('SELECT tg_id, ical_address, stop from `User` NATURAL JOIN `UserConfig`')
-        i = 0
-        for row in cur.fetchall():
-            self.users[row[0]] = User(row[0], row[1], UserConfig(stop=bool(row[2])))
-            i += 1
+        self.__refresh_calendars([user_id for user_id in self.users if not self.users[user_id].config.stop], fetch_local, force_use_local)
+        return True
 
-        conn.close()
+    # Downloads only the feeds the refresh scheduler says are due, the rest keep their index until their turn.
+    def load_due_calendars(self) -> bool:
+        active = [user_id for user_id in self.users if not self.users[user_id].config.stop]
+        cached = set(row[0] for row in self.db.execute('SELECT tg_id, content_hash FROM ICalCache').fetchall() if self.store.has(row[1]))
+        due = self.refresh_scheduler.due(active, cached)
+        if due:
+            self.__refresh_calendars(due, fetch_local=False)
+        return True
 
-        has_failed = False
-        for user_id in self.users:
+    def __refresh_calendars(self, user_ids: list, fetch_local: bool, force_use_local: bool = False):
+        local = []
+        downloads = {}
+        validators = {}
+        hashes = {}
+        indexed = {}
+        for row in self.db.execute('SELECT tg_id, etag, last_modified, content_hash FROM ICalCache').fetchall():
+            if self.store.has(row[3]):
+                validators[row[0]] = (row[1], row[2])
+                hashes[row[0]] = row[3]
+        for row in self.db.execute('SELECT user_id, content_hash FROM EventIndexState').fetchall():
+            indexed[row[0]] = row[1]
+
+        for user_id in user_ids:
             user = self.users[user_id]
-            if user.config.stop:
-                continue
-            ical_path = f'./ical/{user_id}.ics'
-            if fetch_local and (force_use_local or os.path.exists(ical_path)):
-                    ical_file = open(ical_path, 'r')
-                    cal = Calendar.from_ical(ical_file.read())
-                    icals[user_id] = cal
-                    ical_file.close()
+            if fetch_local and (force_use_local or user_id in hashes):
+                if user_id not in hashes:
+                    logger.warning(f'No cached ical file of user {user_id}, skipped.')
+                    continue
+                if indexed.get(user_id) == hashes[user_id]:
+                    continue
+                local.append(user_id)
             else:
-                response = requests.get(user.subscription)
-                if response.ok:
-                    ical_file = open(ical_path, 'w')
-                    ical_file.write(response.text)
-                    ical_file.close()
-                    cal = Calendar.from_ical(response.text)
-                    icals[user_id] = cal
+                downloads[user_id] = user.subscription
+
+        # The feeds go through in batches, only one batch of feed contents is held in memory at a time.
+        for batch in self.__batches(local):
+            self.__index_calendars({user_id: self.store.ref(hashes[user_id]) for user_id in batch})
+
+        # the remote feeds of a batch are downloaded concurrently, only the changed contents are parsed into the index.
+        # The next batch is already downloading while one is being parsed.
+        report = {'unchanged': 0, 'changed': 0, 'failed': 0}
+        batches = list(self.__batches(list(downloads)))
+        submit = lambda batch: self.fetcher.submit_all({user_id: downloads[user_id] for user_id in batch}, {user_id: validators[user_id] for user_id in batch if user_id in validators})
+        pending = submit(batches[0]) if batches else None
+        for i in range(len(batches)):
+            responses = self.fetcher.collect(pending)
+            pending = submit(batches[i + 1]) if i + 1 < len(batches) else None
+            icals = {}
+            cache_rows = []
+            outcomes = {}
+            for user_id in responses:
+                response = responses[user_id]
+                if response.ok or response.not_modified:
+                    content_hash = ical_hash(response.text) if response.ok else hashes.get(user_id)
+                    cache_rows.append((user_id, response.etag, response.last_modified, content_hash))
+                    if response.not_modified or (user_id in hashes and content_hash == hashes[user_id]):
+                        outcomes[user_id] = UNCHANGED
+                        if indexed.get(user_id) != content_hash:
+                            icals[user_id] = self.store.ref(content_hash)
+                        continue
+                    outcomes[user_id] = CHANGED
+                    self.store.put(response.text, content_hash)
+                    icals[user_id] = response.text
                 else:
-                    logger.warning('ical file download failed for: ' + user.subscription + ' , user chat id: '+ user_id)
-                    has_failed = True
+                    outcomes[user_id] = FAILED
+                    if user_id in hashes:
+                        logger.warning(f'ical file download failed for: {response.url} , user chat id: {user_id} ({response.error}), using the cached file.')
+                        if indexed.get(user_id) != hashes[user_id]:
+                            icals[user_id] = self.store.ref(hashes[user_id])
+                    else:
+                        logger.warning(f'ical file download failed for: {response.url} , user chat id: {user_id} ({response.error}), there is no cached file to fall back on.')
+            del responses
+            for user_id in outcomes:
+                report[outcomes[user_id]] += 1
+            self.__save_ical_cache(cache_rows)
+            self.__index_calendars(icals)
+            self.refresh_scheduler.record(outcomes)
+        if downloads:
+            self.refresh_report = report
+            logger.info(f'Refreshed ical subscriptions: {report["changed"]} changed, {report["unchanged"]} unchanged, {report["failed"]} failed.')
 
-        if has_failed:
-            self.load_all_users_calendars(fetch_local=True, force_use_local=True)
-            logger.warning('One or more ical download failed, please check their validation or internet issue. The ical data has not been updated and now using local data.')
-        else:
-            for id in icals:
-                if self.users[id].config.stop:
-                    continue
-                self.users[id].calendar = icals[id]
-                
-        return True
+    def __batches(self, items: list):
+        for i in range(0, len(items), self.batch_size):
+            yield items[i:i + self.batch_size]
 
-    def query_course_by_time(self, hour_time: int) -> list:
-        conn = sqlite3.connect(self.db)
-        if not conn:
-            return False
-        cursor = conn.cursor()
-        courses = []
-        if type(hour_time) == int and hour_time >= 7 and hour_time <= 21:
-            QUERY_COURSE_BY_TIME = "SELECT * from Course WHERE start_time = :hour"
-            res = cursor.execute(QUERY_COURSE_BY_TIME, {'hour': hour_time + 1})
-            for c_data in res.fetchall():
-                courses.append(Course(c_data[0], c_data[1], c_data[2], c_data[3], c_data[4], c_data[5]))
-        conn.close()
-        return courses
+    # Removes the feeds no user is mapped to any more from the feed store.
+    def collect_feed_garbage(self) -> tuple:
+        referenced = set(row[0] for row in self.db.execute('SELECT DISTINCT content_hash FROM ICalCache').fetchall() if row[0])
+        return self.store.collect_garbage(referenced)
+
+    # The courses whose reminders are due at `when`, they are taken out of the due index.
+    def pop_due_courses(self, when: datetime) -> list:
+        return self.due_index.pop_due(when)
 
+    # sessions: (code, name, type, start, end, user_id) rows as __dispatch returns them.
+    # Puts the sessions which haven't started and haven't been notified into the due index, grouped by user.
+    def __update_due_index(self, user_ids: list, sessions: list):
+        now = self.clock.now()
+        day_start = local_day_bounds(now)[0]
+        notified = set(self.db.execute('SELECT user_id, start_time FROM NotifyLog WHERE start_time >= ?', [utc_iso(day_start)]).fetchall())
+        courses = {user_id: [] for user_id in user_ids}
+        # every distinct time is parsed once, the users attending a session share its datetimes.
+        times = {}
+        malformed = 0
+        for session in sessions:
+            if (session[5], session[3]) in notified:
+                continue
+            try:
+                start = times.get(session[3])
+                if start is None:
+                    start = times[session[3]] = datetime.fromisoformat(session[3])
+                end = times.get(session[4])
+                if end is None:
+                    end = times[session[4]] = datetime.fromisoformat(session[4])
+            except (TypeError, ValueError):
+                malformed += 1
+                continue
+            course = Course(sys.intern(session[0]), sys.intern(session[1]), sys.intern(session[2]), start, end, session[5])
+            if course.start > now:
+                courses[course.user_id].append(course)
+        if malformed > 0:
+            logger.warning(f'Skipped {malformed} session(s) with a malformed start or end time.')
+        for user_id in courses:
+            config = self.users[user_id].config
+            self.due_index.set_user_courses(user_id, courses[user_id], config.lead_minutes, config.stop)
+
+    def mark_notified(self, course: Course):
+        with self.db.transaction() as cur:
+            cur.execute('INSERT OR REPLACE INTO NotifyLog VALUES (?, ?, ?)', [course.user_id, utc_iso(course.start), utc_iso(self.clock.now())])
+
+    # listener: called with the list of dispatched user ids after dispatchForUser, or with None after dispatchAll.
+    def add_dispatch_listener(self, listener):
+        self.dispatch_listeners.append(listener)
+
+    def __notify_dispatched(self, user_ids):
+        for listener in self.dispatch_listeners:
+            listener(user_ids)
+
+    # Looks today's sessions of the user up in the EventIndex, an event the feed lists twice is only dispatched once.
+    # The strings are interned, the rows of the users attending the same session share them instead of holding copies each.
     def __dispatch(self, tg_id: int) -> list:
-        sessions = []
-        cal = self.users[tg_id].calendar
-        if not cal:
-            return []
-        events_dat = cal.subcomponents
-        today_date = datetime.today().date()
-        for event in events_dat:
-            if (event.name == 'VEVENT'):
-                desc = str(event['DESCRIPTION'])
-                start_time: datetime = event['DTSTART'].dt
-                if (start_time.date() != today_date):
-                    continue
-                end_time:datetime = event['DTEND'].dt
-                infos = {}
-                lns = desc.splitlines()
-                for ln in lns:
-                    if ln == '':
-                        continue
-                    parts = ln.split(':')
-                    if len(parts) == 2:
-                        infos[parts[0]] = parts[1].strip()
-                
-                unit_code = 'UNKNOW'
-                unit_desc = 'Unknow'
-                event_type = 'Unknow type'
-                if 'Unit Code' in infos:
-                    unit_code = infos['Unit Code']
-                elif 'Code' in infos:
-                    unit_code = infos['Code']
-                else:
-                    logger.error('Cannot find "Unit Code" in calendar info. Please check if there is any change on calendar format.')
+        sessions = {}
+        today_date = self.clock.now().astimezone().date()
+        res = self.db.execute('SELECT course_code, course_name, course_type, start_time, end_time FROM EventIndex WHERE user_id=? AND date=?', [tg_id, today_date.isoformat()])
+        intern = sys.intern
+        for row in res.fetchall():
+            start_time = intern(utc_iso(datetime.fromisoformat(row[3])))
+            end_time = intern(utc_iso(datetime.fromisoformat(row[4])))
+            code = intern(row[0])
+            course_type = intern(row[2])
+            sessions.setdefault((start_time, code, course_type), (code, intern(row[1]), course_type, start_time, end_time, tg_id))
+        EVENTS_DISPATCHED.observe(len(sessions))
+        return list(sessions.values())
 
-                if 'Description' in infos:
-                    unit_desc = infos['Description']
-                elif 'Unit Description' in infos:
-                    unit_desc = infos['Unit Description']
-                else:
-                    logger.error('Cannot find "Description" in calendar info. Please check if there is any change on calendar format.')
-                
-                if 'Event type' in infos:
-                    event_type = infos['Event type']
-                else:
-                    logger.error('Cannot find "Event type" in calendar info. Please check if there is any change on calendar format.')
-                course = (unit_code, unit_desc, event_type, start_time.hour, end_time.hour, tg_id)
-                sessions.append(course)
-        self.users[tg_id].release_calendar()
-        return sessions
+    # The Session ids of the (code, name, type, start, end) keys, the units and sessions which aren't in the catalogue yet are added.
+    # The ids are cached, every session is looked up in the database once a day however many users attend it.
+    def __catalogue_ids(self, keys: set) -> dict:
+        with self.__catalogue_lock:
+            units = set((key[0], key[1]) for key in keys if key not in self.__session_ids and (key[0], key[1]) not in self.__unit_ids)
+            if units:
+                with self.db.transaction() as cur:
+                    cur.executemany('INSERT OR IGNORE INTO Unit (code, name) VALUES (?, ?)', units)
+                    for unit in units:
+                        self.__unit_ids[unit] = cur.execute('SELECT id FROM Unit WHERE code=? AND name=?', unit).fetchone()[0]
+            missing = [key for key in keys if key not in self.__session_ids]
+            if missing:
+                rows = [(self.__unit_ids[(key[0], key[1])], key[2], key[3], key[4]) for key in missing]
+                with self.db.transaction() as cur:
+                    cur.executemany('INSERT OR IGNORE INTO Session (unit_id, type, start_time, end_time) VALUES (?, ?, ?, ?)', rows)
+                    for key, row in zip(missing, rows):
+                        self.__session_ids[key] = cur.execute('SELECT id FROM Session WHERE unit_id=? AND type=? AND start_time=? AND end_time=?', row).fetchone()[0]
+            return {key: self.__session_ids[key] for key in keys}
+
+    # sessions: a dict maps user ids to their (code, name, type, start, end, user_id) rows of today.
+    # Brings the Enrolment rows of the users in line with their sessions, only the rows which differ are deleted or inserted, so dispatching
+    # the same sessions again changes nothing. Every batch of users is written in its own short transaction, the notification queries
+    # and the handlers never wait on the whole dispatch. Returns the number of rows (inserted, deleted).
+    def __apply_sessions(self, sessions: dict):
+        inserted = 0
+        deleted = 0
+        for batch in self.__batches(list(sessions)):
+            session_ids = self.__catalogue_ids(set(session[:5] for user_id in batch for session in sessions[user_id]))
+            wanted = set((user_id, session_ids[session[:5]]) for user_id in batch for session in sessions[user_id])
+            res = self.db.execute(f"SELECT user_id, session_id FROM Enrolment WHERE user_id IN ({','.join('?' * len(batch))})", batch)
+            existing = set(res.fetchall())
+            deletes = list(existing - wanted)
+            inserts = list(wanted - existing)
+            if deletes or inserts:
+                with self.db.transaction() as cur:
+                    cur.executemany("DELETE FROM Enrolment WHERE user_id=? AND session_id=?", deletes)
+                    cur.executemany("INSERT OR IGNORE INTO Enrolment (user_id, session_id) VALUES (?, ?)", inserts)
+            inserted += len(inserts)
+            deleted += len(deletes)
+        return inserted, deleted
 
     def dispatchForUser(self, tg_id: int):
         sessions = self.__dispatch(tg_id)
-        conn = sqlite3.connect(self.db)
-        cur = conn.cursor()
-        cur.executemany("INSERT INTO Course (course_code, course_name, course_type, start_time, end_time, user_id) VALUES (?, ?, ?, ?, ?, ?)", sessions)
-        conn.commit()
-        conn.close()
+        self.__apply_sessions({tg_id: sessions})
+        self.__update_due_index([tg_id], sessions)
+        self.__notify_dispatched([tg_id])
 
+    # Today's sessions are looked up from the EventIndex. On the same day only the users whose index has been rebuilt since the last
+    # dispatch are dispatched again, the others keep their existing Enrolment rows. On a new day the sessions of the previous days are dropped first.
+    # The Enrolment table is only diffed against the new sessions, see __apply_sessions, so an interrupted dispatch is simply run again.
     def dispatchAll(self):
-        sessions = []
+        sessions = {}
         n = 0
         f = 0
+        k = 0
+        now = self.clock.now()
+        today_date = now.astimezone().date()
+        if self.dispatch_date != today_date:
+            day_start = local_day_bounds(now)[0]
+            with self.db.transaction() as cur:
+                cur.execute("DELETE FROM Enrolment WHERE session_id IN (SELECT id FROM Session WHERE start_time < ?)", [utc_iso(day_start)])
+                cur.execute("DELETE FROM Session WHERE start_time < ?", [utc_iso(day_start)])
+                cur.execute("DELETE FROM NotifyLog WHERE start_time < ?", [utc_iso(now - timedelta(days=1))])
+            with self.__catalogue_lock:
+                self.__session_ids.clear()
         for user_id in self.users:
+            if self.users[user_id].config.stop:
+                continue
+            if self.dispatch_date == today_date and user_id not in self.changed_users:
+                k += 1
+                continue
             sess = self.__dispatch(user_id)
+            sessions[user_id] = sess
             if len(sess) > 0:
-                sessions.extend(sess)
                 n += 1
             else:
                 f += 1
-        conn = sqlite3.connect(self.db)
-        cur = conn.cursor()
-        cur.execute("DELETE FROM Course")
-        cur.executemany("INSERT INTO Course (course_code, course_name, course_type, start_time, end_time, user_id) VALUES (?, ?, ?, ?, ?, ?)", sessions)
-        conn.commit()
-        conn.close()
-        logger.info(f'Successfully dispatched today\'s timetable for {n} users with {f} user(s) failed to dispatch.')
+        inserted, deleted = self.__apply_sessions(sessions)
+        with self.db.transaction() as cur:
+            cur.execute("INSERT OR REPLACE INTO DispatchState VALUES (?, ?)", [self.dispatch_state_key, today_date.isoformat()])
+        if self.dispatch_date != today_date:
+            self.due_index.clear()
+        self.__update_due_index(list(sessions), [session for user_id in sessions for session in sessions[user_id]])
+        self.dispatch_date = today_date
+        self.changed_users.clear()
+        self.__notify_dispatched(None)
+        logger.info(f'Successfully dispatched today\'s timetable for {n} users with {f} user(s) failed to dispatch, {k} unchanged user(s) kept their sessions, '
+                    f'{inserted} session(s) added and {deleted} removed.')
+
+    # Picks today's sessions up from the database when a previous run has already dispatched today, so a restart doesn't have to
+    # read any feed before the reminders are scheduled again. Returns False when the persisted dispatch is missing or stale.
+    # The users have to be loaded first.
+    def resume_dispatch(self) -> bool:
+        now = self.clock.now()
+        today_date = now.astimezone().date()
+        row = self.db.execute("SELECT value FROM DispatchState WHERE key=?", [self.dispatch_state_key]).fetchone()
+        if row is None or row[0] != today_date.isoformat():
+            return False
+        day_start, day_end = local_day_bounds(now)
+        sessions = [s for s in self.db.execute('SELECT course_code, course_name, course_type, start_time, end_time, user_id FROM Course WHERE start_time >= ? AND start_time < ?',
+                                               [utc_iso(day_start), utc_iso(day_end)]).fetchall() if s[5] in self.users]
+        self.due_index.clear()
+        self.__update_due_index(list(self.users), sessions)
+        self.dispatch_date = today_date
+        self.__notify_dispatched(None)
+        logger.info(f'Resumed today\'s dispatch of {len(sessions)} session(s) from the database.')
+        return True
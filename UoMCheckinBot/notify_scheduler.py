@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta, timezone, time as dtime
+import threading
+import heapq
+import logging
+import itertools
+
+from .metrics import TIMER_DRIFT
+
+logger = logging.getLogger('checkin-bot')
+
+# The longest time the engine sleeps without looking at the clock, so a changed system clock is noticed in time.
+MAX_WAIT_SECONDS = 30.0
+
+class SystemClock:
+    def now(self) -> datetime:
+        return datetime.now(timezone.utc)
+
+# A clock which only moves when it's told to, for testing the engine without waiting.
+class VirtualClock:
+    def __init__(self, start: datetime = None):
+        self.current = start if start else datetime.now(timezone.utc)
+
+    def now(self) -> datetime:
+        return self.current
+
+    def advance(self, delta: timedelta):
+        self.current += delta
+
+    def set(self, when: datetime):
+        self.current = when
+
+class TimerEntry:
+    def __init__(self, key, when: datetime, callback, group=None, expires: datetime = None):
+        self.key = key
+        self.when = when
+        self.callback = callback
+        self.group = group
+        self.expires = expires
+
+# A heap of one-shot timers keyed by their exact fire time.
+# Timers which are overdue when the engine gets to them (after a stall or a restart) are still fired,
+# unless they have an expiry time which has already passed.
+class TimerEngine:
+    def __init__(self, clock=None):
+        self.clock = clock if clock else SystemClock()
+        self.__heap = []
+        self.__entries = {}
+        self.__seq = itertools.count()
+        self.__cond = threading.Condition()
+        self.__stopped = False
+
+    # key: identifies the timer, scheduling the same key again replaces the old timer.
+    # group: any hashable value, used by cancel_group to drop several timers at once.
+    # expires: when given, the timer is dropped instead of fired if the engine only gets to it after this time.
+    def schedule_at(self, key, when: datetime, callback, group=None, expires: datetime = None):
+        entry = TimerEntry(key, when, callback, group, expires)
+        with self.__cond:
+            self.__entries[key] = entry
+            heapq.heappush(self.__heap, (when, next(self.__seq), entry))
+            if self.__heap[0][2] is entry:
+                self.__cond.notify()
+        return key
+
+    # Runs callback every `seconds`, the first time `seconds` from now.
+    def schedule_every(self, key, seconds: float, callback):
+        def run_and_reschedule():
+            self.schedule_every(key, seconds, callback)
+            callback()
+        return self.schedule_at(key, self.clock.now() + timedelta(seconds=seconds), run_and_reschedule)
+
+    # Runs callback every day at hour:minute in local time.
+    # The time is built from the local date, so the next day's offset applies when the clocks change in between.
+    def schedule_daily(self, key, hour: int, minute: int, callback):
+        def run_and_reschedule():
+            self.schedule_daily(key, hour, minute, callback)
+            callback()
+        now = self.clock.now().astimezone()
+        when = datetime.combine(now.date(), dtime(hour, minute)).astimezone()
+        if when <= now:
+            when = datetime.combine(now.date() + timedelta(days=1), dtime(hour, minute)).astimezone()
+        return self.schedule_at(key, when, run_and_reschedule)
+
+    def cancel(self, key) -> bool:
+        with self.__cond:
+            return self.__entries.pop(key, None) is not None
+
+    def cancel_group(self, group) -> int:
+        return self.cancel_groups({group})
+
+    def cancel_groups(self, groups: set) -> int:
+        with self.__cond:
+            keys = [key for key in self.__entries if self.__entries[key].group in groups]
+            for key in keys:
+                del self.__entries[key]
+            return len(keys)
+
+    def pending(self) -> int:
+        with self.__cond:
+            return len(self.__entries)
+
+    def next_due(self) -> datetime:
+        with self.__cond:
+            self.__drop_cancelled()
+            return self.__heap[0][0] if self.__heap else None
+
+    def __drop_cancelled(self):
+        while self.__heap and self.__entries.get(self.__heap[0][2].key) is not self.__heap[0][2]:
+            heapq.heappop(self.__heap)
+
+    # Fires every timer which is due by now, returns how many of them have been fired.
+    def run_pending(self) -> int:
+        fired = 0
+        while True:
+            with self.__cond:
+                self.__drop_cancelled()
+                now = self.clock.now()
+                if not self.__heap or self.__heap[0][0] > now:
+                    return fired
+                entry = heapq.heappop(self.__heap)[2]
+                del self.__entries[entry.key]
+            if entry.expires and now >= entry.expires:
+                logger.warning(f'Timer {entry.key} expired before it could be fired, it was due at {entry.when}.')
+                continue
+            lateness = (now - entry.when).total_seconds()
+            TIMER_DRIFT.observe(lateness)
+            if lateness > 60:
+                logger.warning(f'Timer {entry.key} is fired {lateness:.0f} seconds late.')
+            try:
+                entry.callback()
+            except Exception:
+                logger.exception(f'Timer {entry.key} failed.')
+            fired += 1
+
+    def run_forever(self):
+        while True:
+            self.run_pending()
+            with self.__cond:
+                if self.__stopped:
+                    return
+                self.__drop_cancelled()
+                timeout = MAX_WAIT_SECONDS
+                if self.__heap:
+                    timeout = min(timeout, max(0.0, (self.__heap[0][0] - self.clock.now()).total_seconds()))
+                self.__cond.wait(timeout)
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
@@ -0,0 +1,121 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+import hashlib
+import logging
+import time
+
+from .ical_extractor import read_events, extract_events, parse_description, UnsupportedFeedError
+
+logger = logging.getLogger('checkin-bot')
+
+def ical_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+# Turns the parsed events of one feed into (code, name, type, start, end) sessions,
+# returns them with the set of description keys which were missing in any event.
+def parse_sessions(events: list):
+    sessions = []
+    missing = set()
+    for event in events:
+        infos = parse_description(event.description)
+
+        unit_code = 'UNKNOW'
+        unit_desc = 'Unknow'
+        event_type = 'Unknow type'
+        if 'Unit Code' in infos:
+            unit_code = infos['Unit Code']
+        elif 'Code' in infos:
+            unit_code = infos['Code']
+        else:
+            missing.add('Unit Code')
+
+        if 'Description' in infos:
+            unit_desc = infos['Description']
+        elif 'Unit Description' in infos:
+            unit_desc = infos['Unit Description']
+        else:
+            missing.add('Description')
+
+        if 'Event type' in infos:
+            event_type = infos['Event type']
+        else:
+            missing.add('Event type')
+        sessions.append((unit_code, unit_desc, event_type, event.start, event.end))
+    return sessions, missing
+
+# Whether the events look like they come from a UoM timetable, i.e. any of them has the description keys the sessions are read from.
+def is_uom_timetable(events) -> bool:
+    for event in events:
+        infos = parse_description(event.description)
+        if 'Event type' in infos and ('Unit Code' in infos or 'Code' in infos) and ('Unit Description' in infos or 'Description' in infos):
+            return True
+    return False
+
+class ParsedFeed:
+    def __init__(self, tg_id: int, content_hash: str, rows: list = None, missing: tuple = (), seconds: float = 0.0, error: str = ''):
+        self.tg_id = tg_id
+        self.content_hash = content_hash
+        # (date, code, name, type, start, end) strings, the EventIndex rows without the user id.
+        self.rows = rows
+        self.missing = missing
+        self.seconds = seconds
+        self.error = error
+
+# A feed of the feed store is read straight from its blob, decompressed line by line, and isn't hashed again.
+def _read_stored_events(feed) -> list:
+    try:
+        with feed.open() as lines:
+            return extract_events(lines)
+    except UnsupportedFeedError:
+        return read_events(feed.read())
+
+# The unit of work of the pool, runs in the worker processes so it only takes and returns plain picklable values.
+# item: (user id, the raw ical content or a feed_store.StoredFeed).
+def parse_feed(item: tuple) -> ParsedFeed:
+    tg_id, content = item
+    start = time.perf_counter()
+    stored = not isinstance(content, str)
+    content_hash = content.content_hash if stored else ical_hash(content)
+    try:
+        sessions, missing = parse_sessions(_read_stored_events(content) if stored else read_events(content))
+    except Exception as e:
+        return ParsedFeed(tg_id, content_hash, error=f'{type(e).__name__}: {e}')
+    rows = [(s[3].date().isoformat(), s[0], s[1], s[2], s[3].isoformat(), s[4].isoformat()) for s in sessions]
+    return ParsedFeed(tg_id, content_hash, rows, tuple(sorted(missing)), time.perf_counter() - start)
+
+# Parses many feeds at once on a pool of worker processes, as the parsing is pure Python and a single process is bound to one core by the GIL.
+# The processes are spawned on first use and kept for the next refresh. Small batches, and every batch when workers <= 1, are parsed in-process.
+class ParsePool:
+    # workers: number of worker processes.
+    # chunksize: feeds handed to a worker at once, larger chunks cost less IPC but balance worse.
+    # min_batch: batches with fewer feeds than this are not worth the round trip to the workers.
+    def __init__(self, workers: int = 1, chunksize: int = 8, min_batch: int = 4):
+        self.workers = max(1, workers)
+        self.chunksize = max(1, chunksize)
+        self.min_batch = min_batch
+        self.__executor = None
+        self.__lock = threading.Lock()
+
+    def __get_executor(self) -> ProcessPoolExecutor:
+        with self.__lock:
+            if self.__executor is None:
+                # spawned rather than forked, the bot has threads holding locks (logging, sqlite, http pools) which a fork would copy.
+                self.__executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.__executor
+
+    # contents: a dict maps user ids to their raw ical content or their feed_store.StoredFeed.
+    # Yields a ParsedFeed for every user as soon as it's parsed, in the order of contents.
+    def parse(self, contents: dict):
+        items = list(contents.items())
+        if self.workers <= 1 or len(items) < self.min_batch:
+            for item in items:
+                yield parse_feed(item)
+            return
+        yield from self.__get_executor().map(parse_feed, items, chunksize=self.chunksize)
+
+    def close(self):
+        with self.__lock:
+            if self.__executor is not None:
+                self.__executor.shutdown(wait=True)
+                self.__executor = None
@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta, timezone
+import threading
+import hashlib
+import logging
+import math
+
+from .database import Database
+
+logger = logging.getLogger('checkin-bot')
+
+# The local hours [start, end) the nightly refreshes are spread over, before the daily dispatch.
+DEFAULT_WINDOW = (1, 5)
+# Retries of a failing feed start this many minutes later and double until MAX_BACKOFF.
+RETRY_BASE_MINUTES = 15
+MAX_BACKOFF = timedelta(hours=24)
+# The backoff stops doubling once it has passed MAX_BACKOFF, so a feed failing for weeks doesn't overflow it.
+MAX_BACKOFF_DOUBLINGS = math.ceil(math.log2(MAX_BACKOFF / timedelta(minutes=RETRY_BASE_MINUTES)))
+# How much the latest refresh counts towards a feed's change rate.
+CHANGE_RATE_WEIGHT = 0.3
+# (minimum change rate, refresh interval) from the most to the least often changing feeds, the rest is refreshed nightly.
+CHANGE_RATE_INTERVALS = ((0.5, timedelta(hours=6)), (0.25, timedelta(hours=12)))
+
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+
+class FeedState:
+    __slots__ = ('tg_id', 'next_refresh', 'failures', 'change_rate', 'last_checked')
+
+    def __init__(self, tg_id: int, next_refresh: datetime, failures: int = 0, change_rate: float = 0.0, last_checked: datetime = None):
+        self.tg_id = tg_id
+        self.next_refresh = next_refresh
+        self.failures = failures
+        self.change_rate = change_rate
+        self.last_checked = last_checked
+
+    def row(self) -> tuple:
+        return (self.tg_id, self.next_refresh.astimezone(timezone.utc).isoformat(), self.failures, self.change_rate,
+                self.last_checked.astimezone(timezone.utc).isoformat() if self.last_checked else None)
+
+# Decides when every subscription is downloaded again, the state is kept in the FeedSchedule table.
+# Every feed has its own fixed slot in the nightly window, so the downloads are spread over the night instead of all
+# happening at once. Feeds which often change between refreshes are refreshed every few hours instead, and failing
+# feeds are retried with an exponential backoff.
+class RefreshScheduler:
+    def __init__(self, database: Database, clock, window: tuple = DEFAULT_WINDOW):
+        self.db = database
+        self.clock = clock
+        self.window = window
+        self.__states = None
+        self.__lock = threading.Lock()
+
+    def __load(self) -> dict:
+        if self.__states is None:
+            self.__states = {}
+            for row in self.db.execute('SELECT tg_id, next_refresh, failures, change_rate, last_checked FROM FeedSchedule').fetchall():
+                self.__states[row[0]] = FeedState(row[0], datetime.fromisoformat(row[1]), row[2], row[3], datetime.fromisoformat(row[4]) if row[4] else None)
+        return self.__states
+
+    # The feed's slot in the nightly window is derived from its id, so it stays the same across restarts.
+    def night_slot(self, tg_id: int, after: datetime) -> datetime:
+        start_hour, end_hour = self.window
+        span = ((end_hour - start_hour) % 24 or 24) * 3600
+        offset = int.from_bytes(hashlib.blake2b(str(tg_id).encode(), digest_size=4).digest(), 'big') % span
+        local = after.astimezone()
+        slot = local.replace(hour=start_hour, minute=0, second=0, microsecond=0) + timedelta(seconds=offset)
+        while slot <= local:
+            slot += timedelta(days=1)
+        return slot.astimezone(timezone.utc)
+
+    def interval_for(self, change_rate: float) -> timedelta:
+        for rate, interval in CHANGE_RATE_INTERVALS:
+            if change_rate >= rate:
+                return interval
+        return None
+
+    # The users out of user_ids whose refresh is due now. Users the scheduler hasn't seen yet get a slot in the next night,
+    # unless cached is given and doesn't contain them, then they have nothing to fall back on and are due at once.
+    def due(self, user_ids, cached: set = None) -> list:
+        now = self.clock.now()
+        due = []
+        new_rows = []
+        with self.__lock:
+            states = self.__load()
+            for tg_id in user_ids:
+                state = states.get(tg_id)
+                if state is None:
+                    state = FeedState(tg_id, now if cached is not None and tg_id not in cached else self.night_slot(tg_id, now))
+                    states[tg_id] = state
+                    new_rows.append(state.row())
+                if state.next_refresh <= now:
+                    due.append(tg_id)
+        if new_rows:
+            with self.db.transaction() as cur:
+                cur.executemany('INSERT OR REPLACE INTO FeedSchedule VALUES (?, ?, ?, ?, ?)', new_rows)
+        return due
+
+    # outcomes: a dict maps user ids to CHANGED, UNCHANGED or FAILED, schedules the next refresh of every one of them.
+    def record(self, outcomes: dict):
+        if not outcomes:
+            return
+        now = self.clock.now()
+        rows = []
+        with self.__lock:
+            states = self.__load()
+            for tg_id in outcomes:
+                state = states.get(tg_id)
+                if state is None:
+                    state = FeedState(tg_id, now)
+                    states[tg_id] = state
+                state.last_checked = now
+                if outcomes[tg_id] == FAILED:
+                    state.failures += 1
+                    state.next_refresh = now + min(timedelta(minutes=RETRY_BASE_MINUTES * 2 ** min(state.failures - 1, MAX_BACKOFF_DOUBLINGS)), MAX_BACKOFF)
+                else:
+                    state.failures = 0
+                    state.change_rate = state.change_rate * (1 - CHANGE_RATE_WEIGHT) + (CHANGE_RATE_WEIGHT if outcomes[tg_id] == CHANGED else 0.0)
+                    interval = self.interval_for(state.change_rate)
+                    state.next_refresh = now + interval if interval else self.night_slot(tg_id, now + timedelta(hours=1))
+                rows.append(state.row())
+        with self.db.transaction() as cur:
+            cur.executemany('INSERT OR REPLACE INTO FeedSchedule VALUES (?, ?, ?, ?, ?)', rows)
+
+    def forget(self, tg_id: int):
+        with self.__lock:
+            self.__load().pop(tg_id, None)
+        with self.db.transaction() as cur:
+            cur.execute('DELETE FROM FeedSchedule WHERE tg_id=?', [tg_id])
+
+    def state(self, tg_id: int) -> FeedState:
+        with self.__lock:
+            return self.__load().get(tg_id)
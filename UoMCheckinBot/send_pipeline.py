@@ -0,0 +1,218 @@
+from datetime import datetime, timezone
+from collections import deque
+import threading
+import itertools
+import logging
+import heapq
+import time
+
+from telegram.error import RetryAfter, BadRequest, Unauthorized, ChatMigrated, NetworkError
+
+from .metrics import SEND_MESSAGES, REMINDER_LEAD
+
+logger = logging.getLogger('checkin-bot')
+
+# Telegram allows a bot about 30 messages per second in total and about 1 message per second to the same chat.
+TELEGRAM_GLOBAL_RATE = 30.0
+TELEGRAM_CHAT_RATE = 1.0
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1.0, rate)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.last = clock()
+        self.__lock = threading.Lock()
+
+    # Takes one token if there is one and returns 0, otherwise returns how many seconds it takes until one is available.
+    def try_acquire(self) -> float:
+        with self.__lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return 0.0
+            return (1.0 - self.tokens) / self.rate
+
+    # Nothing is taken out of the bucket until `seconds` later, used when Telegram asks to retry after a while.
+    def pause(self, seconds: float):
+        with self.__lock:
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+class SendJob:
+    def __init__(self, chat_id: int, text: str, parse_mode: str = None, session_start: datetime = None, on_sent=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.session_start = session_start
+        self.on_sent = on_sent
+        self.attempts = 0
+        self.enqueued_at = 0.0
+        self.not_before = 0.0
+
+# An outbound queue of messages, sent by a pool of workers within Telegram's flood limits.
+# Jobs are sent in the order of their session start time, failed jobs are retried with exponential backoff.
+class SendPipeline:
+    def __init__(self, bot, workers: int = 8, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 max_retries: int = 5, backoff: float = 1.0, clock=time.monotonic, sleep=time.sleep, wall_clock=None):
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.wall_clock = wall_clock if wall_clock else (lambda: datetime.now(timezone.utc))
+        # no burst allowance, the messages are spread evenly over every second.
+        self.global_bucket = TokenBucket(global_rate, capacity=1.0, clock=clock)
+        self.chat_rate = chat_rate
+        self.__chat_buckets = {}
+        self.__ready = []
+        self.__delayed = []
+        self.__seq = itertools.count()
+        self.__cond = threading.Condition()
+        self.__unfinished = 0
+        self.__stopped = False
+        self.__threads = []
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0}
+        # (seconds spent in the queue, seconds before the session start) of the recently sent messages.
+        self.latencies = deque(maxlen=10000)
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.__work, name=f'send-{i}', daemon=True)
+            t.start()
+            self.__threads.append(t)
+
+    def stop(self, wait: bool = True):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify_all()
+        if wait:
+            for t in self.__threads:
+                t.join()
+        self.__threads.clear()
+
+    # on_sent: called with the job after the message has been delivered.
+    def send(self, chat_id: int, text: str, parse_mode: str = None, session_start: datetime = None, on_sent=None) -> SendJob:
+        job = SendJob(chat_id, text, parse_mode, session_start, on_sent)
+        job.enqueued_at = self.clock()
+        self.__push(job)
+        return job
+
+    def pending(self) -> int:
+        with self.__cond:
+            return self.__unfinished
+
+    # Blocks until every queued job is sent or has failed, returns False on timeout.
+    def join(self, timeout: float = None) -> bool:
+        with self.__cond:
+            return self.__cond.wait_for(lambda: self.__unfinished == 0, timeout)
+
+    def __push(self, job: SendJob, retry: bool = False):
+        with self.__cond:
+            if not retry:
+                self.__unfinished += 1
+            priority = job.session_start.timestamp() if job.session_start else float('inf')
+            if job.not_before > self.clock():
+                heapq.heappush(self.__delayed, (job.not_before, next(self.__seq), priority, job))
+            else:
+                heapq.heappush(self.__ready, (priority, next(self.__seq), job))
+            self.__cond.notify()
+
+    def __done(self):
+        with self.__cond:
+            self.__unfinished -= 1
+            if self.__unfinished == 0:
+                self.__cond.notify_all()
+
+    def __next_job(self) -> SendJob:
+        with self.__cond:
+            while True:
+                now = self.clock()
+                while self.__delayed and self.__delayed[0][0] <= now:
+                    _, seq, priority, job = heapq.heappop(self.__delayed)
+                    heapq.heappush(self.__ready, (priority, seq, job))
+                if self.__ready:
+                    return heapq.heappop(self.__ready)[2]
+                if self.__stopped:
+                    return None
+                self.__cond.wait(self.__delayed[0][0] - now if self.__delayed else None)
+
+    def __chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self.__cond:
+            bucket = self.__chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate, capacity=1.0, clock=self.clock)
+                self.__chat_buckets[chat_id] = bucket
+            return bucket
+
+    def __wait_token(self, bucket: TokenBucket):
+        while True:
+            wait = bucket.try_acquire()
+            if wait <= 0:
+                return
+            self.sleep(wait)
+
+    def __work(self):
+        while True:
+            job = self.__next_job()
+            if job is None:
+                return
+            self.__wait_token(self.__chat_bucket(job.chat_id))
+            self.__wait_token(self.global_bucket)
+            job.attempts += 1
+            try:
+                self.bot.send_message(job.chat_id, job.text, parse_mode=job.parse_mode)
+            except RetryAfter as e:
+                logger.warning(f'Telegram flood limit reached, retry after {e.retry_after} seconds.')
+                self.global_bucket.pause(float(e.retry_after))
+                self.__retry(job, float(e.retry_after))
+                continue
+            except (Unauthorized, BadRequest, ChatMigrated) as e:
+                # the user has blocked the bot or the chat is gone, retrying won't help.
+                self.__fail(job, e)
+                continue
+            except NetworkError as e:
+                self.__retry(job, self.backoff * (2 ** (job.attempts - 1)), e)
+                continue
+            except Exception as e:
+                self.__fail(job, e)
+                continue
+            self.__sent(job)
+
+    def __retry(self, job: SendJob, delay: float, error: Exception = None):
+        if job.attempts > self.max_retries:
+            self.__fail(job, error)
+            return
+        if error:
+            logger.warning(f'Sending message to {job.chat_id} failed ({error}), retry in {delay:.1f} seconds.')
+        job.not_before = self.clock() + delay
+        with self.__cond:
+            self.stats['retried'] += 1
+        SEND_MESSAGES.inc(result='retried')
+        self.__push(job, retry=True)
+
+    def __fail(self, job: SendJob, error: Exception):
+        logger.error(f'Failed to send message to {job.chat_id} after {job.attempts} attempt(s): {error}')
+        with self.__cond:
+            self.stats['failed'] += 1
+        SEND_MESSAGES.inc(result='failed')
+        self.__done()
+
+    def __sent(self, job: SendJob):
+        queued = self.clock() - job.enqueued_at
+        before_start = (job.session_start - self.wall_clock()).total_seconds() if job.session_start else None
+        with self.__cond:
+            self.stats['sent'] += 1
+            self.latencies.append((queued, before_start))
+        SEND_MESSAGES.inc(result='sent')
+        if before_start is not None:
+            REMINDER_LEAD.observe(before_start)
+        if job.on_sent:
+            try:
+                job.on_sent(job)
+            except Exception:
+                logger.exception(f'on_sent callback failed for message to {job.chat_id}.')
+        self.__done()
@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+import hashlib
+import logging
+import json
+
+from .database import Database
+
+logger = logging.getLogger('checkin-bot')
+
+# In the sharded deployment the users are partitioned over a number of worker processes by a hash of their chat id.
+# Every worker owns the fetching, parsing, dispatching and reminders of its shard, a single front process handles the Telegram updates
+# and passes the commands which change a user on to the worker owning that user, through the ShardCommand table of the shared database.
+
+def shard_of(tg_id: int, shards: int) -> int:
+    if shards <= 1:
+        return 0
+    return int.from_bytes(hashlib.blake2b(str(tg_id).encode(), digest_size=4).digest(), 'big') % shards
+
+class ShardCommand:
+    __slots__ = ('id', 'shard', 'command', 'chat_id', 'payload')
+
+    def __init__(self, id: int, shard: int, command: str, chat_id: int, payload: dict):
+        self.id = id
+        self.shard = shard
+        self.command = command
+        self.chat_id = chat_id
+        self.payload = payload
+
+# A queue of commands per shard kept in the database, so the front and the workers only have to share the database file.
+# A taken command is claimed until it's done, the claims of a worker are released when it starts again, so a command is handled at least once.
+# The commands of a chat are handled in order: a chat with a claimed command gets no other one taken until that one is done.
+class CommandQueue:
+    def __init__(self, database: Database, shards: int):
+        self.db = database
+        self.shards = max(1, shards)
+
+    def submit(self, command: str, chat_id: int, **payload) -> int:
+        shard = shard_of(chat_id, self.shards)
+        with self.db.transaction() as cur:
+            cur.execute('INSERT INTO ShardCommand (shard, command, chat_id, payload, created_at) VALUES (?, ?, ?, ?, ?)',
+                        [shard, command, chat_id, json.dumps(payload), datetime.now(timezone.utc).isoformat()])
+        return shard
+
+    # Claims and returns up to limit commands of the shard, the oldest first and at most one of every chat.
+    def take(self, shard: int, limit: int = 64) -> list:
+        # the workers look often, an empty queue is only read and never locked.
+        if self.db.execute('SELECT 1 FROM ShardCommand WHERE shard=? AND claimed_at IS NULL LIMIT 1', [shard]).fetchone() is None:
+            return []
+        with self.db.transaction() as cur:
+            rows = cur.execute('SELECT id, command, chat_id, payload FROM ShardCommand WHERE shard=? AND claimed_at IS NULL '
+                               'AND chat_id NOT IN (SELECT chat_id FROM ShardCommand WHERE shard=? AND claimed_at IS NOT NULL) ORDER BY id',
+                               [shard, shard]).fetchall()
+            commands = []
+            chats = set()
+            for row in rows:
+                if row[2] in chats:
+                    continue
+                chats.add(row[2])
+                commands.append(ShardCommand(row[0], shard, row[1], row[2], json.loads(row[3]) if row[3] else {}))
+                if len(commands) >= limit:
+                    break
+            cur.executemany('UPDATE ShardCommand SET claimed_at=? WHERE id=?', [(datetime.now(timezone.utc).isoformat(), c.id) for c in commands])
+        return commands
+
+    def done(self, command_id: int):
+        with self.db.transaction() as cur:
+            cur.execute('DELETE FROM ShardCommand WHERE id=?', [command_id])
+
+    # The commands a worker had claimed when it stopped are taken again.
+    def release(self, shard: int) -> int:
+        with self.db.transaction() as cur:
+            return cur.execute('UPDATE ShardCommand SET claimed_at=NULL WHERE shard=? AND claimed_at IS NOT NULL', [shard]).rowcount
+
+    def pending(self, shard: int = None) -> int:
+        if shard is None:
+            return self.db.execute('SELECT COUNT(*) FROM ShardCommand').fetchone()[0]
+        return self.db.execute('SELECT COUNT(*) FROM ShardCommand WHERE shard=?', [shard]).fetchone()[0]
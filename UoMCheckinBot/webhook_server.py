@@ -0,0 +1,106 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import logging
+import queue
+import hmac
+import json
+
+from telegram import Update
+
+from .metrics import WEBHOOK_UPDATES, UPDATE_SECONDS
+
+logger = logging.getLogger('checkin-bot')
+
+# The updates larger than this are refused, Telegram's are a few kilobytes.
+MAX_UPDATE_BYTES = 1 << 20
+
+# Receives the updates Telegram posts to the bot's webhook and feeds them into the dispatcher's handlers, instead of polling getUpdates.
+# Every update is acknowledged as soon as it's queued, a bounded pool of workers handles them. The updates of a chat always go to the same
+# worker, so a chat sees its updates handled in order while different chats are handled concurrently. When the worker's queue is full the
+# update is answered with 503 and Telegram delivers it again later.
+# Can be tried locally by posting a recorded update, e.g.
+#   curl -H 'Content-Type: application/json' -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' -d @benchmarks/updates/help.json http://127.0.0.1:8443/telegram
+class WebhookServer:
+    # secret_token: the X-Telegram-Bot-Api-Secret-Token every request has to carry, the one given to set_webhook. None accepts any request.
+    # workers: threads handling the updates, queue_size: updates every one of them holds at most.
+    def __init__(self, dispatcher, host: str, port: int, path: str, secret_token: str = None, workers: int = 8, queue_size: int = 64):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret_token = secret_token
+        self.__queues = [queue.Queue(queue_size) for _ in range(max(1, workers))]
+        self.__server = ThreadingHTTPServer((host, port), self.__make_handler())
+        self.__server.daemon_threads = True
+        self.port = self.__server.server_address[1]
+
+    def __make_handler(self):
+        webhook = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.split('?')[0] != webhook.path:
+                    self.__reply(404, 'invalid')
+                    return
+                if webhook.secret_token is not None and not hmac.compare_digest(self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), webhook.secret_token):
+                    self.__reply(403, 'forbidden')
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    if length <= 0 or length > MAX_UPDATE_BYTES:
+                        self.__reply(400, 'invalid')
+                        return
+                    update = Update.de_json(json.loads(self.rfile.read(length)), webhook.dispatcher.bot)
+                except (ValueError, TypeError, KeyError) as e:
+                    logger.warning(f'Received an invalid update on the webhook: {e}')
+                    self.__reply(400, 'invalid')
+                    return
+                if update is None:
+                    self.__reply(400, 'invalid')
+                    return
+                if not webhook.enqueue(update):
+                    self.__reply(503, 'busy')
+                    return
+                self.__reply(200, 'accepted')
+
+            def __reply(self, status: int, result: str):
+                WEBHOOK_UPDATES.inc(result=result)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return WebhookHandler
+
+    # Returns False when the update's worker is busy with as many updates as it holds.
+    def enqueue(self, update: Update) -> bool:
+        chat = update.effective_chat
+        key = chat.id if chat else update.update_id
+        try:
+            self.__queues[key % len(self.__queues)].put_nowait(update)
+            return True
+        except queue.Full:
+            return False
+
+    def __work(self, updates: queue.Queue):
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            try:
+                with UPDATE_SECONDS.time():
+                    self.dispatcher.process_update(update)
+            except Exception:
+                logger.exception(f'Failed to handle update {update.update_id}.')
+
+    def start(self):
+        for i, updates in enumerate(self.__queues):
+            threading.Thread(target=self.__work, args=(updates,), name=f'webhook-worker-{i}', daemon=True).start()
+        threading.Thread(target=self.__server.serve_forever, name='webhook-server', daemon=True).start()
+        logger.info(f'Receiving updates on port {self.port} at {self.path}.')
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        for updates in self.__queues:
+            updates.put(None)
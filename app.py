@@ -1,6 +1,37 @@
-from UoMCheckinBot.checkin_bot import *
-
+# The bot is imported under the main guard, the worker processes parsing the feeds import this module again when they start.
+# usage: python app.py                     everything in one process.
+#        python app.py --shards 4          a front process handling the updates and 4 worker processes owning a shard of the users each.
+#        python app.py --shards 4 --role front / --role worker --shard 2
+#                                          one process of a sharded deployment, e.g. to run the workers on other hosts sharing the database.
+#        python app.py --mode webhook --webhook-url https://bot.example.org/telegram
+#                                          receive the updates on a webhook instead of polling, in the single or the front process.
 if __name__ == '__main__':
-    bot = UoMCheckinBot()
-    bot.dispatchTodaySessions(True)
-    bot.run()
+    import multiprocessing
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, default=1, help='number of worker processes the users are partitioned over')
+    parser.add_argument('--role', choices=['all', 'front', 'worker'], default='all', help='which processes of a sharded deployment to run')
+    parser.add_argument('--shard', type=int, default=0, help='the shard a worker owns, with --role worker')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling', help='how the updates are received')
+    parser.add_argument('--webhook-url', help='the public url Telegram posts the updates to')
+    parser.add_argument('--webhook-host', help='the address the webhook server binds to')
+    parser.add_argument('--webhook-port', type=int, help='the port the webhook server listens on')
+    parser.add_argument('--webhook-path', help='the path the webhook server accepts the updates at')
+    args = parser.parse_args()
+
+    from UoMCheckinBot.checkin_bot import *
+    intake = {'intake': args.mode, 'webhook_url': args.webhook_url or WEBHOOK_URL, 'webhook_host': args.webhook_host or WEBHOOK_HOST,
+              'webhook_port': args.webhook_port or WEBHOOK_PORT, 'webhook_path': args.webhook_path or WEBHOOK_PATH}
+    if args.shards <= 1:
+        bot = UoMCheckinBot(**intake)
+        bot.run()
+    elif args.role == 'worker':
+        run_worker(args.shard, args.shards)
+    else:
+        if args.role == 'all':
+            context = multiprocessing.get_context('spawn')
+            for shard in range(args.shards):
+                context.Process(target=run_worker, args=(shard, args.shards), name=f'shard-{shard}').start()
+        bot = UoMCheckinBot(ROLE_FRONT, shards=args.shards, **intake)
+        bot.run()
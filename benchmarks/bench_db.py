@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta, timezone
+import threading
+import tempfile
+import sqlite3
+import shutil
+import json
+import time
+import sys
+import os
+
+from UoMCheckinBot.database import Database
+from UoMCheckinBot.notify_dispatcher import NotifyDispatcher, User, UserConfig, Course, utc_iso
+from UoMCheckinBot.notify_scheduler import VirtualClock
+
+# Latency and throughput of the hot paths at a given number of users, through the shared Database layer
+# against the old way (a new connection per call, a flat Course table without indexes, rollback journal).
+# notify_lookup is what a reminder timer does to find its courses: the layer pops them from the due index resumed out of the database,
+# the old way queried the Course table for every minute.
+# usage: python -m benchmarks.bench_db [users]
+
+SESSIONS_PER_USER = 4
+
+# the teaching day starts at 9 and the dispatch has run at 6.
+def clock_of(today: datetime) -> VirtualClock:
+    return VirtualClock(today + timedelta(hours=6))
+
+def session_starts(today: datetime) -> list:
+    return [today + timedelta(hours=9 + h) for h in range(9)]
+
+def populate(path: str, users: int, today: datetime):
+    db = Database(path)
+    with db.transaction() as cur:
+        cur.executemany('INSERT INTO User VALUES (?, ?)', [(i, f'https://timetables.manchester.ac.uk/{i}') for i in range(users)])
+        cur.executemany('INSERT INTO UserConfig (tg_id, stop) VALUES (?, 0)', [(i,) for i in range(users)])
+        cur.executemany('INSERT INTO EventIndexState VALUES (?, ?)', [(i, 'hash') for i in range(users)])
+        cur.executemany('INSERT INTO Unit (id, code, name) VALUES (?, ?, ?)', [(u, f'COMP{u}', 'Unit') for u in range(300)])
+        sessions = {}
+        enrolments = []
+        for i in range(users):
+            for k in range(SESSIONS_PER_USER):
+                start = today + timedelta(hours=9 + (i + k * 2) % 9)
+                session = (i % 300, 'Lecture', utc_iso(start), utc_iso(start + timedelta(hours=1)))
+                enrolments.append((i, sessions.setdefault(session, len(sessions) + 1)))
+        cur.executemany('INSERT INTO Session (id, unit_id, type, start_time, end_time) VALUES (?, ?, ?, ?, ?)', [(sessions[s],) + s for s in sessions])
+        cur.executemany('INSERT OR IGNORE INTO Enrolment VALUES (?, ?)', enrolments)
+        cur.execute("INSERT INTO DispatchState VALUES ('dispatch_date', ?)", [clock_of(today).now().astimezone().date().isoformat()])
+    db.close()
+
+def timed(fn, count: int) -> dict:
+    latencies = []
+    for i in range(count):
+        t = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - t)
+    latencies.sort()
+    total = sum(latencies)
+    return {'ops_per_sec': count / total, 'p50_ms': latencies[len(latencies) // 2] * 1000, 'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000}
+
+def bench_layer(path: str, users: int, today: datetime, count: int) -> dict:
+    dispatcher = NotifyDispatcher(path, clock=clock_of(today))
+    dispatcher.users = {i: User(i, '', UserConfig()) for i in range(users)}
+    lead = timedelta(minutes=UserConfig().lead_minutes)
+    starts = session_starts(today)
+    results = {}
+    results['resume_dispatch'] = timed(lambda i: dispatcher.resume_dispatch(), 3)
+    results['notify_lookup'] = timed(lambda i: dispatcher.pop_due_courses(starts[i] - lead), len(starts))
+    results['notify_lookup_quiet_minute'] = timed(lambda i: dispatcher.pop_due_courses(starts[i % len(starts)] + timedelta(minutes=30) - lead), count)
+    results['is_user_indexed'] = timed(lambda i: dispatcher.is_user_indexed(i % users), count)
+    results['set_user_stop'] = timed(lambda i: dispatcher.set_user_stop(i % users), count)
+    results['mark_notified'] = timed(lambda i: dispatcher.mark_notified(Course('C', 'U', 'T', today + timedelta(hours=9), today, i % users)), count)
+    results['read_with_writer'] = with_writer(lambda: dispatcher.set_user_stop(0), lambda i: dispatcher.is_user_indexed(i % users), count)
+    dispatcher.db.close()
+    return results
+
+def bench_baseline(path: str, users: int, today: datetime, count: int) -> dict:
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    # the old flat Course table, without its indexes.
+    conn.execute('CREATE TABLE FlatCourse AS SELECT * FROM Course')
+    conn.execute('DROP VIEW Course')
+    conn.execute('ALTER TABLE FlatCourse RENAME TO Course')
+    conn.commit()
+    conn.close()
+
+    starts = session_starts(today)
+
+    def query(i, minute=0):
+        conn = sqlite3.connect(path)
+        start = starts[i % len(starts)] + timedelta(minutes=minute)
+        res = conn.execute('SELECT course_code, course_name, course_type, Course.start_time, end_time, Course.user_id from Course LEFT JOIN NotifyLog ON NotifyLog.user_id = Course.user_id AND NotifyLog.start_time = Course.start_time '
+                           'WHERE NotifyLog.user_id IS NULL AND Course.start_time >= ? AND Course.start_time < ?', [utc_iso(start), utc_iso(start + timedelta(minutes=1))])
+        courses = [Course(c[0], c[1], c[2], datetime.fromisoformat(c[3]), datetime.fromisoformat(c[4]), c[5]) for c in res.fetchall()]
+        conn.close()
+        return courses
+
+    def indexed(i):
+        conn = sqlite3.connect(path)
+        conn.execute('SELECT 1 FROM EventIndexState WHERE user_id=?', [i % users]).fetchone()
+        conn.close()
+
+    def write(sql, params):
+        conn = sqlite3.connect(path)
+        conn.execute(sql, params)
+        conn.commit()
+        conn.close()
+
+    results = {}
+    results['notify_lookup'] = timed(query, len(starts))
+    results['notify_lookup_quiet_minute'] = timed(lambda i: query(i, 30), count)
+    results['is_user_indexed'] = timed(indexed, count)
+    results['set_user_stop'] = timed(lambda i: write('UPDATE UserConfig SET stop = 1 WHERE tg_id = ?', [i % users]), count)
+    results['mark_notified'] = timed(lambda i: write('INSERT OR REPLACE INTO NotifyLog VALUES (?, ?, ?)', [i % users, utc_iso(today), utc_iso(today)]), count)
+    results['read_with_writer'] = with_writer(lambda: write('UPDATE UserConfig SET stop = 1 WHERE tg_id = ?', [0]), indexed, count)
+    return results
+
+# Times reader while another thread keeps running writer, as the Telegram handlers do while the scheduler sends reminders.
+def with_writer(writer, reader, count: int) -> dict:
+    stop = threading.Event()
+    def loop():
+        while not stop.is_set():
+            try:
+                writer()
+            except sqlite3.OperationalError:
+                pass
+    t = threading.Thread(target=loop)
+    t.start()
+    try:
+        return timed(reader, count)
+    finally:
+        stop.set()
+        t.join()
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    count = 1000
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    workdir = tempfile.mkdtemp()
+    try:
+        layer_path = os.path.join(workdir, 'layer.db')
+        baseline_path = os.path.join(workdir, 'baseline.db')
+        populate(layer_path, users, today)
+        shutil.copy(layer_path, baseline_path)
+        results = {'users': users, 'layer': bench_layer(layer_path, users, today, count), 'baseline': bench_baseline(baseline_path, users, today, count)}
+        print(json.dumps(results, indent=2))
+    finally:
+        shutil.rmtree(workdir)
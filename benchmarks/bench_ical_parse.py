@@ -0,0 +1,29 @@
+from datetime import date
+import timeit
+import json
+import sys
+
+from icalendar import Calendar
+
+from UoMCheckinBot.ical_extractor import extract_events, extract_events_icalendar
+from benchmarks.ical_feeds import generate_feed
+
+# Compares the streaming extractor against Calendar.from_ical on today's events of a semester long feed.
+# usage: python -m benchmarks.bench_ical_parse [repeat]
+
+def bench(feed: str, repeat: int) -> dict:
+    today = date.today()
+    full = timeit.timeit(lambda: extract_events_icalendar(feed, today, today), number=repeat) / repeat
+    parse_only = timeit.timeit(lambda: Calendar.from_ical(feed), number=repeat) / repeat
+    streaming = timeit.timeit(lambda: extract_events(feed, today, today), number=repeat) / repeat
+    assert extract_events(feed, today, today) == extract_events_icalendar(feed, today, today)
+    return {'feed_bytes': len(feed), 'from_ical_ms': parse_only * 1000, 'icalendar_dispatch_ms': full * 1000,
+            'streaming_ms': streaming * 1000, 'speedup': full / streaming}
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    results = {}
+    for name, kwargs in [('utc', {}), ('europe_london', {'local_time': True}), ('short_keys', {'short_keys': True}),
+                         ('full_year', {'weeks': 36, 'events_per_week': 20})]:
+        results[name] = bench(generate_feed(seed=1, **kwargs), repeat)
+    print(json.dumps(results, indent=2))
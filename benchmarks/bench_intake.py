@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
+import urllib.request
+import statistics
+import subprocess
+import argparse
+import tempfile
+import logging
+import shutil
+import copy
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.fake_telegram import FakeTelegram
+from benchmarks.run import prepare_workdir
+
+# The latency of a command, from Telegram having the update until the bot's reply arrives at Telegram, when the updates are polled
+# and when they are posted to the webhook. The bot's real handlers answer the recorded /help update of benchmarks/updates,
+# sent from `updates` different chats at `rate` updates a second against a fake Bot API with `rtt` seconds of round trip.
+# Every mode runs in its own process.
+# usage: python -m benchmarks.bench_intake [--updates 200] [--rate 20] [--rtt 0.05]
+
+SECRET = 'bench-secret'
+
+def recorded_update(update_id: int, chat_id: int) -> dict:
+    with open(os.path.join(ROOT, 'benchmarks', 'updates', 'help.json')) as f:
+        update = json.load(f)
+    update = copy.deepcopy(update)
+    update['update_id'] = update_id
+    update['message']['chat']['id'] = chat_id
+    update['message']['from']['id'] = chat_id
+    return update
+
+def post(url: str, update: dict, delay: float):
+    # the update travels from Telegram to the bot.
+    time.sleep(delay)
+    request = urllib.request.Request(url, json.dumps(update).encode('utf-8'), {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET})
+    urllib.request.urlopen(request, timeout=30).read()
+
+def run_mode(mode: str, updates: int, rate: float, rtt: float) -> dict:
+    workdir = tempfile.mkdtemp(prefix='checkin-bench-')
+    cwd = os.getcwd()
+    telegram = FakeTelegram(rtt)
+    telegram.start()
+    try:
+        prepare_workdir(workdir, 0, '')
+        with open(os.path.join(workdir, '.WEBHOOK_SECRET'), 'w') as f:
+            f.write(SECRET)
+        os.chdir(workdir)
+        logging.getLogger('checkin-bot').setLevel(logging.WARNING)
+        from UoMCheckinBot.checkin_bot import UoMCheckinBot
+        bot = UoMCheckinBot(intake=mode, webhook_url='http://127.0.0.1/telegram', webhook_host='127.0.0.1', webhook_port=0, api_url=telegram.base_url)
+        bot._UoMCheckinBot__start_polling()
+        time.sleep(0.5)
+        if mode == 'webhook':
+            url = f'http://127.0.0.1:{bot.webhook_server.port}/telegram'
+            posters = ThreadPoolExecutor(64)
+        pushed = {}
+        start = time.perf_counter()
+        for i in range(updates):
+            chat_id = 1000 + i
+            due = start + i / rate
+            time.sleep(max(0.0, due - time.perf_counter()))
+            pushed[chat_id] = time.perf_counter()
+            if mode == 'webhook':
+                posters.submit(post, url, recorded_update(i + 1, chat_id), rtt / 2)
+            else:
+                telegram.push(recorded_update(i + 1, chat_id))
+        complete = telegram.wait_sent(updates, timeout=60 + updates / rate)
+        latencies = sorted(arrived - pushed[chat_id] for chat_id, _, arrived in telegram.sent if chat_id in pushed)
+        if mode == 'webhook':
+            posters.shutdown()
+            bot.webhook_server.stop()
+            bot.tg_dispatcher.stop()
+        else:
+            bot.tg_updater.stop()
+        return {
+            'mode': mode,
+            'replies': len(latencies),
+            'complete': complete,
+            'p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000 if latencies else None,
+            'max_ms': latencies[-1] * 1000 if latencies else None,
+        }
+    finally:
+        telegram.stop()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=20.0, help='updates a second')
+    parser.add_argument('--rtt', type=float, default=0.05, help='seconds of a round trip to the Bot API')
+    parser.add_argument('--modes', nargs='+', default=['polling', 'webhook'])
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.single:
+        print(json.dumps(run_mode(args.single, args.updates, args.rate, args.rtt)))
+        os._exit(0)
+    results = []
+    for mode in args.modes:
+        cmd = [sys.executable, '-m', 'benchmarks.bench_intake', '--single', mode, '--updates', str(args.updates), '--rate', str(args.rate), '--rtt', str(args.rtt)]
+        proc = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+        if proc.returncode != 0 or not proc.stdout.strip():
+            results.append({'mode': mode, 'error': f'exited with {proc.returncode}'})
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    print(json.dumps({'updates': args.updates, 'rate': args.rate, 'rtt_s': args.rtt, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
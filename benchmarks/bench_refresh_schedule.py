@@ -0,0 +1,78 @@
+from datetime import datetime, time as dtime, timedelta
+import tempfile
+import random
+import shutil
+import json
+import sys
+import os
+
+from UoMCheckinBot.database import Database
+from UoMCheckinBot.notify_scheduler import VirtualClock
+from UoMCheckinBot.refresh_scheduler import RefreshScheduler, CHANGED, UNCHANGED, FAILED
+
+# Simulates a week of the refresh scheduler on a virtual clock, the feeds are checked every CHECK_MINUTES like the bot does.
+# Reports how many downloads every kind of feed gets, and how many are done in the busiest check against refreshing all at once.
+#   stable    changes about once a week.
+#   changing  changes on most refreshes, e.g. a timetable which is still being put together.
+#   flaky     fails half of the downloads.
+#   dead      always fails.
+# usage: python -m benchmarks.bench_refresh_schedule [users]
+
+CHECK_MINUTES = 10
+DAYS = 7
+KINDS = (('stable', 0.8), ('changing', 0.1), ('flaky', 0.07), ('dead', 0.03))
+
+def outcome(kind: str, rnd: random.Random) -> str:
+    if kind == 'dead' or (kind == 'flaky' and rnd.random() < 0.5):
+        return FAILED
+    if kind == 'changing':
+        return CHANGED if rnd.random() < 0.7 else UNCHANGED
+    return CHANGED if rnd.random() < 1 / 7 else UNCHANGED
+
+def main(users: int) -> dict:
+    rnd = random.Random(0)
+    kinds = {}
+    for tg_id in range(users):
+        r = rnd.random()
+        for kind, share in KINDS:
+            r -= share
+            if r < 0:
+                break
+        kinds[tg_id] = kind
+
+    workdir = tempfile.mkdtemp(prefix='checkin-bench-')
+    try:
+        db = Database(os.path.join(workdir, 'bot-database.db'))
+        start = datetime.combine(datetime.now().date(), dtime(0, 0)).astimezone()
+        clock = VirtualClock(start)
+        scheduler = RefreshScheduler(db, clock)
+        downloads = {kind: 0 for kind, _ in KINDS}
+        busiest = 0
+        by_hour = [0] * 24
+        # every feed is cached already, so none is due at once.
+        cached = set(kinds)
+        while clock.now() < start + timedelta(days=DAYS):
+            due = scheduler.due(kinds, cached)
+            scheduler.record({tg_id: outcome(kinds[tg_id], rnd) for tg_id in due})
+            for tg_id in due:
+                downloads[kinds[tg_id]] += 1
+            by_hour[clock.now().hour] += len(due)
+            busiest = max(busiest, len(due))
+            clock.advance(timedelta(minutes=CHECK_MINUTES))
+        counts = {kind: sum(1 for k in kinds.values() if k == kind) for kind, _ in KINDS}
+        db.close()
+        return {
+            'users': users,
+            'days': DAYS,
+            'downloads_per_feed_per_day': {kind: downloads[kind] / counts[kind] / DAYS for kind in counts if counts[kind]},
+            'downloads_total': sum(downloads.values()),
+            'downloads_nightly_all_at_once': users * DAYS,
+            'busiest_check': busiest,
+            'busiest_check_all_at_once': users,
+            'downloads_by_hour': by_hour,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    print(json.dumps(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000), indent=2))
@@ -0,0 +1,99 @@
+from datetime import datetime, time as dtime
+import multiprocessing
+import argparse
+import tempfile
+import logging
+import shutil
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.feed_server import start_server_process
+from benchmarks.fake_bot import FakeBot
+from benchmarks.run import prepare_workdir, bench_day
+
+# Runs the work of the shard workers for the same users with 1, 2, 4... shards, every shard in its own process on a shared database:
+# the cold refresh of the shard's feeds, its dispatch and the sending of every reminder of the day to a fake bot.
+# The wall time is the one of the slowest shard, the speedup can't exceed the number of cores the machine has.
+# usage: python -m benchmarks.bench_shards [--users 2000] [--shards 1 2 4] [--latency 0.01] [--bot-latency 0.01]
+
+def run_shard(workdir: str, shard: int, shards: int, day, bot_latency: float, ready, start, results):
+    os.chdir(workdir)
+    logging.getLogger('checkin-bot').setLevel(logging.WARNING)
+    from UoMCheckinBot.checkin_bot import ICAL_FETCH_WORKERS, ICAL_FETCH_TIMEOUT, ICAL_REFRESH_BATCH, SEND_WORKERS
+    from UoMCheckinBot.notify_dispatcher import NotifyDispatcher
+    from UoMCheckinBot.notify_scheduler import VirtualClock
+    from UoMCheckinBot.send_pipeline import SendPipeline
+    from UoMCheckinBot.ical_fetcher import ICalFetcher
+    from UoMCheckinBot.parse_pool import ParsePool
+
+    clock = VirtualClock(datetime.combine(day, dtime(6, 0)).astimezone())
+    dispatcher = NotifyDispatcher('./db/bot-database.db', ICalFetcher(ICAL_FETCH_WORKERS, ICAL_FETCH_TIMEOUT), clock, ParsePool(1),
+                                  ICAL_REFRESH_BATCH, shard=(shard, shards))
+    fake_bot = FakeBot(bot_latency)
+    pipeline = SendPipeline(fake_bot, workers=SEND_WORKERS, global_rate=1e9, chat_rate=1e9, wall_clock=clock.now)
+    ready.put(shard)
+    start.wait()
+    t = time.perf_counter()
+    dispatcher.load_all_users_calendars(fetch_local=False)
+    refreshed = time.perf_counter()
+    dispatcher.dispatchAll()
+    pipeline.start()
+    for when in dispatcher.due_index.due_times():
+        for course in dispatcher.due_index.pop_due(when):
+            pipeline.send(course.user_id, f'{course.code} {course.start}', session_start=course.start)
+    pipeline.join()
+    done = time.perf_counter()
+    pipeline.stop()
+    dispatcher.fetcher.close()
+    results.put({'shard': shard, 'users': len(dispatcher.users), 'refresh_s': refreshed - t, 'dispatch_send_s': done - refreshed,
+                 'wall_s': done - t, 'sent': fake_bot.sent})
+
+def run_fleet(users: int, shards: int, feed_url: str, day, bot_latency: float) -> dict:
+    workdir = tempfile.mkdtemp(prefix='checkin-bench-')
+    try:
+        prepare_workdir(workdir, users, feed_url)
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        results = context.Queue()
+        start = context.Event()
+        processes = [context.Process(target=run_shard, args=(workdir, i, shards, day, bot_latency, ready, start, results)) for i in range(shards)]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            ready.get(timeout=120)
+        t = time.perf_counter()
+        start.set()
+        per_shard = sorted((results.get() for _ in processes), key=lambda r: r['shard'])
+        wall = time.perf_counter() - t
+        for process in processes:
+            process.join()
+        return {'shards': shards, 'wall_s': wall, 'users_per_s': users / wall, 'sent': sum(r['sent'] for r in per_shard), 'per_shard': per_shard}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds the feed server takes for every response')
+    parser.add_argument('--bot-latency', type=float, default=0.01, help='seconds every fake send_message takes')
+    args = parser.parse_args()
+    day = bench_day()
+    server, feed_url = start_server_process(args.latency, 0.0, 200, day)
+    try:
+        runs = [run_fleet(args.users, shards, feed_url, day, args.bot_latency) for shards in args.shards]
+    finally:
+        server.terminate()
+    base = runs[0]['wall_s']
+    for run in runs:
+        run['speedup'] = base / run['wall_s']
+    print(json.dumps({'users': args.users, 'cpus': os.cpu_count(), 'feed_latency_s': args.latency, 'bot_latency_s': args.bot_latency, 'runs': runs}, indent=2))
+
+if __name__ == '__main__':
+    main()
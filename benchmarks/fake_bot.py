@@ -0,0 +1,18 @@
+import threading
+import time
+
+# A stand-in for telegram.Bot which only records what would have been sent.
+# latency: seconds every send_message call takes, like a round trip to the Bot API.
+class FakeBot:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent = 0
+        self.chats = set()
+        self.__lock = threading.Lock()
+
+    def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.__lock:
+            self.sent += 1
+            self.chats.add(chat_id)
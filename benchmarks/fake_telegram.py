@@ -0,0 +1,103 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qsl
+import threading
+import json
+import time
+
+# A local stand-in for the Bot API server, enough of it for the bot to poll getUpdates and to send its replies.
+# rtt: seconds of every round trip, half of it is spent before a request is handled and half before its response arrives,
+# like the network between the bot and Telegram.
+
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+class FakeTelegram:
+    def __init__(self, rtt: float = 0.0):
+        self.rtt = rtt
+        self.__updates = []
+        # (chat_id, text, arrival time) of every sendMessage.
+        self.sent = []
+        self.__cond = threading.Condition()
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), self.__make_handler())
+        self.__server.daemon_threads = True
+        self.port = self.__server.server_address[1]
+        self.base_url = f'http://127.0.0.1:{self.port}/bot'
+
+    # Makes the update available to getUpdates.
+    def push(self, update: dict):
+        with self.__cond:
+            self.__updates.append(update)
+            self.__cond.notify_all()
+
+    def wait_sent(self, count: int, timeout: float) -> bool:
+        with self.__cond:
+            return self.__cond.wait_for(lambda: len(self.sent) >= count, timeout)
+
+    def __get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self.__cond:
+            while True:
+                self.__updates = [u for u in self.__updates if u['update_id'] >= offset]
+                if self.__updates or time.monotonic() >= deadline:
+                    return self.__updates[:int(params.get('limit') or 100)]
+                self.__cond.wait(deadline - time.monotonic())
+
+    def call(self, method: str, params: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self.__get_updates(params)
+        if method in ('deleteWebhook', 'setWebhook'):
+            return True
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            with self.__cond:
+                self.sent.append((chat_id, params.get('text'), time.perf_counter()))
+                message_id = len(self.sent)
+                self.__cond.notify_all()
+            return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text')}
+        return None
+
+    def __make_handler(self):
+        telegram = self
+
+        class ApiHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.__handle({})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = dict(parse_qsl(body.decode('utf-8')))
+                self.__handle(params)
+
+            def __handle(self, params: dict):
+                path, _, query = self.path.partition('?')
+                params.update(parse_qsl(query))
+                if telegram.rtt > 0:
+                    time.sleep(telegram.rtt / 2)
+                result = telegram.call(path.rsplit('/', 1)[-1], params)
+                if telegram.rtt > 0:
+                    time.sleep(telegram.rtt / 2)
+                body = json.dumps({'ok': True, 'result': result} if result is not None else {'ok': False, 'error_code': 404, 'description': 'Not Found'}).encode('utf-8')
+                self.send_response(200 if result is not None else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return ApiHandler
+
+    def start(self):
+        threading.Thread(target=self.__server.serve_forever, name='fake-telegram', daemon=True).start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
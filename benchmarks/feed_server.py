@@ -0,0 +1,106 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import date
+import multiprocessing
+import argparse
+import hashlib
+import random
+import time
+import sys
+
+from benchmarks.ical_feeds import generate_feed
+
+# A local stand-in for timetables.manchester.ac.uk, serves /feed/<n> with an ETag and answers conditional GETs with 304.
+# Only `distinct` different feeds are generated, feed n is feed n % distinct, so a server for 10k users stays small.
+# usage: python -m benchmarks.feed_server [--port 8000] [--latency 0.01] [--error-rate 0]
+
+# The shape of feed n, so the users' timetables vary in length, term and description format.
+def feed_kwargs(n: int) -> dict:
+    rnd = random.Random(n)
+    return {'events_per_week': rnd.randint(8, 25), 'weeks': rnd.choice([10, 12, 12, 14]), 'short_keys': n % 3 == 0, 'local_time': n % 2 == 0}
+
+class FeedCache:
+    def __init__(self, distinct: int, today: date = None):
+        self.distinct = distinct
+        self.today = today
+        self.__feeds = {}
+
+    def get(self, n: int):
+        n %= self.distinct
+        feed = self.__feeds.get(n)
+        if feed is None:
+            body = generate_feed(seed=n, term_center=self.today, **feed_kwargs(n)).encode('utf-8')
+            feed = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+            self.__feeds[n] = feed
+        return feed
+
+def make_handler(cache: FeedCache, latency: float, error_rate: float, seed: int):
+    rnd = random.Random(seed)
+
+    class FeedHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if latency > 0:
+                time.sleep(latency)
+            parts = self.path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'feed' or not parts[1].isdigit():
+                self.__empty(404)
+                return
+            if error_rate > 0 and rnd.random() < error_rate:
+                self.__empty(503)
+                return
+            body, etag = cache.get(int(parts[1]))
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/calendar; charset=utf-8')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def __empty(self, status: int):
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return FeedHandler
+
+class FeedServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # clients which only read the start of a feed (the /setup verification) hang up early, that's not an error.
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+def serve(port: int, latency: float = 0.0, error_rate: float = 0.0, distinct: int = 200, today: date = None, seed: int = 0, ready=None):
+    server = FeedServer(('127.0.0.1', port), make_handler(FeedCache(distinct, today), latency, error_rate, seed))
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+# Runs the server in its own process so it neither competes for the GIL with nor adds to the memory of the measured process.
+# Returns the process and the base url of the feeds, terminate the process when done.
+def start_server_process(latency: float = 0.0, error_rate: float = 0.0, distinct: int = 200, today: date = None, port: int = 0):
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(port, latency, error_rate, distinct, today, 0, ready), daemon=True)
+    process.start()
+    port = ready.get(timeout=30)
+    return process, f'http://127.0.0.1:{port}/feed/'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--distinct', type=int, default=200, help='number of different feeds')
+    args = parser.parse_args()
+    serve(args.port, args.latency, args.error_rate, args.distinct)
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, date
+import random
+
+# Generates synthetic timetable feeds shaped like the ones exported by timetables.manchester.ac.uk.
+
+UNIT_NAMES = ['Fundamentals of Computation', 'Programming 1', 'Algorithms and Data Structures', 'Computer Architecture',
+              'Software Engineering', 'Mathematical Techniques for Computer Science', 'Database Systems', 'Operating Systems',
+              'Machine Learning', 'Distributed Computing', 'Compilers', 'Computer Graphics']
+EVENT_TYPES = ['Lecture', 'Laboratory', 'Tutorial', 'Workshop', 'Examples Class']
+
+VTIMEZONE = ['BEGIN:VTIMEZONE', 'TZID:Europe/London',
+             'BEGIN:DAYLIGHT', 'TZOFFSETFROM:+0000', 'TZOFFSETTO:+0100', 'TZNAME:BST', 'DTSTART:19700329T010000',
+             'RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU', 'END:DAYLIGHT',
+             'BEGIN:STANDARD', 'TZOFFSETFROM:+0100', 'TZOFFSETTO:+0000', 'TZNAME:GMT', 'DTSTART:19701025T020000',
+             'RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU', 'END:STANDARD', 'END:VTIMEZONE']
+
+def fold(line: str) -> list:
+    out = []
+    while len(line) > 75:
+        out.append(line[:75])
+        line = ' ' + line[75:]
+    out.append(line)
+    return out
+
+def escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+# events_per_week: sessions of the student in one week.
+# weeks: term length, the term is centered on term_center (today by default) so there is always something to dispatch.
+# short_keys: use the "Code"/"Description" description keys instead of "Unit Code"/"Unit Description", both exist in the wild.
+# local_time: write DTSTART/DTEND with TZID=Europe/London instead of UTC.
+def generate_feed(seed: int = 0, events_per_week: int = 15, weeks: int = 12, short_keys: bool = False, local_time: bool = False, term_center: date = None) -> str:
+    rnd = random.Random(seed)
+    term_center = term_center if term_center else date.today()
+    term_start = term_center - timedelta(days=7 * (weeks // 2) + term_center.weekday())
+    units = rnd.sample(range(len(UNIT_NAMES)), 5)
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Scientia Ltd//Syllabus Plus Timetables//EN', 'CALSCALE:GREGORIAN',
+             'METHOD:PUBLISH', f'X-WR-CALNAME:Timetable {seed}']
+    if local_time:
+        lines.extend(VTIMEZONE)
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    for week in range(weeks):
+        for i in range(events_per_week):
+            day = term_start + timedelta(days=7 * week + rnd.randrange(5))
+            start = datetime(day.year, day.month, day.day, rnd.randrange(9, 18), rnd.choice([0, 0, 0, 30]))
+            end = start + timedelta(hours=rnd.choice([1, 1, 2]))
+            unit = units[rnd.randrange(len(units))]
+            code = f'COMP{10000 + unit * 110:05d}'
+            name = UNIT_NAMES[unit]
+            event_type = rnd.choice(EVENT_TYPES)
+            desc = '\n'.join([
+                f'{"Code" if short_keys else "Unit Code"}: {code}',
+                f'{"Description" if short_keys else "Unit Description"}: {name}',
+                f'Event type: {event_type}',
+                f'Staff member(s): Dr Staff {rnd.randrange(40)}',
+                f'Location: Kilburn Building, Room {rnd.randrange(1, 4)}.{rnd.randrange(1, 30)}',
+                'Notes: Please check in using the My Manchester app.',
+                ''])
+            if local_time:
+                dtstart = f'DTSTART;TZID=Europe/London:{start:%Y%m%dT%H%M%S}'
+                dtend = f'DTEND;TZID=Europe/London:{end:%Y%m%dT%H%M%S}'
+            else:
+                dtstart = f'DTSTART:{start:%Y%m%dT%H%M%SZ}'
+                dtend = f'DTEND:{end:%Y%m%dT%H%M%SZ}'
+            lines.extend(['BEGIN:VEVENT', f'UID:{seed}-{week}-{i}@timetables.manchester.ac.uk', f'DTSTAMP:{stamp}', dtstart, dtend,
+                          f'SUMMARY:{code}/{event_type}'])
+            lines.extend(fold(f'LOCATION:Kilburn Building\\, Room {rnd.randrange(1, 4)}.{rnd.randrange(1, 30)}'))
+            lines.extend(fold(f'DESCRIPTION:{escape(desc)}'))
+            lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines) + '\r\n'
@@ -0,0 +1,220 @@
+from datetime import datetime, date, time as dtime, timedelta
+import subprocess
+import tracemalloc
+import argparse
+import resource
+import tempfile
+import logging
+import shutil
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.feed_server import start_server_process
+from benchmarks.fake_bot import FakeBot
+
+# Times the hot paths of the bot end to end at several numbers of users, against the local feed server, a fake Telegram bot
+# and a fresh SQLite database in a temporary working directory:
+#   load_cold       load_all_users_calendars, every feed downloaded, written and parsed.
+#   load_warm       load_all_users_calendars again, every feed answered with 304.
+#   load_local      load_all_users_calendars(fetch_local=True), the startup path with an up to date index.
+#   load_local_reindex  the same with an empty index, so every cached feed is parsed again.
+#   dispatch_all    dispatchAll on a new day, then dispatch_all_same_day without any changed feed.
+#   restart_resume  a restarted dispatcher picking today's dispatch up from the database.
+#   check_and_send_notifies  every due timer of the day fired in order, until the fake bot has received every reminder.
+# Every scale runs in its own process, so its peak memory (ru_maxrss) is its own.
+# usage: python -m benchmarks.run [--scales 100 1000 10000] [--latency 0.01] [--error-rate 0] [--out results.json] [--tracemalloc]
+
+FAKE_TOKEN = '123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi'
+
+class Stages:
+    def __init__(self, trace: bool):
+        self.trace = trace
+        self.results = {}
+
+    # items: how many users/queries/messages the stage handles, for the throughput.
+    def run(self, name: str, fn, items=None):
+        if self.trace:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            out = fn()
+        except Exception as e:
+            self.results[name] = {'error': repr(e)}
+            return None
+        wall = time.perf_counter() - start
+        result = {'wall_s': wall}
+        count = items(out) if callable(items) else items
+        if count is not None:
+            result['items'] = count
+            result['throughput_per_s'] = count / wall if wall > 0 else None
+        if self.trace:
+            result['tracemalloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        self.results[name] = result
+        return out
+
+# (files, MB) of the cached feeds under ical/.
+def feed_cache_usage(workdir: str) -> tuple:
+    files = 0
+    size = 0
+    for dirpath, _, filenames in os.walk(os.path.join(workdir, 'ical')):
+        for name in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return files, size / 2 ** 20
+
+def prepare_workdir(workdir: str, users: int, feed_url: str):
+    for d in ('ical', 'db', 'logs'):
+        os.makedirs(os.path.join(workdir, d))
+    with open(os.path.join(workdir, '.TOKEN'), 'w') as f:
+        f.write(FAKE_TOKEN)
+    from UoMCheckinBot.database import Database
+    db = Database(os.path.join(workdir, 'db', 'bot-database.db'))
+    with db.transaction() as cur:
+        cur.executemany('INSERT INTO User VALUES (?, ?)', [(i, f'{feed_url}{i}') for i in range(users)])
+        cur.executemany('INSERT INTO UserConfig (tg_id, stop) VALUES (?, 0)', [(i,) for i in range(users)])
+    db.close()
+
+# The day the benchmark pretends it is, the synthetic terms have no weekend sessions so it's the next weekday.
+def bench_day() -> date:
+    day = date.today()
+    while day.weekday() >= 5:
+        day += timedelta(days=1)
+    return day
+
+def run_scale(users: int, feed_url: str, day: date, bot_latency: float, trace: bool, parse_workers: int = None) -> dict:
+    workdir = tempfile.mkdtemp(prefix='checkin-bench-')
+    cwd = os.getcwd()
+    try:
+        prepare_workdir(workdir, users, feed_url)
+        # checkin_bot reads .TOKEN and opens its log file relative to the working directory when it's imported.
+        os.chdir(workdir)
+        from UoMCheckinBot.checkin_bot import UoMCheckinBot, SEND_WORKERS
+        from UoMCheckinBot.notify_scheduler import VirtualClock
+        from UoMCheckinBot.send_pipeline import SendPipeline
+        from UoMCheckinBot.parse_pool import ParsePool
+        from UoMCheckinBot.notify_dispatcher import NotifyDispatcher
+
+        clock = VirtualClock(datetime.combine(day, dtime(6, 0)).astimezone())
+        bot = UoMCheckinBot()
+        bot.notify_dispatcher.clock = clock
+        bot.timer_engine.clock = clock
+        fake_bot = FakeBot(bot_latency)
+        # the rate limits are lifted, this measures the bot and not Telegram's flood limits.
+        bot.send_pipeline = SendPipeline(fake_bot, workers=SEND_WORKERS, global_rate=1e9, chat_rate=1e9, wall_clock=clock.now)
+        bot.send_pipeline.start()
+        dispatcher = bot.notify_dispatcher
+        if parse_workers:
+            dispatcher.parse_pool = ParsePool(parse_workers, dispatcher.parse_pool.chunksize)
+
+        if trace:
+            tracemalloc.start()
+        stages = Stages(trace)
+        stages.run('load_cold', lambda: dispatcher.load_all_users_calendars(fetch_local=False), users)
+        cold_report = dict(dispatcher.refresh_report)
+        stages.run('load_warm', lambda: dispatcher.load_all_users_calendars(fetch_local=False), users)
+        warm_report = dict(dispatcher.refresh_report)
+        stages.run('load_local', lambda: dispatcher.load_all_users_calendars(fetch_local=True), users)
+        dispatcher.db.execute('DELETE FROM EventIndexState')
+        stages.run('load_local_reindex', lambda: dispatcher.load_all_users_calendars(fetch_local=True), users)
+        stages.run('dispatch_all', dispatcher.dispatchAll, users)
+        stages.run('dispatch_all_same_day', dispatcher.dispatchAll, users)
+        def restart():
+            restarted = NotifyDispatcher(dispatcher.db, dispatcher.fetcher, clock)
+            restarted.load_users()
+            restarted.resume_dispatch()
+            return restarted
+        restarted = stages.run('restart_resume', restart, users)
+
+        due_times = dispatcher.due_index.due_times()
+        def fire_all():
+            # every batch is delivered before the clock moves on, so the pipeline sees the time the reminders would really be sent at.
+            for when in due_times:
+                clock.set(when)
+                bot._UoMCheckinBot__check_and_send_notifies(when)
+                bot.send_pipeline.join()
+            return fake_bot.sent
+        sent = stages.run('check_and_send_notifies', fire_all, lambda sent: sent)
+        if trace:
+            tracemalloc.stop()
+
+        bot.send_pipeline.stop()
+        dispatcher.fetcher.close()
+        dispatcher.parse_pool.close()
+        counts = {
+            'events_indexed': dispatcher.db.execute('SELECT COUNT(*) FROM EventIndex').fetchone()[0],
+            'courses_dispatched': dispatcher.db.execute('SELECT COUNT(*) FROM Course').fetchone()[0],
+            'sessions_dispatched': dispatcher.db.execute('SELECT COUNT(*) FROM Session').fetchone()[0],
+            'due_times': len(due_times),
+            'resumed_due_times': len(restarted.due_index.due_times()) if restarted else None,
+            'reminders_sent': sent,
+            'feed_cache_files': feed_cache_usage(workdir)[0],
+            'feed_cache_mb': feed_cache_usage(workdir)[1],
+        }
+        dispatcher.db.close()
+        return {
+            'users': users,
+            'stages': stages.results,
+            'refresh_reports': {'cold': cold_report, 'warm': warm_report},
+            'counts': counts,
+            'send_stats': bot.send_pipeline.stats,
+            # kilobytes on Linux.
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds the feed server takes for every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of feed requests answered with 503')
+    parser.add_argument('--distinct', type=int, default=200, help='number of different feeds served')
+    parser.add_argument('--bot-latency', type=float, default=0.0, help='seconds every fake send_message takes')
+    parser.add_argument('--parse-workers', type=int, help='worker processes parsing the feeds, the bot\'s default when not given')
+    parser.add_argument('--tracemalloc', action='store_true', help='also report the peak of Python allocations of every stage')
+    parser.add_argument('--out', help='write the results to this file as well')
+    # internal, runs one scale against a running feed server and prints its results.
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--feed-url', help=argparse.SUPPRESS)
+    parser.add_argument('--day', type=date.fromisoformat, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.getLogger('checkin-bot').setLevel(logging.WARNING)
+
+    if args.single:
+        print(json.dumps(run_scale(args.single, args.feed_url, args.day, args.bot_latency, args.tracemalloc, args.parse_workers)))
+        return
+
+    day = bench_day()
+    server, feed_url = start_server_process(args.latency, args.error_rate, args.distinct, day)
+    results = {'started_at': datetime.now().astimezone().isoformat(), 'day': day.isoformat(), 'python': sys.version.split()[0],
+               'feed_latency_s': args.latency, 'feed_error_rate': args.error_rate, 'distinct_feeds': args.distinct,
+               'bot_latency_s': args.bot_latency, 'parse_workers': args.parse_workers, 'cpus': os.cpu_count(), 'scales': []}
+    try:
+        for users in args.scales:
+            cmd = [sys.executable, '-m', 'benchmarks.run', '--single', str(users), '--feed-url', feed_url, '--day', day.isoformat(), '--bot-latency', str(args.bot_latency)]
+            if args.tracemalloc:
+                cmd.append('--tracemalloc')
+            if args.parse_workers:
+                cmd.extend(['--parse-workers', str(args.parse_workers)])
+            proc = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+            if proc.returncode != 0 or not proc.stdout.strip():
+                results['scales'].append({'users': users, 'error': f'exited with {proc.returncode}'})
+                continue
+            results['scales'].append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    finally:
+        server.terminate()
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+from datetime import date
+import threading
+import socket
+
+from benchmarks.feed_server import FeedServer, FeedCache, make_handler
+
+# The local feed server of the benchmarks, run on a thread of the test process.
+class FeedServerThread:
+    def __init__(self, latency: float = 0.0, distinct: int = 10):
+        self.cache = FeedCache(distinct, date(2026, 10, 19))
+        self.server = FeedServer(('127.0.0.1', 0), make_handler(self.cache, latency, 0.0, 0))
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/feed/'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def closed_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
@@ -0,0 +1,124 @@
+from datetime import datetime, timedelta, timezone
+import threading
+import unittest
+import tempfile
+import sqlite3
+import shutil
+import os
+
+from UoMCheckinBot.database import Database, MIGRATIONS
+from UoMCheckinBot.feed_store import FeedStore
+from UoMCheckinBot.notify_dispatcher import NotifyDispatcher, utc_iso
+from UoMCheckinBot.notify_scheduler import VirtualClock
+from UoMCheckinBot.parse_pool import ParsePool
+
+NOW = datetime(2026, 10, 19, 6, 0, tzinfo=timezone.utc)
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    # starts the bot on the database as far as resuming today's dispatch, returns whether it resumed.
+    def resume(self, db: Database) -> bool:
+        dispatcher = NotifyDispatcher(db, clock=VirtualClock(NOW), parse_pool=ParsePool(workers=1), feed_store=FeedStore(os.path.join(self.workdir, 'ical')))
+        try:
+            self.assertTrue(dispatcher.load_users())
+            self.assertEqual(set(dispatcher.users), {1, 2})
+            self.assertTrue(dispatcher.users[2].config.stop)
+            return dispatcher.resume_dispatch()
+        finally:
+            dispatcher.fetcher.close()
+
+    def test_migrates_a_baseline_database(self):
+        # the schema before the versioning, the hour of the day is stored as an integer.
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE User (tg_id INTEGER PRIMARY KEY, ical_address TEXT)')
+        conn.execute('CREATE TABLE UserConfig (tg_id INTEGER PRIMARY KEY, stop INTEGER)')
+        conn.execute('CREATE TABLE Course (course_code TEXT, course_name TEXT, course_type TEXT, start_time INTEGER, end_time INTEGER, user_id INTEGER)')
+        conn.executemany('INSERT INTO User VALUES (?, ?)', [(1, 'http://feed/1'), (2, 'http://feed/2')])
+        conn.executemany('INSERT INTO UserConfig VALUES (?, ?)', [(1, 0), (2, 1)])
+        conn.executemany("INSERT INTO Course VALUES ('COMP10120', 'First Year Team Project', 'Lecture', ?, ?, ?)", [(9, 10, 1), (9, 10, 2), (14, 16, 1)])
+        conn.commit()
+        conn.close()
+        db = Database(self.path)
+        self.assertEqual(db.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM Session').fetchone()[0], 0)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM Course').fetchone()[0], 0)
+        self.assertFalse(self.resume(db))
+        db.close()
+
+    def test_migrates_hour_based_rows_dispatched_today(self):
+        # a database of the versions before the catalogue, dispatched today, with hour-based rows the old dispatch left behind.
+        conn = sqlite3.connect(self.path)
+        for migration in MIGRATIONS[:6]:
+            migration(conn.cursor())
+        conn.execute('PRAGMA user_version=6')
+        conn.executemany('INSERT INTO User VALUES (?, ?)', [(1, 'http://feed/1'), (2, 'http://feed/2')])
+        conn.executemany('INSERT INTO UserConfig (tg_id, stop) VALUES (?, ?)', [(1, 0), (2, 1)])
+        start = NOW + timedelta(hours=6)
+        conn.executemany("INSERT INTO Course VALUES ('COMP10120', 'First Year Team Project', 'Lecture', ?, ?, ?)",
+                         [(9, 10, 1), (utc_iso(start), utc_iso(start + timedelta(hours=1)), 1), (utc_iso(start), utc_iso(start + timedelta(hours=1)), 2)])
+        conn.execute("INSERT INTO DispatchState VALUES ('dispatch_date', ?)", [NOW.astimezone().date().isoformat()])
+        conn.commit()
+        conn.close()
+        db = Database(self.path)
+        self.assertEqual(db.execute('SELECT user_id, start_time FROM Course ORDER BY user_id').fetchall(), [(1, utc_iso(start)), (2, utc_iso(start))])
+        # some of today's rows couldn't be kept, so today isn't resumed but dispatched again.
+        self.assertFalse(self.resume(db))
+        db.close()
+
+    def test_hour_based_sessions_are_dropped(self):
+        db = Database(self.path)
+        with db.transaction() as cur:
+            cur.execute("INSERT INTO Unit VALUES (1, 'COMP10120', 'First Year Team Project')")
+            # an hour-based session copied over from the old Course table, and an ISO one.
+            cur.executemany('INSERT INTO Session VALUES (?, 1, ?, ?, ?)', [(1, 'Lecture', 9, 10), (2, 'Lab', '2026-10-19T09:00:00+00:00', '2026-10-19T10:00:00+00:00')])
+            cur.executemany('INSERT INTO Enrolment VALUES (?, ?)', [(100, 1), (100, 2), (101, 1)])
+            cur.executemany('INSERT INTO DispatchState VALUES (?, ?)', [('dispatch_date', '2026-10-19'), ('other', 'kept')])
+            cur.execute(f'PRAGMA user_version={len(MIGRATIONS) - 1}')
+        db.close()
+        db = Database(self.path)
+        self.assertEqual(db.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(db.execute('SELECT id FROM Session').fetchall(), [(2,)])
+        self.assertEqual(db.execute('SELECT user_id, session_id FROM Enrolment').fetchall(), [(100, 2)])
+        # today is dispatched again, the dropped sessions are read from the feeds once more.
+        self.assertEqual(db.execute('SELECT key FROM DispatchState').fetchall(), [('other',)])
+        db.close()
+
+class ConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.workdir, 'test.db'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.workdir)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc/self/fd')
+    def test_connections_of_finished_threads_are_closed(self):
+        self.db.execute('SELECT 1')
+        fds = len(os.listdir('/proc/self/fd'))
+        for _ in range(200):
+            thread = threading.Thread(target=self.db.execute, args=['SELECT COUNT(*) FROM User'])
+            thread.start()
+            thread.join()
+        self.assertLessEqual(len(os.listdir('/proc/self/fd')), fds + 3)
+        # the connection of the running thread is kept.
+        self.assertEqual(self.db.execute('SELECT 1').fetchone(), (1,))
+
+    def test_close_is_idempotent(self):
+        thread = threading.Thread(target=self.db.execute, args=['SELECT 1'])
+        self.db.execute('SELECT 1')
+        thread.start()
+        thread.join()
+        self.db.close()
+        self.db.close()
+        # a new connection is opened after closing.
+        self.assertEqual(self.db.execute('SELECT 1').fetchone(), (1,))
+
+if __name__ == '__main__':
+    unittest.main()
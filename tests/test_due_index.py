@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta, timezone
+import unittest
+
+from UoMCheckinBot.notify_dispatcher import DueIndex, Course
+
+NINE = datetime(2026, 10, 19, 9, 0, tzinfo=timezone.utc)
+ELEVEN = NINE + timedelta(hours=2)
+
+def course(start: datetime, user_id: int) -> Course:
+    return Course('COMP10120', 'First Year Team Project', 'Lecture', start, start + timedelta(hours=1), user_id)
+
+class DueIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = DueIndex()
+        self.index.set_user_courses(1, [course(NINE, 1), course(ELEVEN, 1)], 10, False)
+        self.index.set_user_courses(2, [course(NINE, 2)], 10, False)
+
+    def test_buckets_by_start_minus_lead(self):
+        self.assertEqual(self.index.due_times(), [NINE - timedelta(minutes=10), ELEVEN - timedelta(minutes=10)])
+        due = self.index.pop_due(NINE - timedelta(minutes=10))
+        self.assertEqual(sorted(c.user_id for c in due), [1, 2])
+        self.assertEqual(self.index.due_times(), [ELEVEN - timedelta(minutes=10)])
+        self.assertEqual(self.index.pop_due(NINE - timedelta(minutes=10)), [])
+
+    def test_stop_and_resume(self):
+        self.index.stop_user(1)
+        self.assertEqual(self.index.due_times(), [NINE - timedelta(minutes=10)])
+        self.assertEqual(self.index.due_times([1]), [])
+        self.assertTrue(self.index.has_user(1))
+        self.index.resume_user(1, 10)
+        self.assertEqual(self.index.due_times([1]), [NINE - timedelta(minutes=10), ELEVEN - timedelta(minutes=10)])
+
+    def test_stopped_users_are_not_bucketed(self):
+        self.index.set_user_courses(3, [course(NINE, 3)], 10, True)
+        due = self.index.pop_due(NINE - timedelta(minutes=10))
+        self.assertEqual(sorted(c.user_id for c in due), [1, 2])
+
+    def test_lead_time_change_moves_the_reminders(self):
+        self.index.resume_user(1, 30)
+        self.assertEqual(self.index.due_times([1]), [NINE - timedelta(minutes=30), ELEVEN - timedelta(minutes=30)])
+        self.assertEqual([c.user_id for c in self.index.pop_due(NINE - timedelta(minutes=10))], [2])
+        self.assertEqual([c.user_id for c in self.index.pop_due(NINE - timedelta(minutes=30))], [1])
+
+    def test_popped_courses_are_not_bucketed_again(self):
+        self.index.pop_due(NINE - timedelta(minutes=10))
+        self.index.resume_user(1, 5)
+        self.assertEqual(self.index.due_times([1]), [ELEVEN - timedelta(minutes=5)])
+        self.assertEqual(self.index.due_times([2]), [])
+
+    def test_set_user_courses_replaces_the_old_ones(self):
+        self.index.set_user_courses(1, [], 10, False)
+        self.assertEqual(self.index.due_times([1]), [])
+        self.assertEqual([c.user_id for c in self.index.pop_due(NINE - timedelta(minutes=10))], [2])
+        self.assertEqual(self.index.due_times(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from UoMCheckinBot.database import Database
+from UoMCheckinBot.feed_store import FeedStore
+from UoMCheckinBot.notify_dispatcher import NotifyDispatcher
+from UoMCheckinBot.parse_pool import ical_hash
+
+FEED = 'BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nSUMMARY:Lecture\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n'
+
+class FeedStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.workdir, 'ical')
+        self.store = FeedStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_put_is_content_addressed(self):
+        content_hash = self.store.put(FEED)
+        self.assertEqual(content_hash, ical_hash(FEED))
+        self.assertEqual(self.store.put(FEED), content_hash)
+        self.assertEqual(self.store.read(content_hash), FEED)
+        self.assertEqual(len(os.listdir(os.path.dirname(self.store.path(content_hash)))), 1)
+
+    def test_collect_garbage_keeps_referenced_blobs(self):
+        kept = self.store.put(FEED)
+        dropped = self.store.put(FEED + ' ')
+        removed, _ = self.store.collect_garbage({kept}, min_age=0)
+        self.assertEqual(removed, 1)
+        self.assertTrue(self.store.has(kept))
+        self.assertFalse(self.store.has(dropped))
+
+    def test_imports_legacy_files_by_name(self):
+        db = Database(os.path.join(self.workdir, 'test.db'))
+        with db.transaction() as cur:
+            cur.executemany('INSERT INTO User VALUES (?, ?)', [(1, 'a'), (2, 'b')])
+            # only user 2 has an ICalCache row, user 1's file was cached before there was one.
+            cur.execute("INSERT INTO ICalCache VALUES (2, 'etag', NULL, 'stale')")
+        os.makedirs(self.root)
+        for name in ('1.ics', '2.ics', '3.ics'):
+            with open(os.path.join(self.root, name), 'w', newline='') as f:
+                f.write(FEED)
+        NotifyDispatcher(db, feed_store=self.store)
+        rows = dict(db.execute('SELECT tg_id, content_hash FROM ICalCache').fetchall())
+        self.assertEqual(rows, {1: ical_hash(FEED), 2: ical_hash(FEED)})
+        self.assertTrue(self.store.has(ical_hash(FEED)))
+        # user 3 is gone, the file is removed without importing it.
+        self.assertFalse([name for name in os.listdir(self.root) if name.endswith('.ics')])
+        # a second process starting later finds nothing left to import.
+        NotifyDispatcher(db, feed_store=self.store)
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
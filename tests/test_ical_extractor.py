@@ -0,0 +1,131 @@
+from datetime import datetime, date, timedelta, timezone
+from zoneinfo import ZoneInfo
+import unittest
+import io
+
+from UoMCheckinBot.ical_extractor import unfold_lines, extract_events, extract_events_icalendar, read_events, parse_description, UnsupportedFeedError
+
+LONDON = ZoneInfo('Europe/London')
+
+def feed(*events, header=()) -> str:
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Scientia Ltd//Syllabus Plus Timetables//EN', *header]
+    for event in events:
+        lines += ['BEGIN:VEVENT', *event, 'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines) + '\r\n'
+
+def event(start: str = 'DTSTART:20261019T090000Z', end: str = 'DTEND:20261019T100000Z', description: str = 'Unit Code: COMP10120', *extra) -> list:
+    return ['UID:1', start, end, 'DESCRIPTION:' + description, *extra]
+
+class UnfoldTest(unittest.TestCase):
+    def test_unfolds_continuation_lines(self):
+        text = 'DESCRIPTION:Unit Code: COMP\r\n 10120\\nUnit\r\n\tDescription: X\r\nEND:VEVENT\r\n'
+        self.assertEqual(list(unfold_lines(text)), ['DESCRIPTION:Unit Code: COMP10120\\nUnitDescription: X', 'END:VEVENT'])
+
+    def test_unfolds_inside_multi_byte_text(self):
+        name = 'Ingeniería de Software 日本語の授業'
+        line = 'DESCRIPTION:Unit Description: ' + name
+        # folded right after the 'í' and between two of the CJK characters.
+        folded = line[:39] + '\r\n ' + line[39:55] + '\r\n ' + line[55:] + '\r\n'
+        self.assertEqual(list(unfold_lines(folded)), [line])
+        records = extract_events(feed(event(description=f'Unit Code: X\\nUnit Description: {name}')).replace(name, name[:12] + '\r\n ' + name[12:]))
+        self.assertEqual(parse_description(records[0].description)['Unit Description'], name)
+
+    def test_unfolds_lines_of_a_file(self):
+        text = feed(event(description='Unit Code: COMP\r\n 10120'))
+        from_file = extract_events(io.StringIO(text, newline=''))
+        self.assertEqual(from_file, extract_events(text))
+        self.assertEqual(from_file[0].description, 'Unit Code: COMP10120')
+
+    def test_a_folded_first_line_is_unsupported(self):
+        with self.assertRaises(UnsupportedFeedError):
+            list(unfold_lines(' BEGIN:VCALENDAR\r\n'))
+
+class DateTimeTest(unittest.TestCase):
+    def start(self, line: str) -> datetime:
+        return extract_events(feed(event(start=line, end=line)))[0].start
+
+    def test_utc(self):
+        self.assertEqual(self.start('DTSTART:20261019T090000Z'), datetime(2026, 10, 19, 9, 0, tzinfo=timezone.utc))
+
+    def test_tzid(self):
+        start = self.start('DTSTART;TZID=Europe/London:20261019T090000')
+        self.assertEqual(start, datetime(2026, 10, 19, 9, 0, tzinfo=LONDON))
+        self.assertEqual(start.utcoffset(), timedelta(hours=1))
+        self.assertEqual(self.start('DTSTART;TZID="Europe/London":20261201T090000').utcoffset(), timedelta(0))
+
+    def test_floating(self):
+        start = self.start('DTSTART:20261019T090000')
+        self.assertEqual(start, datetime(2026, 10, 19, 9, 0))
+        self.assertIsNone(start.tzinfo)
+
+    def test_same_as_icalendar(self):
+        text = feed(event('DTSTART;TZID=Europe/London:20261019T090000', 'DTEND;TZID=Europe/London:20261019T110000'),
+                    event('DTSTART:20261020T130000Z', 'DTEND:20261020T140000Z'))
+        self.assertEqual([(e.start, e.end, e.description) for e in extract_events(text)],
+                         [(e.start, e.end, e.description) for e in extract_events_icalendar(text)])
+
+    def test_all_day_events_are_skipped(self):
+        self.assertEqual(extract_events(feed(event(start='DTSTART;VALUE=DATE:20261019', end='DTEND;VALUE=DATE:20261020'))), [])
+
+    def test_date_range(self):
+        text = feed(event(), event(start='DTSTART:20261020T090000Z', end='DTEND:20261020T100000Z'))
+        self.assertEqual([e.start.day for e in extract_events(text, date(2026, 10, 20), date(2026, 10, 20))], [20])
+
+class UnescapeTest(unittest.TestCase):
+    def test_description(self):
+        records = extract_events(feed(event(description='Unit Code: COMP10120\\nLocation: Kilburn\\, Room 1.8\\; Floor 1\\nNotes: a\\\\b')))
+        self.assertEqual(records[0].description, 'Unit Code: COMP10120\nLocation: Kilburn, Room 1.8; Floor 1\nNotes: a\\b')
+        self.assertEqual(parse_description(records[0].description)['Unit Code'], 'COMP10120')
+
+    def test_escaped_summary_does_not_leak_into_the_event(self):
+        # SUMMARY isn't read, its escaped separators and colons mustn't be taken for properties of the event.
+        records = extract_events(feed(event('DTSTART:20261019T090000Z', 'DTEND:20261019T100000Z', 'Unit Code: X',
+                                            'SUMMARY:COMP10120/Lecture\\, Kilburn\\; DTSTART:20991231T000000Z\\nDESCRIPTION:no')))
+        self.assertEqual(records[0].start, datetime(2026, 10, 19, 9, 0, tzinfo=timezone.utc))
+        self.assertEqual(records[0].description, 'Unit Code: X')
+
+class NestedComponentTest(unittest.TestCase):
+    def test_valarm_is_skipped(self):
+        alarm = ['BEGIN:VALARM', 'ACTION:DISPLAY', 'DESCRIPTION:Reminder', 'TRIGGER;RELATED=START:-PT15M', 'END:VALARM']
+        records = extract_events(feed(event('DTSTART:20261019T090000Z', 'DTEND:20261019T100000Z', 'Unit Code: COMP10120', *alarm)))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].description, 'Unit Code: COMP10120')
+
+    def test_nested_components_are_skipped(self):
+        nested = ['BEGIN:X-OUTER', 'DTSTART:20991231T000000Z', 'BEGIN:VALARM', 'DESCRIPTION:inner', 'END:VALARM', 'END:X-OUTER']
+        records = extract_events(feed(event('DTSTART:20261019T090000Z', 'DTEND:20261019T100000Z', 'Unit Code: COMP10120', *nested)))
+        self.assertEqual((records[0].start.year, records[0].description), (2026, 'Unit Code: COMP10120'))
+
+    def test_vtimezone_outside_events_is_ignored(self):
+        header = ['BEGIN:VTIMEZONE', 'TZID:Europe/London', 'BEGIN:STANDARD', 'DTSTART:19701025T020000', 'TZOFFSETFROM:+0100',
+                  'TZOFFSETTO:+0000', 'END:STANDARD', 'END:VTIMEZONE']
+        self.assertEqual(len(extract_events(feed(event(), header=header))), 1)
+
+    def test_unterminated_event_is_unsupported(self):
+        with self.assertRaises(UnsupportedFeedError):
+            extract_events(feed(event()).replace('END:VEVENT\r\n', ''))
+
+class FallbackTest(unittest.TestCase):
+    # an Outlook-style zone which only the feed's own VTIMEZONE defines.
+    VTIMEZONE = ['BEGIN:VTIMEZONE', 'TZID:GMT Standard Time',
+                 'BEGIN:STANDARD', 'DTSTART:16010101T020000', 'TZOFFSETFROM:+0100', 'TZOFFSETTO:+0000', 'RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=10', 'END:STANDARD',
+                 'BEGIN:DAYLIGHT', 'DTSTART:16010101T010000', 'TZOFFSETFROM:+0000', 'TZOFFSETTO:+0100', 'RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3', 'END:DAYLIGHT',
+                 'END:VTIMEZONE']
+
+    def test_unsupported_feed_falls_back_to_icalendar(self):
+        text = feed(event('DTSTART;TZID=GMT Standard Time:20261019T090000', 'DTEND;TZID=GMT Standard Time:20261019T100000'), header=self.VTIMEZONE)
+        with self.assertRaises(UnsupportedFeedError):
+            extract_events(text)
+        with self.assertLogs('checkin-bot', 'INFO'):
+            records = read_events(text)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].start, datetime(2026, 10, 19, 8, 0, tzinfo=timezone.utc))
+        self.assertEqual(records[0].description, 'Unit Code: COMP10120')
+
+    def test_supported_feed_does_not_fall_back(self):
+        with self.assertNoLogs('checkin-bot', 'INFO'):
+            self.assertEqual(len(read_events(feed(event()))), 1)
+
+if __name__ == '__main__':
+    unittest.main()
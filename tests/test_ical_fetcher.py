@@ -0,0 +1,129 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import unittest
+
+from UoMCheckinBot.ical_fetcher import ICalFetcher
+from tests.feeds import FeedServerThread, closed_port
+
+class ICalFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.feeds = FeedServerThread()
+        self.fetcher = ICalFetcher(max_workers=4, timeout=(2.0, 5.0))
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.feeds.stop()
+
+    def test_fetch(self):
+        result = self.fetcher.fetch(self.feeds.url + '3')
+        body, etag = self.feeds.cache.get(3)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.text, body.decode('utf-8'))
+        self.assertEqual(result.etag, etag)
+
+    def test_http_error_is_a_failed_result(self):
+        result = self.fetcher.fetch(self.feeds.url + 'missing')
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status, 404)
+        self.assertEqual(result.error, 'HTTP 404')
+
+    def test_connection_error_is_a_failed_result(self):
+        result = self.fetcher.fetch(f'http://127.0.0.1:{closed_port()}/feed/1')
+        self.assertFalse(result.ok)
+        self.assertFalse(result.not_modified)
+        self.assertEqual(result.status, 0)
+        self.assertTrue(result.error)
+
+    def test_concurrent_results_are_keyed_to_their_users(self):
+        urls = {100 + n: self.feeds.url + str(n) for n in range(10)}
+        urls[999] = f'http://127.0.0.1:{closed_port()}/feed/1'
+        results = self.fetcher.collect(self.fetcher.submit_all(urls))
+        self.assertEqual(set(results), set(urls))
+        for user_id in urls:
+            if user_id == 999:
+                self.assertFalse(results[user_id].ok)
+                continue
+            self.assertTrue(results[user_id].ok)
+            self.assertEqual(results[user_id].url, urls[user_id])
+            self.assertEqual(results[user_id].text, self.feeds.cache.get(user_id - 100)[0].decode('utf-8'))
+
+class SlowFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.feeds = FeedServerThread(latency=1.0)
+        self.fetcher = ICalFetcher(max_workers=4, timeout=(1.0, 0.2))
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.feeds.stop()
+
+    def test_slow_feed_times_out(self):
+        result = self.fetcher.fetch(self.feeds.url + '1')
+        self.assertFalse(result.ok)
+        self.assertIn('timed out', result.error.lower())
+
+    def test_slow_feeds_time_out_concurrently(self):
+        results = self.fetcher.fetch_all({n: self.feeds.url + str(n) for n in range(4)})
+        self.assertEqual(set(results), set(range(4)))
+        self.assertFalse(any(result.ok for result in results.values()))
+
+# Answers every GET with 304 when the validators match, and records the validators it was sent.
+class ValidatingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    etag = '"v1"'
+    last_modified = 'Mon, 19 Oct 2026 06:00:00 GMT'
+    seen = []
+
+    def do_GET(self):
+        ValidatingHandler.seen.append((self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')))
+        if self.headers.get('If-None-Match') == self.etag or self.headers.get('If-Modified-Since') == self.last_modified:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = b'BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n'
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', self.last_modified)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ConditionalGetTest(unittest.TestCase):
+    def setUp(self):
+        ValidatingHandler.seen = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ValidatingHandler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/feed'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.fetcher = ICalFetcher(max_workers=2)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_first_download_is_unconditional(self):
+        result = self.fetcher.fetch(self.url)
+        self.assertTrue(result.ok)
+        self.assertEqual((result.etag, result.last_modified), (ValidatingHandler.etag, ValidatingHandler.last_modified))
+        self.assertEqual(ValidatingHandler.seen, [(None, None)])
+
+    def test_stored_validators_are_sent(self):
+        result = self.fetcher.fetch(self.url, ValidatingHandler.etag, ValidatingHandler.last_modified)
+        self.assertTrue(result.not_modified)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.text, '')
+        self.assertEqual(ValidatingHandler.seen, [(ValidatingHandler.etag, ValidatingHandler.last_modified)])
+        # a 304 keeps the validators it was asked with.
+        self.assertEqual((result.etag, result.last_modified), (ValidatingHandler.etag, ValidatingHandler.last_modified))
+
+    def test_validators_are_sent_per_key(self):
+        results = self.fetcher.fetch_all({1: self.url, 2: self.url}, {1: ('"old"', None)})
+        self.assertTrue(results[1].ok and results[2].ok)
+        self.assertCountEqual(ValidatingHandler.seen, [('"old"', None), (None, None)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+from datetime import datetime, timedelta, timezone
+import unittest
+import tempfile
+import shutil
+import os
+
+from UoMCheckinBot.database import Database
+from UoMCheckinBot.feed_store import FeedStore
+from UoMCheckinBot.ical_fetcher import ICalFetcher, FetchResult
+from UoMCheckinBot.notify_dispatcher import NotifyDispatcher, User, UserConfig, local_day_bounds, utc_iso
+from UoMCheckinBot.notify_scheduler import VirtualClock
+from UoMCheckinBot.parse_pool import ParsePool
+from tests.feeds import FeedServerThread
+
+NOW = datetime(2026, 10, 19, 6, 0, tzinfo=timezone.utc)
+
+def session_feed(*events) -> str:
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Scientia Ltd//Syllabus Plus Timetables//EN']
+    for start, code, course_type in events:
+        lines += ['BEGIN:VEVENT', 'DTSTART:' + start.strftime('%Y%m%dT%H%M%SZ'), 'DTEND:' + (start + timedelta(hours=1)).strftime('%Y%m%dT%H%M%SZ'),
+                  f'SUMMARY:{code}/{course_type}', f'DESCRIPTION:Unit Code: {code}\\nUnit Description: Unit {code}\\nEvent type: {course_type}', 'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines) + '\r\n'
+
+# Answers every download of a subscription with the feed it was given.
+class StubFetcher:
+    def __init__(self, feeds: dict):
+        self.feeds = feeds
+
+    def fetch(self, url: str, etag: str = None, last_modified: str = None) -> FetchResult:
+        return FetchResult(url, 200, self.feeds[url])
+
+# Parses in-process and records which users' feeds it was given.
+class RecordingParsePool(ParsePool):
+    def __init__(self):
+        super().__init__(workers=1)
+        self.parsed = []
+
+    def parse(self, contents: dict):
+        self.parsed.extend(contents)
+        yield from super().parse(contents)
+
+class DispatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.workdir, 'test.db'))
+        self.clock = VirtualClock(NOW)
+        self.parse_pool = RecordingParsePool()
+        self.fetcher = ICalFetcher(max_workers=4)
+        self.dispatcher = NotifyDispatcher(self.db, self.fetcher, self.clock, self.parse_pool, feed_store=FeedStore(os.path.join(self.workdir, 'ical')))
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.db.close()
+        shutil.rmtree(self.workdir)
+
+class RefreshTest(DispatcherTestCase):
+    def setUp(self):
+        super().setUp()
+        self.feeds = FeedServerThread()
+        for user_id in range(3):
+            self.dispatcher.add_user(User(user_id, self.feeds.url + str(user_id), UserConfig()))
+
+    def tearDown(self):
+        self.feeds.stop()
+        super().tearDown()
+
+    def refresh(self) -> dict:
+        self.parse_pool.parsed.clear()
+        self.assertTrue(self.dispatcher.load_all_users_calendars(fetch_local=False))
+        return self.dispatcher.refresh_report
+
+    def test_not_modified_feeds_are_not_parsed_again(self):
+        self.assertEqual(self.refresh(), {'unchanged': 0, 'changed': 3, 'failed': 0})
+        self.assertCountEqual(self.parse_pool.parsed, [0, 1, 2])
+        etags = dict(self.db.execute('SELECT tg_id, etag FROM ICalCache').fetchall())
+        self.assertEqual(etags, {n: self.feeds.cache.get(n)[1] for n in range(3)})
+        self.assertEqual(self.refresh(), {'unchanged': 3, 'changed': 0, 'failed': 0})
+        self.assertEqual(self.parse_pool.parsed, [])
+
+    def test_same_content_without_validators_is_not_parsed_again(self):
+        self.refresh()
+        indexed = self.db.execute('SELECT COUNT(*) FROM EventIndex').fetchone()[0]
+        # the server answers 200 with the same body, the content hash matches the cached one.
+        self.db.execute('UPDATE ICalCache SET etag=NULL, last_modified=NULL')
+        self.assertEqual(self.refresh(), {'unchanged': 3, 'changed': 0, 'failed': 0})
+        self.assertEqual(self.parse_pool.parsed, [])
+        self.assertEqual(self.db.execute('SELECT COUNT(*) FROM EventIndex').fetchone()[0], indexed)
+
+    def test_changed_subscription_is_downloaded_unconditionally(self):
+        self.refresh()
+        self.dispatcher.update_user_subscription(1, self.feeds.url + '7', load=False)
+        self.assertIsNone(self.db.execute('SELECT etag FROM ICalCache WHERE tg_id=1').fetchone())
+        self.assertEqual(self.refresh(), {'unchanged': 2, 'changed': 1, 'failed': 0})
+        self.assertEqual(self.parse_pool.parsed, [1])
+
+class DispatchTest(DispatcherTestCase):
+    LECTURE = (NOW + timedelta(hours=6), 'COMP10120', 'Lecture')
+    LAB = (NOW + timedelta(hours=8), 'COMP15111', 'Laboratory')
+
+    def setUp(self):
+        super().setUp()
+        self.dispatcher.fetcher = StubFetcher({'a': session_feed(self.LECTURE, self.LAB), 'b': session_feed(self.LECTURE)})
+        self.dispatcher.add_user(User(1, 'a', UserConfig()))
+        self.dispatcher.add_user(User(2, 'b', UserConfig()))
+
+    def load(self, dispatcher: NotifyDispatcher):
+        for user in dispatcher.users.values():
+            self.assertTrue(dispatcher.load_user_calendar(user))
+
+    def catalogue(self) -> tuple:
+        return (self.db.execute('SELECT * FROM Session ORDER BY id').fetchall(), self.db.execute('SELECT * FROM Enrolment ORDER BY user_id, session_id').fetchall())
+
+    def test_dispatching_the_same_feeds_again_changes_nothing(self):
+        self.load(self.dispatcher)
+        self.dispatcher.dispatchAll()
+        sessions, enrolments = self.catalogue()
+        self.assertEqual(len(sessions), 2)
+        self.assertEqual(len(enrolments), 3)
+        # the feeds are indexed again, so every user is dispatched again.
+        self.load(self.dispatcher)
+        self.assertEqual(self.dispatcher.changed_users, {1, 2})
+        self.dispatcher.dispatchAll()
+        self.assertEqual(self.catalogue(), (sessions, enrolments))
+        # a restarted process has none of the ids cached.
+        restarted = NotifyDispatcher(self.db, StubFetcher({}), self.clock, self.parse_pool, feed_store=self.dispatcher.store)
+        self.assertTrue(restarted.load_users())
+        restarted.dispatchAll()
+        self.assertEqual(self.catalogue(), (sessions, enrolments))
+
+    def test_duplicate_events_are_one_session(self):
+        self.dispatcher.fetcher.feeds['a'] = session_feed(self.LECTURE, self.LECTURE)
+        self.load(self.dispatcher)
+        self.assertEqual(self.db.execute('SELECT COUNT(*) FROM EventIndex WHERE user_id=1').fetchone()[0], 2)
+        self.dispatcher.dispatchAll()
+        sessions, enrolments = self.catalogue()
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(enrolments, [(1, sessions[0][0]), (2, sessions[0][0])])
+        due = self.LECTURE[0] - timedelta(minutes=UserConfig().lead_minutes)
+        self.assertEqual(self.dispatcher.due_index.due_times(), [due])
+        self.assertEqual(sorted(course.user_id for course in self.dispatcher.pop_due_courses(due)), [1, 2])
+
+class ResumeTest(DispatcherTestCase):
+    def test_resumes_only_todays_sessions(self):
+        day_start, day_end = local_day_bounds(NOW)
+        today = day_end - timedelta(hours=1)
+        starts = [today, day_start - timedelta(hours=1), day_end + timedelta(hours=1)]
+        self.dispatcher.add_user(User(1, 'http://feed', UserConfig()))
+        with self.db.transaction() as cur:
+            cur.execute("INSERT INTO Unit VALUES (1, 'COMP10120', 'First Year Team Project')")
+            cur.executemany("INSERT INTO Session VALUES (?, 1, 'Lecture', ?, ?)", [(n, utc_iso(start), utc_iso(start + timedelta(hours=1))) for n, start in enumerate(starts)])
+            # today's range, but not a time fromisoformat can read.
+            cur.execute("INSERT INTO Session VALUES (3, 1, 'Lab', ?, ?)", [utc_iso(day_start) + 'x', utc_iso(day_end)])
+            cur.executemany('INSERT INTO Enrolment VALUES (1, ?)', [(n,) for n in range(4)])
+            cur.execute("INSERT INTO DispatchState VALUES ('dispatch_date', ?)", [NOW.astimezone().date().isoformat()])
+        with self.assertLogs('checkin-bot', 'WARNING'):
+            self.assertTrue(self.dispatcher.resume_dispatch())
+        self.assertEqual(self.dispatcher.due_index.due_times([1]), [today - timedelta(minutes=UserConfig().lead_minutes)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta, timezone
+import unittest
+import time
+import os
+
+from UoMCheckinBot.notify_scheduler import TimerEngine, VirtualClock
+
+START = datetime(2026, 10, 19, 8, 0, tzinfo=timezone.utc)
+
+class TimerEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock(START)
+        self.engine = TimerEngine(self.clock)
+        self.fired = []
+
+    def schedule(self, key, minutes: float, expires_minutes: float = None):
+        expires = START + timedelta(minutes=expires_minutes) if expires_minutes is not None else None
+        self.engine.schedule_at(key, START + timedelta(minutes=minutes), lambda: self.fired.append(key), expires=expires)
+
+    def test_fires_only_due_timers(self):
+        self.schedule('a', 1)
+        self.schedule('b', 5)
+        self.clock.advance(timedelta(minutes=2))
+        self.assertEqual(self.engine.run_pending(), 1)
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(self.engine.next_due(), START + timedelta(minutes=5))
+
+    def test_catches_up_overdue_timers_in_order(self):
+        self.schedule('b', 2)
+        self.schedule('a', 1)
+        self.schedule('c', 3)
+        # the engine stalled past all of them.
+        self.clock.advance(timedelta(minutes=30))
+        self.assertEqual(self.engine.run_pending(), 3)
+        self.assertEqual(self.fired, ['a', 'b', 'c'])
+        self.assertEqual(self.engine.pending(), 0)
+
+    def test_drops_expired_timers(self):
+        self.schedule('expired', 1, expires_minutes=5)
+        self.schedule('late', 2, expires_minutes=20)
+        self.clock.advance(timedelta(minutes=10))
+        self.assertEqual(self.engine.run_pending(), 1)
+        self.assertEqual(self.fired, ['late'])
+        self.assertEqual(self.engine.pending(), 0)
+
+    def test_rescheduling_a_key_replaces_the_timer(self):
+        self.schedule('a', 1)
+        self.schedule('a', 10)
+        self.clock.advance(timedelta(minutes=5))
+        self.assertEqual(self.engine.run_pending(), 0)
+        self.clock.advance(timedelta(minutes=5))
+        self.assertEqual(self.engine.run_pending(), 1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_cancel_group(self):
+        self.engine.schedule_at('a', START, lambda: self.fired.append('a'), group='g')
+        self.engine.schedule_at('b', START, lambda: self.fired.append('b'), group='g')
+        self.schedule('c', 0)
+        self.assertEqual(self.engine.cancel_group('g'), 2)
+        self.engine.run_pending()
+        self.assertEqual(self.fired, ['c'])
+
+    def test_failing_callback_does_not_stop_the_others(self):
+        self.engine.schedule_at('bad', START, lambda: 1 / 0)
+        self.schedule('good', 0)
+        with self.assertLogs('checkin-bot', 'ERROR'):
+            self.assertEqual(self.engine.run_pending(), 2)
+        self.assertEqual(self.fired, ['good'])
+
+class ScheduleDailyTest(unittest.TestCase):
+    def setUp(self):
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Europe/London'
+        time.tzset()
+
+    def tearDown(self):
+        if self.tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def next_run(self, now: datetime) -> datetime:
+        engine = TimerEngine(VirtualClock(now))
+        engine.schedule_daily('daily', 6, 0, lambda: None)
+        return engine.next_due()
+
+    def test_later_today(self):
+        self.assertEqual(self.next_run(datetime(2026, 10, 19, 4, 0, tzinfo=timezone.utc)), datetime(2026, 10, 19, 5, 0, tzinfo=timezone.utc))
+
+    def test_keeps_local_time_when_the_clocks_go_forward(self):
+        # 07:00 GMT on the Saturday, the clocks go forward that night, 06:00 BST is 05:00 UTC.
+        self.assertEqual(self.next_run(datetime(2026, 3, 28, 7, 0, tzinfo=timezone.utc)), datetime(2026, 3, 29, 5, 0, tzinfo=timezone.utc))
+
+    def test_keeps_local_time_when_the_clocks_go_back(self):
+        # 07:00 BST on the Saturday, the clocks go back that night, 06:00 GMT is 06:00 UTC.
+        self.assertEqual(self.next_run(datetime(2026, 10, 24, 6, 0, tzinfo=timezone.utc)), datetime(2026, 10, 25, 6, 0, tzinfo=timezone.utc))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+import unittest
+import tempfile
+import shutil
+import os
+
+from UoMCheckinBot.database import Database
+from UoMCheckinBot.notify_scheduler import VirtualClock
+from UoMCheckinBot.refresh_scheduler import RefreshScheduler, CHANGED, UNCHANGED, FAILED, MAX_BACKOFF
+
+NOW = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+class RefreshSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.workdir, 'test.db'))
+        self.clock = VirtualClock(NOW)
+        self.scheduler = RefreshScheduler(self.db, self.clock)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.workdir)
+
+    def backoff(self) -> timedelta:
+        return self.scheduler.state(1).next_refresh - self.clock.now()
+
+    def test_failures_back_off_exponentially(self):
+        backoffs = []
+        for _ in range(3):
+            self.scheduler.record({1: FAILED})
+            backoffs.append(self.backoff())
+        self.assertEqual(backoffs, [timedelta(minutes=15), timedelta(minutes=30), timedelta(minutes=60)])
+
+    def test_backoff_is_capped_for_a_long_dead_feed(self):
+        for _ in range(100):
+            self.clock.advance(timedelta(days=1))
+            self.scheduler.record({1: FAILED})
+            self.assertLessEqual(self.backoff(), MAX_BACKOFF)
+        self.assertEqual(self.scheduler.state(1).failures, 100)
+        self.assertEqual(self.backoff(), MAX_BACKOFF)
+        # the state survives a restart.
+        restarted = RefreshScheduler(self.db, self.clock)
+        self.assertEqual(restarted.state(1).failures, 100)
+
+    def test_success_resets_the_backoff(self):
+        for _ in range(5):
+            self.scheduler.record({1: FAILED})
+        self.scheduler.record({1: UNCHANGED})
+        self.assertEqual(self.scheduler.state(1).failures, 0)
+        self.scheduler.record({1: FAILED})
+        self.assertEqual(self.backoff(), timedelta(minutes=15))
+
+    def test_stable_feeds_are_refreshed_in_the_night_window(self):
+        self.scheduler.record({1: UNCHANGED})
+        slot = self.scheduler.state(1).next_refresh.astimezone()
+        start, end = self.scheduler.window
+        self.assertTrue(start <= slot.hour < end)
+        self.assertTrue(timedelta(0) < slot - self.clock.now() <= timedelta(days=1, hours=1))
+
+    def test_often_changing_feeds_are_refreshed_more_often(self):
+        for _ in range(5):
+            self.scheduler.record({1: CHANGED})
+        self.assertEqual(self.backoff(), timedelta(hours=6))
+
+    def test_due(self):
+        self.assertEqual(self.scheduler.due([1, 2], cached={1}), [2])
+        self.scheduler.record({2: FAILED})
+        self.assertEqual(self.scheduler.due([1, 2]), [])
+        self.clock.advance(timedelta(minutes=15))
+        self.assertEqual(self.scheduler.due([1, 2]), [2])
+        self.clock.advance(timedelta(days=1))
+        self.assertEqual(self.scheduler.due([1, 2]), [1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta, timezone
+import threading
+import unittest
+
+from telegram.error import NetworkError, BadRequest, RetryAfter
+
+from UoMCheckinBot.send_pipeline import SendPipeline, TokenBucket
+
+# A stand-in for telegram.Bot which records what was sent, and raises the errors it is given for the next sends to a chat.
+class StubBot:
+    def __init__(self):
+        self.sent = 0
+        self.chats = set()
+        self.__errors = {}
+        self.__lock = threading.Lock()
+
+    def fail_next(self, chat_id, *errors):
+        with self.__lock:
+            self.__errors.setdefault(chat_id, []).extend(errors)
+
+    def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        with self.__lock:
+            errors = self.__errors.get(chat_id)
+            if errors:
+                raise errors.pop(0)
+            self.sent += 1
+            self.chats.add(chat_id)
+
+class SendPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = StubBot()
+        # no rate limits and short backoffs, the tests don't wait for Telegram's timing.
+        self.pipeline = SendPipeline(self.bot, workers=2, global_rate=1e6, chat_rate=1e6, max_retries=3, backoff=0.01)
+        self.pipeline.start()
+        self.delivered = []
+
+    def tearDown(self):
+        self.pipeline.stop()
+
+    def send(self, chat_id: int):
+        return self.pipeline.send(chat_id, 'reminder', session_start=datetime.now(timezone.utc) + timedelta(minutes=10), on_sent=self.delivered.append)
+
+    def test_sends_and_reports_delivery(self):
+        jobs = [self.send(chat_id) for chat_id in range(5)]
+        self.assertTrue(self.pipeline.join(5))
+        self.assertEqual(self.bot.sent, 5)
+        self.assertEqual(self.bot.chats, set(range(5)))
+        self.assertCountEqual(self.delivered, jobs)
+        self.assertEqual(self.pipeline.stats, {'sent': 5, 'retried': 0, 'failed': 0})
+
+    def test_retries_network_errors(self):
+        self.bot.fail_next(1, NetworkError('timed out'), NetworkError('timed out'))
+        with self.assertLogs('checkin-bot', 'WARNING'):
+            job = self.send(1)
+            self.assertTrue(self.pipeline.join(5))
+        self.assertEqual(job.attempts, 3)
+        self.assertEqual(self.delivered, [job])
+        self.assertEqual(self.pipeline.stats, {'sent': 1, 'retried': 2, 'failed': 0})
+
+    def test_retries_after_flood_limit(self):
+        self.bot.fail_next(1, RetryAfter(0.01))
+        with self.assertLogs('checkin-bot', 'WARNING'):
+            job = self.send(1)
+            self.assertTrue(self.pipeline.join(5))
+        self.assertEqual(self.delivered, [job])
+        self.assertEqual(self.pipeline.stats['retried'], 1)
+
+    def test_gives_up_after_max_retries(self):
+        self.bot.fail_next(1, *[NetworkError('timed out')] * 10)
+        with self.assertLogs('checkin-bot', 'WARNING'):
+            job = self.send(1)
+            self.assertTrue(self.pipeline.join(5))
+        self.assertEqual(job.attempts, 4)
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(self.pipeline.stats, {'sent': 0, 'retried': 3, 'failed': 1})
+
+    def test_does_not_retry_permanent_errors(self):
+        self.bot.fail_next(1, BadRequest('Chat not found'))
+        with self.assertLogs('checkin-bot', 'ERROR'):
+            job = self.send(1)
+            other = self.send(2)
+            self.assertTrue(self.pipeline.join(5))
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(self.delivered, [other])
+        self.assertEqual(self.pipeline.stats, {'sent': 1, 'retried': 0, 'failed': 1})
+
+class TokenBucketTest(unittest.TestCase):
+    def test_refills_at_the_rate(self):
+        now = [0.0]
+        bucket = TokenBucket(2.0, capacity=1.0, clock=lambda: now[0])
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertAlmostEqual(bucket.try_acquire(), 0.5)
+        now[0] = 0.5
+        self.assertEqual(bucket.try_acquire(), 0.0)
+
+    def test_pause(self):
+        now = [0.0]
+        bucket = TokenBucket(1.0, capacity=1.0, clock=lambda: now[0])
+        bucket.pause(3.0)
+        self.assertAlmostEqual(bucket.try_acquire(), 4.0)
+
+if __name__ == '__main__':
+    unittest.main()
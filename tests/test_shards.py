@@ -0,0 +1,81 @@
+import threading
+import unittest
+import tempfile
+import shutil
+import os
+
+from UoMCheckinBot.database import Database
+from UoMCheckinBot.shards import CommandQueue, shard_of
+
+class CommandQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        path = os.path.join(self.workdir, 'test.db')
+        # the front and two workers, each with its own Database like separate processes.
+        self.dbs = [Database(path) for _ in range(3)]
+        self.front, self.a, self.b = [CommandQueue(db, 2) for db in self.dbs]
+
+    def tearDown(self):
+        for db in self.dbs:
+            db.close()
+        shutil.rmtree(self.workdir)
+
+    def test_submit_routes_to_the_shard_of_the_chat(self):
+        for chat_id in range(20):
+            self.assertEqual(self.front.submit('stop', chat_id), shard_of(chat_id, 2))
+        self.assertEqual(self.front.pending(0) + self.front.pending(1), 20)
+
+    def test_a_command_is_claimed_once(self):
+        chats = [chat_id for chat_id in range(400) if shard_of(chat_id, 2) == 0][:100]
+        for chat_id in chats:
+            self.front.submit('set_lead', chat_id, minutes=chat_id)
+        taken = {self.a: [], self.b: []}
+
+        def work(queue: CommandQueue):
+            while True:
+                commands = queue.take(0, limit=8)
+                if not commands:
+                    return
+                taken[queue].extend(commands)
+
+        threads = [threading.Thread(target=work, args=[queue]) for queue in taken]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        commands = taken[self.a] + taken[self.b]
+        self.assertEqual(len(commands), len(chats))
+        self.assertCountEqual([command.chat_id for command in commands], chats)
+        self.assertTrue(all(command.payload == {'minutes': command.chat_id} for command in commands))
+
+    def test_commands_of_a_chat_come_in_order(self):
+        chat_id = next(n for n in range(100) if shard_of(n, 2) == 1)
+        for command in ('subscribe', 'set_lead', 'stop'):
+            self.front.submit(command, chat_id)
+        handled = []
+        queues = [self.a, self.b]
+        for turn in range(6):
+            commands = queues[turn % 2].take(1)
+            self.assertLessEqual(len(commands), 1)
+            # nothing else of the chat is taken while a command is claimed.
+            self.assertEqual(queues[(turn + 1) % 2].take(1), [])
+            for command in commands:
+                handled.append(command.command)
+                queues[turn % 2].done(command.id)
+        self.assertEqual(handled, ['subscribe', 'set_lead', 'stop'])
+        self.assertEqual(self.front.pending(), 0)
+
+    def test_claims_are_released_after_a_worker_dies(self):
+        chats = [n for n in range(100) if shard_of(n, 2) == 0][:3]
+        for chat_id in chats:
+            self.front.submit('stop', chat_id)
+        claimed = self.a.take(0)
+        self.assertEqual(len(claimed), 3)
+        # the worker dies without finishing them, its successor releases the claims when it starts.
+        self.assertEqual(self.b.take(0), [])
+        self.assertEqual(self.b.release(0), 3)
+        self.assertEqual([command.id for command in self.b.take(0)], [command.id for command in claimed])
+        self.assertEqual(self.b.release(1), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import http.client
+import threading
+import unittest
+import os
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, TypeHandler
+
+from UoMCheckinBot.webhook_server import WebhookServer
+from UoMCheckinBot.metrics import WEBHOOK_UPDATES
+
+SECRET = 'test-secret'
+UPDATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'updates', 'help.json')
+
+class WebhookServerTest(unittest.TestCase):
+    def setUp(self):
+        with open(UPDATE_PATH, 'rb') as f:
+            self.update = f.read()
+        self.handled = []
+        self.received = threading.Event()
+        # a handler which doesn't need the Bot API, the recorded update only has to reach the dispatcher.
+        self.dispatcher = Dispatcher(Bot('123456:TEST'), None, workers=0)
+        self.dispatcher.add_handler(TypeHandler(Update, self.handle))
+        self.server = WebhookServer(self.dispatcher, '127.0.0.1', 0, '/telegram', SECRET, workers=2, queue_size=4)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def handle(self, update: Update, context):
+        self.handled.append(update)
+        self.received.set()
+
+    def post(self, path: str = '/telegram', body: bytes = None, headers: dict = None) -> int:
+        headers = headers if headers is not None else {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+        body = self.update if body is None else body
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+        try:
+            conn.putrequest('POST', path)
+            headers.setdefault('Content-Length', str(len(body)))
+            headers.setdefault('Content-Type', 'application/json')
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            conn.endheaders(body)
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    def test_accepts_a_recorded_update(self):
+        accepted = WEBHOOK_UPDATES.value(result='accepted')
+        self.assertEqual(self.post(), 200)
+        self.assertTrue(self.received.wait(5))
+        self.assertEqual(self.handled[0].effective_chat.id, 424242)
+        self.assertEqual(self.handled[0].message.text, '/help')
+        self.assertEqual(WEBHOOK_UPDATES.value(result='accepted'), accepted + 1)
+
+    def test_rejects_a_wrong_path(self):
+        self.assertEqual(self.post('/other'), 404)
+
+    def test_rejects_a_wrong_or_missing_secret(self):
+        self.assertEqual(self.post(headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}), 403)
+        self.assertEqual(self.post(headers={}), 403)
+        self.assertFalse(self.received.wait(0.2))
+
+    def test_rejects_invalid_bodies(self):
+        invalid = WEBHOOK_UPDATES.value(result='invalid')
+        self.assertEqual(self.post(body=b'not json'), 400)
+        self.assertEqual(self.post(body=b''), 400)
+        self.assertEqual(self.post(headers={'X-Telegram-Bot-Api-Secret-Token': SECRET, 'Content-Length': 'abc'}), 400)
+        self.assertEqual(WEBHOOK_UPDATES.value(result='invalid'), invalid + 3)
+
+if __name__ == '__main__':
+    unittest.main()